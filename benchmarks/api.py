@@ -0,0 +1,251 @@
+# coding: utf8
+#
+
+"""API benchmark: every public method of Catalog and Basket
+
+    python3 -m benchmarks.api --items 10000 --baskets 2000 --output a.json
+    python3 -m benchmarks.compare a.json b.json
+
+The catalog and the baskets are generated from --seed, so runs with the
+same arguments work on the same data.  Baskets pick popular items more
+often, the stock of those is short and their reservations contend.
+Each call is followed by a flush, and by a rollback that is not timed,
+so every call sees the same data.  The statements column is the number
+of statements of one call after the first one.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import inspect
+import io
+import json
+import sys
+import time
+
+from putiikki import be, models
+
+from . import common
+from .export import CountingFile
+
+PRICES = [('<', 10.0), ('range', 10.0, 30.0), ('>=', 30.0)]
+EXTRA = 'BENCH_EXTRA'
+
+# connection and session handling and statistics, nothing to time
+UNTIMED = set(['Catalog.close', 'Catalog.request', 'Catalog.transaction',
+               'Catalog.cache_stats', 'Catalog.result_cache_stats',
+               'Catalog.retry_stats'])
+
+def public_methods():
+    """Names of the public methods of Catalog and Basket"""
+    names = set()
+    for cls in (be.Catalog, be.Basket):
+        for name in vars(cls):
+            if not name.startswith('_') and \
+              inspect.isfunction(getattr(cls, name)):
+                names.add('{:s}.{:s}'.format(cls.__name__, name))
+    return names
+
+def new_items(items, count, tag):
+    """count items like those of items, with codes of their own"""
+    return [dict(x, code='BENCH_NEW_{:s}_{:d}'.format(tag, i))
+            for i, x in enumerate(items[:count])]
+
+def import_file(items):
+    """items as the JSON array that import_items reads"""
+    rows = [dict(x, price=str(x['price'])) for x in items]
+    return json.dumps(rows)
+
+def catalog_cases(catalog, typeahead, items, repeat):
+    hot = items[0]['code']
+    codes = [x['code'] for x in items]
+    item_id = catalog.get_item(hot)[0]
+    category = catalog.session.query(models.Category.id).\
+      filter(~models.Category.name.in_(items[0]['categories'])).\
+      order_by(models.Category.id).first()[0]
+    stock_rows = [(x['code'], 1, x['price']) for x in items[:1000]]
+    # imports are committed, each call gets items and a source of its own
+    imports = iter([(io.StringIO(import_file(new_items(
+        items, 100, 'I{:d}'.format(i)))), 'bench-{:d}'.format(i))
+                    for i in range(repeat + 1)])
+    cursor = catalog.list_items(cursor='')['cursor']
+    added = new_items(items, 10, 'A')
+    # add_items_with_stock creates the categories of the items
+    added_with_stock = [dict(x, categories=['Category B {:d}'.format(i)])
+                        for i, x in enumerate(new_items(items, 10, 'B'))]
+    bulk_added = new_items(items, 1000, 'C')
+
+    return [
+        ('Catalog.get_item', lambda: catalog.get_item(hot)),
+        ('Catalog.get_item object',
+         lambda: catalog.get_item(hot, as_object=True)),
+        ('Catalog.get_stock', lambda: catalog.get_stock(hot)),
+        ('Catalog.get_stock object',
+         lambda: catalog.get_stock(hot, as_object=True)),
+        ('Catalog.list_items', lambda: catalog.list_items()),
+        ('Catalog.list_items page 50',
+         lambda: catalog.list_items(page=50)),
+        ('Catalog.list_items cursor',
+         lambda: catalog.list_items(cursor=cursor)),
+        ('Catalog.list_items json',
+         lambda: catalog.list_items(result='json')),
+        ('Catalog.search_items',
+         lambda: catalog.search_items('red', (0.0, 100.0))),
+        ('Catalog.list_items_by_category',
+         lambda: catalog.list_items_by_category('Category 1')),
+        ('Catalog.search_text', lambda: catalog.search_text('habanero')),
+        ('Catalog.list_items_by_prices',
+         lambda: catalog.list_items_by_prices(PRICES)),
+        ('Catalog.facets_by_prices',
+         lambda: catalog.facets_by_prices(PRICES)),
+        ('Catalog.typeahead', lambda: typeahead.typeahead('red')),
+        ('Catalog.refresh_typeahead', typeahead.refresh_typeahead),
+        ('Catalog.export',
+         lambda: catalog.export(CountingFile(), 'jsonl')),
+        ('Catalog.check_reservations', catalog.check_reservations),
+        ('Catalog.get_basket', lambda: catalog.get_basket('bench-0')),
+        ('Catalog.create_basket', lambda: catalog.create_basket('bench')),
+        ('Catalog.add_item',
+         lambda: catalog.add_item('BENCH_NEW', 'Red habanero 10')),
+        ('Catalog.add_items',
+         lambda: catalog.add_items(added)),
+        ('Catalog.add_items_with_stock',
+         lambda: catalog.add_items_with_stock(added_with_stock)),
+        ('Catalog.bulk_add_items_with_stock',
+         lambda: catalog.bulk_add_items_with_stock(bulk_added)),
+        ('Catalog.add_category',
+         lambda: catalog.add_category('Category new')),
+        ('Catalog.add_categories',
+         lambda: catalog.add_categories(['Category new {:d}'.format(i)
+                                         for i in range(10)])),
+        ('Catalog.add_item_category',
+         lambda: catalog.add_item_category(item_id, category)),
+        ('Catalog.update_item',
+         lambda: catalog.update_item(hot, description='Red habanero 20')),
+        ('Catalog.remove_item', lambda: catalog.remove_item(EXTRA)),
+        ('Catalog.add_stock',
+         lambda: catalog.add_stock([{'code': EXTRA, 'count': 10,
+                                     'price': 1.0}])),
+        ('Catalog.update_stock count',
+         lambda: catalog.update_stock(hot, 200, items[0]['price'])),
+        ('Catalog.update_stock price',
+         lambda: catalog.update_stock(hot, items[0]['count'], 1.0)),
+        ('Catalog.update_stocks 1000',
+         lambda: catalog.update_stocks(stock_rows)),
+        ('Catalog.rebalance_reservations 10',
+         lambda: catalog.rebalance_reservations(codes[:10])),
+        # these two commit, they are run last
+        ('Catalog.import_items 100',
+         lambda: catalog.import_items(*next(imports))),
+        ('Catalog.expire_baskets none',
+         lambda: catalog.expire_baskets(365 * 86400))]
+
+def basket_cases(catalog, items):
+    hot = items[0]['code']
+    basket = catalog.get_basket('bench-0')
+    lines = basket.list_items()
+    code = lines[0]['code']
+    stock_id = catalog.get_stock(code)[0]
+    adds = [(x['code'], 1) for x in items[:10]]
+
+    return [
+        ('Basket.get', lambda: be.Basket.get(catalog, 'bench-0')),
+        ('Basket.get_item', lambda: basket.get_item(stock_id)),
+        ('Basket.list_items', basket.list_items),
+        ('Basket.list_items_by_prices',
+         lambda: basket.list_items_by_prices(PRICES)),
+        ('Basket.get_total', basket.get_total),
+        ('Basket.get_total prices', lambda: basket.get_total(PRICES)),
+        ('Basket.dump', lambda: basket.dump(CountingFile())),
+        ('Basket.create', lambda: be.Basket.create(catalog, 'bench')),
+        ('Basket.add_item', lambda: basket.add_item(hot, 1)),
+        ('Basket.add_items 10', lambda: basket.add_items(adds)),
+        ('Basket.set_items 10', lambda: basket.set_items(adds)),
+        ('Basket.update_item_count',
+         lambda: basket.update_item_count(code, 2)),
+        ('Basket.remove_item', lambda: basket.remove_item(code)),
+        ('Basket.checkout', basket.checkout),
+        ('Basket.delete', basket.delete)]
+
+def measure(session, counter, fun, repeat):
+    """Time fun and the flush after it, rolling back after each call.
+    The first call builds and prepares the statements and is not timed.
+    """
+    fun()
+    session.rollback()
+    times = []
+    statements = None
+    for i in range(repeat):
+        count = counter.count
+        start = time.perf_counter()
+        fun()
+        session.flush()
+        times.append(time.perf_counter() - start)
+        if statements is None:
+            statements = counter.count - count
+        session.rollback()
+    res = common.timing(times)
+    res['statements'] = statements
+    return res
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0], items=10000)
+    parser.set_defaults(repeat=10)
+    parser.add_argument('--baskets', type=int, default=2000,
+                        help='number of live baskets')
+    parser.add_argument('--lines', type=int, default=5,
+                        help='most items in a basket')
+    parser.add_argument('--prepared', action='store_true',
+                        help='run the hot queries as prepared statements')
+    parser.add_argument('--reservation', default='serializable',
+                        choices=be.RESERVATION_STRATEGIES)
+    args = parser.parse_args()
+
+    engine = common.connect(args)
+    items = common.make_items(args.items, args.seed)
+    common.create_catalog(engine, items)
+    codes = [x['code'] for x in items]
+    common.create_baskets(engine, common.make_baskets(
+        codes, args.baskets, args.seed, args.lines))
+
+    catalog = be.Catalog(engine, prepared=args.prepared,
+                         reservation=args.reservation)
+    catalog.add_item(EXTRA, 'Red habanero 5')
+    catalog.session.commit()
+    typeahead = be.Catalog(engine, typeahead=True)
+
+    cases = basket_cases(catalog, items) + \
+      catalog_cases(catalog, typeahead, items, args.repeat)
+    missing = public_methods() - UNTIMED - \
+      set(name.split()[0] for name, fun in cases)
+    if len(missing) > 0:
+        sys.exit('No cases for {:s}'.format(', '.join(sorted(missing))))
+
+    counter = common.StatementCounter(engine)
+    rows = []
+    for name, fun in cases:
+        timing = measure(catalog.session, counter, fun, args.repeat)
+        rows.append((name, timing,
+                     '{:d} statements'.format(timing['statements'])))
+    catalog.close()
+    typeahead.close()
+
+    common.report('API, {:d} items, {:d} baskets, {:s}{:s}'.format(
+        args.items, args.baskets, args.reservation,
+        ', prepared' if args.prepared else ''), rows, args, engine)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+# coding: utf8
+#
+
+"""Checkout benchmark: simultaneous checkouts of baskets of hot items
+
+    python3 -m benchmarks.checkout --threads 8 --baskets 50 --lines 5
+
+Every thread fills --baskets baskets with --lines items picked from the
+--hot most popular items, and once all are filled they check them out
+at the same time.  Basket.checkout with both reservation strategies is
+compared to a checkout written with the ORM a row at a time.  Each
+checkout is a transaction, retried after serialization failures and
+deadlocks as --attempts allows.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random
+import threading
+import time
+import uuid
+
+from putiikki import be, models
+
+from . import common
+
+def row_by_row(basket):
+    """Checkout with a statement for each row, as done before checkout()"""
+    session = basket.session
+    order = models.Order(session='bench')
+    session.add(order)
+    q = session.query(models.BasketItem).\
+      filter(models.BasketItem.basket_id == basket.id)
+    for basket_item in q:
+        stock = basket_item.stock_item
+        for reservation in basket_item.reservation:
+            stock.count -= reservation.count
+            stock.reserved -= reservation.count
+            session.add(models.OrderLine(order=order, stock_item=stock,
+                                         count=reservation.count,
+                                         price=stock.price))
+            session.delete(reservation)
+        session.delete(basket_item)
+    session.flush()
+
+def run(engine, mode, strategy, codes, args, seed):
+    """Returns the seconds taken, the retries and the failed checkouts"""
+    policy = be.RetryPolicy(attempts=args.attempts)
+    catalogs = [be.Catalog(engine, retry=policy, reservation=strategy)
+                for i in range(args.threads)]
+    rnd = random.Random(seed)
+    baskets = []
+    for catalog in catalogs:
+        baskets.append([])
+        for i in range(args.baskets):
+            basket = catalog.create_basket(str(uuid.uuid4()))
+            basket.add_items([(code, rnd.randint(1, 3))
+                              for code in rnd.sample(codes, args.lines)])
+            baskets[-1].append(basket)
+
+    failed = [0] * args.threads
+    start = threading.Barrier(args.threads + 1)
+
+    def work(i):
+        catalog = catalogs[i]
+        start.wait()
+        for basket in baskets[i]:
+            try:
+                if mode == 'checkout':
+                    basket.checkout()
+                else:
+                    catalog.transaction(row_by_row, basket)
+            except Exception as exc:
+                if not be.is_retryable(exc):
+                    raise
+                failed[i] += 1
+
+    threads = [threading.Thread(target=work, args=(i,))
+               for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    start.wait()
+    began = time.perf_counter()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - began
+
+    retries = 0
+    for catalog in catalogs:
+        retries += sum(x['retries'] for x in catalog.retry_stats().values())
+        catalog.close()
+    return seconds, retries, sum(failed)
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0], items=1000)
+    parser.set_defaults(repeat=3)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='concurrent checkouts')
+    parser.add_argument('--baskets', type=int, default=50,
+                        help='baskets checked out by each thread')
+    parser.add_argument('--lines', type=int, default=5,
+                        help='items in each basket')
+    parser.add_argument('--hot', type=int, default=20,
+                        help='number of items the baskets pick from')
+    parser.add_argument('--attempts', type=int, default=5,
+                        help='attempts of each checkout')
+    args = parser.parse_args()
+
+    # a connection for each thread, the pool is not what is measured
+    engine = common.connect(args, pool={'pool_size': args.threads})
+    items = common.make_items(args.items, args.seed)
+    common.create_catalog(engine, items)
+
+    # enough stock for all runs of the three cases, every basket gets
+    # all it wants, at most three units of an item
+    codes = [x['code'] for x in items[:args.hot]]
+    catalog = be.Catalog(engine)
+    stock = 3 * 3 * args.threads * args.baskets * args.repeat
+    catalog.update_stocks([(code, stock, 10.0) for code in codes],
+                          mode='absolute')
+    catalog.session.commit()
+    catalog.close()
+
+    rows = []
+    total = args.threads * args.baskets
+    for mode, strategy in [('row by row', 'serializable'),
+                           ('checkout', 'serializable'),
+                           ('checkout', 'locking')]:
+        times = []
+        retries = failed = 0
+        for i in range(args.repeat):
+            seconds, r, f = run(engine, mode, strategy, codes, args,
+                                args.seed + i)
+            times.append(seconds)
+            retries += r
+            failed += f
+        timing = common.timing(times)
+        notes = '{:.0f} checkouts/s, {:.2f} retries/checkout, ' \
+          '{:.1f} % failed'.format(total / timing['median'],
+                                   retries / (total * args.repeat),
+                                   100.0 * failed / (total * args.repeat))
+        rows.append(('{:s}, {:s}'.format(mode, strategy), timing, notes))
+
+    common.report('{:d} checkouts of {:d} lines, {:d} threads'.format(
+        total, args.lines, args.threads), rows, args, engine)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# coding: utf8
+#
+
+"""Synthetic catalogs and baskets, database setup, timing and results
+shared by the benchmarks
+
+The benchmarks drop and create the tables of the database they are
+given, do not point them at a database with data you want to keep.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import bisect
+import datetime
+import decimal
+import itertools
+import json
+import platform
+import random
+import statistics
+import time
+
+import sqlalchemy as sqla
+from sqlalchemy import event
+
+from putiikki import be, models
+
+WORDS = ['aji', 'cristal', 'lemon', 'drop', 'habanero', 'naga', 'morich',
+         'bhut', 'jolokia', 'padron', 'pimientos', 'cayenne', 'jalapeno',
+         'serrano', 'poblano', 'chipotle', 'scotch', 'bonnet', 'carolina',
+         'reaper', 'trinidad', 'scorpion', 'red', 'yellow', 'orange',
+         'chocolate', 'peach', 'white', 'giant', 'dwarf', 'sweet', 'hot',
+         'smoked', 'dried', 'fresh', 'organic', 'powder', 'sauce', 'flakes',
+         'plant', 'seeds', 'pack', 'siemenpussi', 'siementä', 'kuivattu',
+         'jauhe', 'kastike', 'taimi']
+
+def make_items(count, seed=0, categories=20):
+    """count catalog items in the format of Catalog.add_items_with_stock.
+
+    The same seed gives the same items.
+    """
+    rnd = random.Random(seed)
+    names = ['Category {:d}'.format(i) for i in range(categories)]
+    items = []
+    for i in range(count):
+        words = rnd.sample(WORDS, rnd.randint(2, 4))
+        size = rnd.choice([5, 10, 20, 50])
+        description = '{:s} {:d}'.format(' '.join(words).capitalize(), size)
+        long_description = None
+        if rnd.random() < 0.5:
+            long_description = ' '.join(rnd.choice(WORDS)
+                                        for j in range(rnd.randint(10, 30)))
+        price = decimal.Decimal(rnd.randint(50, 5000)) / 100
+        items.append({'code': 'BENCH_{:08d}'.format(i),
+                      'description': description,
+                      'long description': long_description,
+                      'categories': rnd.sample(names, rnd.randint(1, 2)),
+                      'price': price,
+                      'count': rnd.randint(0, 100)})
+    return items
+
+def make_baskets(codes, count, seed=0, lines=5, units=3):
+    """count baskets as lists of (code, count) pairs, for Basket.add_items.
+
+    Each basket has 1 to lines items of 1 to units units.  The first
+    codes are picked more often than the last ones, as popular items
+    are, so the stock of those is short.  The same seed gives the same
+    baskets.
+    """
+    rnd = random.Random(seed)
+    # the cumulative weights 1/1, 1/2, ... for a weighted pick, as
+    # random.choices of Python 3.6 does it
+    weights = list(itertools.accumulate(1.0 / (i + 1)
+                                        for i in range(len(codes))))
+    baskets = []
+    for i in range(count):
+        picked = set()
+        wanted = min(rnd.randint(1, lines), len(codes))
+        while len(picked) < wanted:
+            picked.add(codes[bisect.bisect(weights,
+                                           rnd.random() * weights[-1])])
+        baskets.append([(code, rnd.randint(1, units))
+                        for code in sorted(picked)])
+    return baskets
+
+def argument_parser(description, items=100000):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--database', default='putiikki',
+                        help='database, its tables are recreated')
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--username', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--items', type=int, default=items,
+                        help='number of catalog items')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='timed runs of each case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='also write the results to this JSON file')
+    return parser
+
+def connect(args, pool=None):
+    """Engine of the database of args, pool as the DB_POOL settings"""
+    engine = {'drivername': 'postgresql', 'database': args.database}
+    for key in ('host', 'port', 'username', 'password'):
+        value = getattr(args, key)
+        if value is not None:
+            engine[key] = value
+    return be.db_connect({'DB_ENGINE': engine, 'DB_POOL': pool or {}})
+
+def create_catalog(engine, items, chunk_size=1000):
+    """Recreate the tables and load items, returns the load statistics"""
+    models.drop_tables(engine)
+    models.create_tables(engine)
+
+    catalog = be.Catalog(engine)
+    stats = catalog.bulk_add_items_with_stock(items, chunk_size)
+    catalog.session.commit()
+    catalog.close()
+
+    # planner statistics, as after autovacuum has caught up
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').\
+          execute('ANALYZE')
+    return stats
+
+def create_baskets(engine, baskets, chunk_size=1000):
+    """Load baskets of make_baskets, returns their session ids.
+
+    The baskets and basket items are inserted a chunk at a time, and
+    the stock is then reserved first come first served, in the order of
+    baskets.
+    """
+    catalog = be.Catalog(engine)
+    session = catalog.session
+    stock = dict(session.query(models.Item.code, models.StockItem.id).\
+                 join(models.StockItem))
+    now = datetime.datetime.utcnow()
+    basket_table = models.Basket.__table__
+    item_table = models.BasketItem.__table__
+
+    session_ids = ['bench-{:d}'.format(i) for i in range(len(baskets))]
+    for chunk in be.chunked(list(zip(session_ids, baskets)), chunk_size):
+        q = basket_table.insert().\
+          values([{'session': session_id, 'creation': now,
+                   'modification': now} for session_id, lines in chunk]).\
+          returning(basket_table.c.session, basket_table.c.id)
+        ids = dict(session.execute(q).fetchall())
+        session.execute(item_table.insert(),
+                        [{'basket_id': ids[session_id],
+                          'stock_item_id': stock[code], 'count': count,
+                          'creation': now, 'modification': now}
+                         for session_id, lines in chunk
+                         for code, count in lines])
+
+    codes = set(code for lines in baskets for code, count in lines)
+    catalog.rebalance_reservations(sorted(codes))
+    catalog.session.commit()
+    catalog.close()
+
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').\
+          execute('ANALYZE')
+    return session_ids
+
+class StatementCounter(object):
+    """Counts the statements executed through an engine"""
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._executed)
+
+    def _executed(self, conn, cursor, statement, parameters, context,
+                  executemany):
+        self.count += 1
+
+def timed(fun, repeat):
+    """Run fun repeat times, returns min, median and max seconds"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return timing(times)
+
+def timing(times):
+    """min, median and max of a list of seconds"""
+    return {'min': min(times), 'median': statistics.median(times),
+            'max': max(times)}
+
+def explain(session, q):
+    """EXPLAIN ANALYZE of a Query, returns the plan as a dict"""
+    compiled = q.statement.compile(dialect=session.bind.dialect)
+    res = session.connection().execute(
+        'EXPLAIN (ANALYZE, FORMAT JSON) ' + compiled.string, compiled.params)
+    return res.scalar()[0]['Plan']
+
+def plan_indexes(plan):
+    """Names of the indexes that a plan reads"""
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for sub in plan.get('Plans', []):
+        names.update(plan_indexes(sub))
+    return names
+
+def environment(engine):
+    """Versions of Python, SQLAlchemy and PostgreSQL, for the results"""
+    with engine.connect() as conn:
+        server = conn.execute('SHOW server_version').scalar()
+    return {'python': platform.python_version(),
+            'sqlalchemy': sqla.__version__, 'postgresql': server,
+            'machine': platform.machine(), 'system': platform.system()}
+
+def save_results(path, title, args, rows, engine=None):
+    """Write rows of report to path as JSON, with the arguments and the
+    environment of the run, for benchmarks.compare"""
+    settings = dict(vars(args))
+    settings.pop('password', None)
+    res = {'title': title, 'settings': settings,
+           'created': datetime.datetime.utcnow().isoformat(),
+           'environment': environment(engine) if engine is not None else {},
+           'results': dict((name, dict(timing, notes=notes))
+                           for name, timing, notes in rows)}
+    with open(path, 'w') as fp:
+        json.dump(res, fp, indent=2, sort_keys=True)
+
+def report(title, rows, args=None, engine=None):
+    """Print rows of (case, timing, notes) as a table, and save them with
+    save_results when args has an output file"""
+    print(title)
+    print('{:<40s} {:>10s} {:>10s} {:>10s}  {:s}'.format(
+        'case', 'min ms', 'median ms', 'max ms', 'notes'))
+    for name, timing, notes in rows:
+        print('{:<40s} {:>10.2f} {:>10.2f} {:>10.2f}  {:s}'.format(
+            name, timing['min'] * 1000, timing['median'] * 1000,
+            timing['max'] * 1000, notes))
+    if args is not None and args.output is not None:
+        save_results(args.output, title, args, rows, engine)
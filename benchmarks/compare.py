@@ -0,0 +1,97 @@
+# coding: utf8
+#
+
+"""Compare two benchmark results saved with --output
+
+    python3 -m benchmarks.compare base.json new.json --threshold 0.2
+
+Prints the median times of the cases of both runs and their ratio.  A
+case is a regression when its median is more than --threshold slower,
+or when it runs more statements.  The exit status is 1 when there are
+regressions.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+def compare(base, new, threshold):
+    """Rows of (case, base median, new median, ratio, notes) of the cases
+    of both results, and the names of the regressions"""
+    rows = []
+    regressions = []
+    for name in sorted(set(base) & set(new)):
+        old, cur = base[name], new[name]
+        ratio = cur['median'] / old['median'] if old['median'] > 0 else 1.0
+        notes = []
+        if ratio > 1 + threshold:
+            notes.append('slower')
+        elif ratio < 1 / (1 + threshold):
+            notes.append('faster')
+        statements = (old.get('statements'), cur.get('statements'))
+        if None not in statements and statements[0] != statements[1]:
+            notes.append('{:d} -> {:d} statements'.format(*statements))
+        if 'slower' in notes or (None not in statements and
+                                 statements[1] > statements[0]):
+            regressions.append(name)
+        rows.append((name, old['median'], cur['median'], ratio,
+                     ', '.join(notes)))
+    return rows, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base', help='results of the baseline run')
+    parser.add_argument('new', help='results of the run compared to it')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown of a median counted as a regression')
+    args = parser.parse_args()
+
+    base, new = load(args.base), load(args.new)
+    if base['title'] != new['title']:
+        print('Warning: comparing {!r} to {!r}'.format(base['title'],
+                                                       new['title']))
+    for key in sorted(set(base['settings']) | set(new['settings'])):
+        if base['settings'].get(key) != new['settings'].get(key) and \
+          key != 'output':
+            print('Warning: {:s} {!r} -> {!r}'.format(
+                key, base['settings'].get(key), new['settings'].get(key)))
+
+    rows, regressions = compare(base['results'], new['results'],
+                                args.threshold)
+    print(new['title'])
+    print('{:<40s} {:>10s} {:>10s} {:>7s}  {:s}'.format(
+        'case', 'base ms', 'new ms', 'ratio', 'notes'))
+    for name, old, cur, ratio, notes in rows:
+        print('{:<40s} {:>10.2f} {:>10.2f} {:>7.2f}  {:s}'.format(
+            name, old * 1000, cur * 1000, ratio, notes))
+    for name in sorted(set(base['results']) ^ set(new['results'])):
+        print('{:<40s} only in {:s}'.format(
+            name, args.base if name in base['results'] else args.new))
+
+    if len(regressions) > 0:
+        print('{:d} regressions: {:s}'.format(len(regressions),
+                                              ', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# coding: utf8
+#
+
+"""Export benchmark: the whole catalog as JSON Lines and CSV
+
+    python3 -m benchmarks.export --items 1000000
+
+Prints the throughput of each format and the peak of memory allocated
+by Python during an export, which should not depend on --items.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import tracemalloc
+
+from putiikki import be
+
+from . import common
+
+class CountingFile(object):
+    """Text file that only counts what is written"""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0], items=1000000)
+    parser.set_defaults(repeat=3)
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='rows fetched from the cursor at a time')
+    args = parser.parse_args()
+
+    engine = common.connect(args)
+    common.create_catalog(engine, common.make_items(args.items, args.seed))
+
+    catalog = be.Catalog(engine)
+    rows = []
+    for format in ('jsonl', 'csv'):
+        fp = CountingFile()
+        timing = common.timed(
+            lambda: catalog.export(fp, format, args.batch_size), args.repeat)
+        catalog.session.rollback()
+
+        tracemalloc.start()
+        catalog.export(CountingFile(), format, args.batch_size)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        catalog.session.rollback()
+
+        notes = '{:.0f} items/s, {:.1f} MB/s, peak {:.1f} MB allocated'.format(
+            args.items / timing['median'],
+            fp.size / args.repeat / timing['median'] / 1e6, peak / 1e6)
+        rows.append(('export {:s}'.format(format), timing, notes))
+    catalog.close()
+
+    common.report('export, {:d} items'.format(args.items), rows, args,
+                  engine)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# coding: utf8
+#
+
+"""Hot query benchmark: per call cost of the point lookups and listings
+
+    python3 -m benchmarks.queries --items 10000 --repeat 500
+
+Each case is run with the query built for every call, as a baked query
+and as a server side prepared statement.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from putiikki import be
+
+from . import common
+
+CODE = 'BENCH_00000042'
+PRICES = (0.0, 100.0)
+
+def rebuilt_cases(session, basket_id, stock_id):
+    """The queries as they were run before baking, built every call"""
+    def item():
+        return be.item_query(CODE).with_session(session).first()
+
+    def stock():
+        return be.stock_query(CODE).with_session(session).first()
+
+    def page(q):
+        keys = be.sort_keys('description', True)
+        rows = be.page_query(q, keys, 1, 10, None).with_session(session).all()
+        return [be.item_to_json(*x) for x in rows]
+
+    return [('get_item', item),
+            ('get_stock', stock),
+            ('list_items', lambda: page(be.items_query())),
+            ('search_items', lambda: page(be.search_query('red', PRICES))),
+            ('Basket.get', lambda: be.basket_query('bench').
+             with_session(session).first()),
+            ('Basket.get_item', lambda: be.basket_item_query(
+                basket_id, stock_id).with_session(session).first())]
+
+def catalog_cases(catalog):
+    basket = be.Basket.get(catalog, 'bench')
+    stock_id = catalog.get_stock(CODE)[0]
+    return [('get_item', lambda: catalog.get_item(CODE)),
+            ('get_stock', lambda: catalog.get_stock(CODE)),
+            ('list_items', lambda: catalog.list_items()),
+            ('search_items', lambda: catalog.search_items('red', PRICES)),
+            ('Basket.get', lambda: be.Basket.get(catalog, 'bench')),
+            ('Basket.get_item', lambda: basket.get_item(stock_id))]
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0], items=10000)
+    parser.set_defaults(repeat=500)
+    args = parser.parse_args()
+
+    engine = common.connect(args)
+    common.create_catalog(engine, common.make_items(args.items, args.seed))
+
+    catalog = be.Catalog(engine)
+    basket = be.Basket.create(catalog, 'bench')
+    basket.add_item(CODE, 1)
+    catalog.session.commit()
+
+    stock_id = catalog.get_stock(CODE)[0]
+    modes = [('rebuilt', rebuilt_cases(catalog.session, basket.id, stock_id)),
+             ('baked', catalog_cases(catalog))]
+    prepared = be.Catalog(engine, prepared=True)
+    modes.append(('prepared', catalog_cases(prepared)))
+
+    rows = []
+    for mode, cases in modes:
+        for name, fun in cases:
+            # the first call builds, compiles and prepares
+            fun()
+            rows.append(('{:s} {:s}'.format(name, mode),
+                         common.timed(fun, args.repeat), ''))
+    catalog.session.rollback()
+    catalog.close()
+    prepared.session.rollback()
+    prepared.close()
+
+    rows.sort(key=lambda x: x[0])
+    common.report('hot queries, {:d} items'.format(args.items), rows,
+                  args, engine)
+
+if __name__ == '__main__':
+    main()
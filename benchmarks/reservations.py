@@ -0,0 +1,125 @@
+# coding: utf8
+#
+
+"""Reservation benchmark: concurrent baskets reserving one hot item
+
+    python3 -m benchmarks.reservations --threads 8 --operations 200
+
+Each thread has a basket of its own with a unit of the same item, and
+alternately adds a unit and sets the count back to one.  Every operation is a transaction, retried
+after serialization failures and deadlocks as --attempts allows.  Both
+reservation strategies of Catalog are run, the results are the
+throughput, the retries per operation and the operations that failed
+after all of their attempts.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+import uuid
+
+from putiikki import be
+
+from . import common
+
+CODE = 'BENCH_00000042'
+
+def run(engine, strategy, args):
+    """Returns the seconds taken, the retries and the failed operations"""
+    policy = be.RetryPolicy(attempts=args.attempts)
+    catalogs = [be.Catalog(engine, retry=policy, reservation=strategy)
+                for i in range(args.threads)]
+    baskets = [c.create_basket(str(uuid.uuid4())) for c in catalogs]
+    for basket in baskets:
+        basket.add_item(CODE, 1)
+    failed = [0] * args.threads
+    start = threading.Barrier(args.threads + 1)
+
+    def work(i):
+        start.wait()
+        for j in range(args.operations):
+            try:
+                if j % 2 == 0:
+                    baskets[i].add_item(CODE, 1)
+                else:
+                    baskets[i].update_item_count(CODE, 1)
+            except Exception as exc:
+                if not be.is_retryable(exc):
+                    raise
+                failed[i] += 1
+
+    threads = [threading.Thread(target=work, args=(i,))
+               for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    start.wait()
+    began = time.perf_counter()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - began
+
+    retries = 0
+    for catalog in catalogs:
+        retries += sum(x['retries'] for x in catalog.retry_stats().values())
+        catalog.close()
+    return seconds, retries, sum(failed)
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0], items=1000)
+    parser.set_defaults(repeat=3)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='concurrent baskets')
+    parser.add_argument('--operations', type=int, default=200,
+                        help='operations of each basket')
+    parser.add_argument('--attempts', type=int, default=5,
+                        help='attempts of each operation')
+    args = parser.parse_args()
+
+    # a connection for each thread, the pool is not what is measured
+    engine = common.connect(args, pool={'pool_size': args.threads})
+    common.create_catalog(engine, common.make_items(args.items, args.seed))
+
+    # enough stock for everybody, failures come from the conflicts alone
+    catalog = be.Catalog(engine)
+    catalog.update_stocks([(CODE, args.threads * args.operations, 10.0)],
+                          mode='absolute')
+    catalog.session.commit()
+    catalog.close()
+
+    rows = []
+    total = args.threads * args.operations
+    for strategy in be.RESERVATION_STRATEGIES:
+        times = []
+        retries = failed = 0
+        for i in range(args.repeat):
+            seconds, r, f = run(engine, strategy, args)
+            times.append(seconds)
+            retries += r
+            failed += f
+        timing = common.timing(times)
+        notes = '{:.0f} ops/s, {:.2f} retries/op, {:.1f} % failed'.format(
+            total / timing['median'], retries / (total * args.repeat),
+            100.0 * failed / (total * args.repeat))
+        rows.append(('{:s}, {:d} threads'.format(strategy, args.threads),
+                     timing, notes))
+
+    common.report('reservations of one item, {:d} operations'.format(total),
+                  rows, args, engine)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# coding: utf8
+#
+
+"""Result format benchmark: a 500 item page listed and serialized to JSON
+
+    python3 -m benchmarks.results --items 10000
+
+The dict and row results are serialized with the options of jsonbe, the
+json result comes serialized from the database.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+
+from putiikki import be
+from putiikki.jsonbe import json_options
+
+from . import common
+
+PAGE_SIZE = 500
+
+def serialize(res):
+    return json.dumps(res, **json_options).encode('utf8')
+
+def cases(catalog):
+    prices = [('<', 10.0), ('range', 10.0, 30.0), ('>=', 30.0)]
+    listings = [('list_items', lambda **kw: catalog.list_items(
+                    'price', page_size=PAGE_SIZE, **kw)),
+                ('list_items_by_prices', lambda **kw:
+                 catalog.list_items_by_prices(prices, page_size=PAGE_SIZE,
+                                              **kw))]
+    res = []
+    for name, fun in listings:
+        res.append(('{:s} dict'.format(name),
+                    lambda fun=fun: fun(),
+                    lambda fun=fun: serialize(fun())))
+        res.append(('{:s} row'.format(name),
+                    lambda fun=fun: fun(result='row'),
+                    lambda fun=fun: serialize(
+                        [x._asdict() for x in fun(result='row')])))
+        res.append(('{:s} json'.format(name),
+                    lambda fun=fun: fun(result='json'),
+                    lambda fun=fun: fun(result='json')))
+    return res
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0], items=10000)
+    args = parser.parse_args()
+
+    engine = common.connect(args)
+    common.create_catalog(engine, common.make_items(args.items, args.seed))
+
+    catalog = be.Catalog(engine)
+    rows = []
+    for name, listed, serialized in cases(catalog):
+        listing = common.timed(listed, args.repeat)
+        total = common.timed(serialized, args.repeat)
+        rows.append((name + ' listed', listing, ''))
+        rows.append((name + ' serialized', total, '{:.0f} % serializing'.format(
+            100 * max(0.0, 1 - listing['median'] / total['median']))))
+    catalog.session.rollback()
+    catalog.close()
+
+    common.report('result formats, {:d} items'.format(args.items), rows,
+                  args, engine)
+
+if __name__ == '__main__':
+    main()
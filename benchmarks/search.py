@@ -0,0 +1,84 @@
+# coding: utf8
+#
+
+"""Search benchmark: prefix and full text searches on a large catalog
+
+    python3 -m benchmarks.search --items 100000
+
+Prints the timings of each case and the indexes its plan uses.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from putiikki import be
+
+from . import common
+
+PRICES = (0.0, 100.0)
+
+def cases(catalog):
+    """(name, function, query) of each case, query is for EXPLAIN"""
+    keys = be.sort_keys('description', True)
+    res = []
+    for prefix in ('habanero choc', 'lemon', 'a'):
+        q = be.page_query(be.search_query(prefix, PRICES), keys, 1, 20, None)
+        res.append(('search_items {!r}'.format(prefix),
+                    lambda prefix=prefix: catalog.search_items(
+                        prefix, PRICES, page_size=20),
+                    q))
+
+    for text in ('habanero chocolate', 'scorp', 'sauce 50'):
+        q, keys = be.text_search_query(text, None, 1, 20, '')
+        res.append(('search_text {!r}'.format(text),
+                    lambda text=text: catalog.search_text(
+                        text, page_size=20, cursor=''),
+                    q))
+
+    prices = [('<', 10.0), ('range', 10.0, 30.0), ('>=', 30.0)]
+    q, keys = be.price_groups_query(prices, 'red', True, 1, 20, None)
+    res.append(("list_items_by_prices 'red'",
+                lambda: catalog.list_items_by_prices(prices, prefix='red',
+                                                     page_size=20),
+                q))
+    return res
+
+def main():
+    parser = common.argument_parser(__doc__.splitlines()[0])
+    args = parser.parse_args()
+
+    engine = common.connect(args)
+    stats = common.create_catalog(engine, common.make_items(args.items,
+                                                            args.seed))
+    print('loaded {:d} items in {:.1f} s'.format(
+        stats['items']['rows'], sum(x['seconds'] for x in stats.values())))
+
+    catalog = be.Catalog(engine)
+    rows = []
+    for name, fun, q in cases(catalog):
+        plan = common.explain(catalog.session, q.with_session(catalog.session))
+        indexes = sorted(x for x in common.plan_indexes(plan)
+                         if x.startswith('ix_items'))
+        rows.append((name, common.timed(fun, args.repeat),
+                     ', '.join(indexes) or 'no item index'))
+        catalog.session.rollback()
+    catalog.close()
+
+    common.report('search, {:d} items'.format(args.items), rows, args,
+                  engine)
+
+if __name__ == '__main__':
+    main()
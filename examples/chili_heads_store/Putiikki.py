@@ -55,30 +55,35 @@ class PriceGroup(LadonType):
     b = { 'type': float, 'nullable': True, 'default': -1.0 }
     op = PORTABLE_STRING
 
+with open('settings.json', 'r') as fp:
+    settings = json.load(fp, encoding="UTF-8")
+
+# One engine and connection pool for all the services, each thread
+# borrows a session of its own for the duration of a request
+dbc = be.db_connect(settings)
+# models.drop_tables(dbc)
+# models.create_tables(dbc)
+catalog = be.Catalog(dbc, scoped=True,
+                     reservation=settings.get('RESERVATION', 'serializable'))
+
 class Catalog(object):
     def __init__(self):
-        with open('settings.json', 'r') as fp:
-            settings = json.load(fp, encoding="UTF-8")
-
-        self.dbc = be.db_connect(settings)
-        # models.drop_tables(self.dbc)
-        # models.create_tables(self.dbc)
-        self.catalog = be.Catalog(self.dbc)
+        self.catalog = catalog
 
     @ladonize(rtype=int)
     def _create(self):
-        with open('catalog.json', 'r', encoding="ISO-8859-1") as fp:
-            items = json.load(fp, encoding="ISO-8859-1")
-            print(items)
-        self.catalog.add_items_with_stock(items)
-        self.catalog.session.commit()
+        with open('catalog.json', 'r', encoding="ISO-8859-1") as fp, \
+          self.catalog.request():
+            self.catalog.import_items(fp, 'catalog.json')
         return 0
 
     @ladonize(PORTABLE_STRING, bool, int, int, rtype=[Item])
     def list_items(self,
                    sort_key=PORTABLE_STRING('description'), ascending=True,
                    page=1, page_size=10):
-        items = self.catalog.list_items(sort_key, ascending, page, page_size)
+        with self.catalog.request():
+            items = self.catalog.list_items(sort_key, ascending, page,
+                                            page_size)
         def dummy(x):
             nx = Item()
             nx.code = x['code']
@@ -96,8 +101,10 @@ class Catalog(object):
                      price_min=0.0, price_max=10000.0,
                      sort_key=PORTABLE_STRING('price'), ascending=True,
                      page=1, page_size=10):
-        items = self.catalog.search_items(prefix, (price_min, price_max),
-                                     sort_key, ascending, page, page_size)
+        with self.catalog.request():
+            items = self.catalog.search_items(prefix, (price_min, price_max),
+                                              sort_key, ascending, page,
+                                              page_size)
         def dummy(x):
             nx = Item()
             nx.code = x['code']
@@ -115,8 +122,10 @@ class Catalog(object):
                          sort_key='price', prefix=PORTABLE_STRING(''),
                          ascending=True, page=1, page_size=50):
         pgs = [(pg.op, pg.a, pg.b) for pg in prices]
-        items = self.catalog.list_items_by_prices(pgs, sort_key, prefix,
-                                             ascending, page, page_size)
+        with self.catalog.request():
+            items = self.catalog.list_items_by_prices(pgs, sort_key, prefix,
+                                                      ascending, page,
+                                                      page_size)
         def dummy(x):
             nx = GroupedItem()
             nx.group = x['price_group']
@@ -131,49 +140,44 @@ class Catalog(object):
 
 class Basket(object):
     def __init__(self):
-        with open('settings.json', 'r') as fp:
-            settings = json.load(fp, encoding="UTF-8")
-
-        self.dbc = be.db_connect(settings)
-        # models.drop_tables(self.dbc)
-        # models.create_tables(self.dbc)
-        self.catalog = be.Catalog(self.dbc)
+        self.catalog = catalog
 
     @ladonize(PORTABLE_STRING, rtype=int)
     def create_basket(self, session_id):
-        basket = be.Basket.create(self.catalog, session_id)
-        self.catalog.session.commit()
+        with self.catalog.request():
+            be.Basket.create(self.catalog, session_id)
         return 0
 
     @ladonize(PORTABLE_STRING, rtype=int)
     def _stuff_basket(self, session_id):
-        basket = be.Basket.get(self.catalog, session_id)
-        basket.add_item('SIEMENP_CAPBACC_LEMONDROP5', 16)
-        basket.add_item('SIEMENP_CAPBACC_LEMONDROP20', 1)
-        basket.add_item('SIEMENP_CAPBACC_LEMONDROP20', 1)
-        self.catalog.session.commit()
+        with self.catalog.request():
+            basket = be.Basket.get(self.catalog, session_id)
+            basket.add_item('SIEMENP_CAPBACC_LEMONDROP5', 16)
+            basket.add_item('SIEMENP_CAPBACC_LEMONDROP20', 1)
+            basket.add_item('SIEMENP_CAPBACC_LEMONDROP20', 1)
 
         return 0
 
     @ladonize(PORTABLE_STRING, PORTABLE_STRING, int, rtype=int)
     def add_item(self, session_id, code, count):
-        basket = be.Basket.get(self.catalog, session_id)
-        basket.add_item(code, count)
-        self.catalog.session.commit()
+        with self.catalog.request():
+            basket = be.Basket.get(self.catalog, session_id)
+            basket.add_item(code, count)
 
         return 0
 
     @ladonize(PORTABLE_STRING, PORTABLE_STRING, bool, rtype=[BasketItem])
     def list_items(self, session_id, sort_key='description', ascending=True):
-        basket = be.Basket.get(self.catalog, session_id)
-        if basket is None:
-            raise ClientFault('basket not found', detail=session_id)
-
-        try:
-            items = basket.list_items(sort_key, ascending)
-        except ValueError as ex:
-            raise ClientFault(str(ex), hint='invalid sort key',
-                              detail=sort_key)
+        with self.catalog.request():
+            basket = be.Basket.get(self.catalog, session_id)
+            if basket is None:
+                raise ClientFault('basket not found', detail=session_id)
+
+            try:
+                items = basket.list_items(sort_key, ascending)
+            except ValueError as ex:
+                raise ClientFault(str(ex), hint='invalid sort key',
+                                  detail=sort_key)
 
         def dummy(x):
             nx = BasketItem()
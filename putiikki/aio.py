@@ -0,0 +1,510 @@
+# coding: utf8
+#
+
+"""asyncio counterparts of the Catalog and Basket of be, on asyncpg
+
+The statements are the ones that be builds with SQLAlchemy, compiled
+for PostgreSQL with asyncpg's $n parameters, so both work on the same
+database.  Every method is a coroutine that returns what the method of
+the same name in be returns.  Requires Python 3.5 or later and asyncpg.
+
+These methods of be are not available here:
+
+ - Catalog.add_item, add_items, add_items_with_stock,
+   bulk_add_items_with_stock, add_category, add_categories,
+   add_item_category, add_stock, import_items, update_stocks,
+   rebalance_reservations, check_reservations, expire_baskets and
+   export, loading and maintenance are left to be
+ - Catalog.refresh_typeahead, typeahead() always queries the database
+ - Catalog.request, close and result_cache_stats, there are no sessions
+   and no result cache
+ - Basket.get_item, which returns an ORM object
+
+Listings return dicts only, the result= formats and the as_object=
+options of get_item and get_stock are not supported.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import datetime
+import functools
+
+import asyncpg
+import sqlalchemy as sqla
+
+from . import be, cache, models
+from .statements import compile_statement, statement_args
+
+__all__ = ['connect', 'Catalog', 'Basket']
+
+async def fetch(conn, stmt, params=None):
+    compiled = compile_statement(stmt)
+    return [tuple(x) for x in await conn.fetch(
+        compiled.string, *statement_args(compiled, params))]
+
+async def execute(conn, stmt, params=None):
+    compiled = compile_statement(stmt)
+    await conn.execute(compiled.string, *statement_args(compiled, params))
+
+async def update_totals(conn, basket_ids):
+    if len(basket_ids) > 0:
+        await execute(conn, be._basket_totals_sql['baskets'],
+                      {'ids': list(basket_ids)})
+
+async def connect(settings):
+    """Create an asyncpg connection pool from the settings of db_connect.
+
+    Of the DB_POOL options pool_size is the number of connections kept
+    open and max_overflow the number of connections opened on top of
+    them.  The other options have no counterpart in asyncpg.
+    """
+    engine = settings['DB_ENGINE']
+    pool = settings.get('DB_POOL', {})
+    for key in pool:
+        if key not in be.POOL_OPTIONS:
+            raise ValueError("Unknown pool option {:s}".format(key))
+
+    params = {'database': engine.get('database'),
+              'user': engine.get('username'),
+              'password': engine.get('password'),
+              'host': engine.get('host'), 'port': engine.get('port')}
+    params = dict((k, v) for k, v in params.items() if v is not None)
+
+    size = pool.get('pool_size', 5)
+    return await asyncpg.create_pool(
+        min_size=size, max_size=size + pool.get('max_overflow', 10),
+        server_settings={'default_transaction_isolation': 'serializable'},
+        **params)
+
+def is_retryable(exc):
+    return getattr(exc, 'sqlstate', None) in be.RETRYABLE_ERRORS
+
+def transactional(fun):
+    """Run the method as a transaction of its own.
+
+    The method gets a connection as its first argument after self, it
+    is not passed by the caller.
+    """
+    @functools.wraps(fun)
+    async def new_fun(self, *args, **kw):
+        catalog = getattr(self, 'catalog', self)
+        return await catalog._transaction(
+            fun.__qualname__, lambda conn: fun(self, conn, *args, **kw))
+
+    return new_fun
+
+class Catalog(object):
+    def __init__(self, pool, cache_size=0, cache_ttl=60.0, retry=None):
+        """pool is from connect(), the caller closes it.
+
+        cache_size and retry are as in be.Catalog.  Concurrent calls
+        run on connections of their own.
+        """
+        self.pool = pool
+        self.retry = retry
+        self._retry_stats = {}
+
+        self.item_cache = None
+        self.item_version = 0
+        self._invalidations = {}
+        if cache_size > 0:
+            self.item_cache = cache.LRUCache(cache_size, cache_ttl)
+
+    def cache_stats(self):
+        if self.item_cache is None:
+            return None
+        return self.item_cache.stats()
+
+    def retry_stats(self):
+        """Retries and final failures of transactions by unit of work"""
+        return dict((k, dict(v)) for k, v in self._retry_stats.items())
+
+    def _invalidate(self, conn, codes):
+        # dropped when the transaction of conn ends, other coroutines
+        # may cache the committed rows until then
+        if self.item_cache is not None:
+            self._invalidations[conn].update(codes)
+
+    def _drop(self, codes):
+        self.item_version += 1
+        for code in codes:
+            self.item_cache.invalidate(('item', code))
+            self.item_cache.invalidate(('stock', code))
+
+    async def transaction(self, fun, *args, **kw):
+        """Run await fun(conn, *args, **kw) as a transaction of its own.
+
+        Serialization failures and deadlocks are retried as in
+        be.Catalog.transaction, but the backoff is an asyncio.sleep.
+        """
+        name = getattr(fun, '__qualname__', fun.__name__)
+        return await self._transaction(name,
+                                       lambda conn: fun(conn, *args, **kw))
+
+    async def _transaction(self, name, fun):
+        policy = self.retry
+        if policy is None:
+            policy = be.RetryPolicy(attempts=1)
+
+        attempt = 1
+        while True:
+            try:
+                async with self.pool.acquire() as conn:
+                    self._invalidations[conn] = set()
+                    try:
+                        async with conn.transaction(
+                                isolation='serializable'):
+                            return await fun(conn)
+                    finally:
+                        codes = self._invalidations.pop(conn)
+                        if len(codes) > 0:
+                            self._drop(codes)
+            except Exception as exc:
+                if not is_retryable(exc):
+                    raise exc
+
+                failed = attempt >= policy.attempts
+                stats = self._retry_stats.setdefault(
+                    name, {'retries': 0, 'failures': 0})
+                if failed:
+                    stats['failures'] += 1
+                    raise exc
+                stats['retries'] += 1
+                if policy.on_retry is not None:
+                    policy.on_retry(name, attempt, exc)
+
+            await asyncio.sleep(policy.backoff(attempt))
+            attempt += 1
+
+    async def _fetch(self, stmt, params=None):
+        async with self.pool.acquire() as conn:
+            return await fetch(conn, stmt, params)
+
+    async def create_basket(self, session_id):
+        return await Basket.create(self, session_id)
+
+    async def get_basket(self, session_id):
+        return await Basket.get(self, session_id)
+
+    async def get_item(self, code):
+        if self.item_cache is not None:
+            res = self.item_cache.get(('item', code))
+            if res is not None:
+                return res
+
+        # a concurrent commit of changes makes the row stale
+        version = self.item_version
+        rows = await self._fetch(be.item_query(code).\
+          with_entities(models.Item.id, models.Item.code,
+                        models.Item.description,
+                        models.Item.long_description))
+        if len(rows) == 0:
+            return None
+
+        res = rows[0]
+        if self.item_cache is not None and version == self.item_version:
+            self.item_cache.put(('item', code), res)
+        return res
+
+    async def get_stock(self, code):
+        if self.item_cache is not None:
+            res = self.item_cache.get(('stock', code))
+            if res is not None:
+                return res
+
+        version = self.item_version
+        rows = await self._fetch(be.stock_query(code).\
+          with_entities(models.StockItem.id, models.StockItem.price,
+                        models.StockItem.count))
+        if len(rows) == 0:
+            return None
+
+        res = rows[0]
+        if self.item_cache is not None and version == self.item_version:
+            self.item_cache.put(('stock', code), res)
+        return res
+
+    @transactional
+    async def remove_item(self, conn, code):
+        self._invalidate(conn, [code])
+        table = models.Item.__table__
+        await execute(conn, table.delete().where(table.c.code == code))
+
+    @transactional
+    async def update_item(self, conn, code, description=None,
+                          long_description=None, new_code=None):
+        self._invalidate(conn, [code, new_code])
+        values = {}
+        if new_code is not None:
+            values['code'] = new_code
+
+        if description is not None:
+            values['description'] = description
+            values['description_lower'] = description.lower()
+
+        if long_description is not None:
+            values['long_description'] = long_description
+
+        table = models.Item.__table__
+        if description is not None or long_description is not None:
+            # SET sees the old values of the columns
+            values['document'] = models.item_document(
+                table.c.description if description is None else \
+                sqla.cast(sqla.literal(description), sqla.TEXT),
+                table.c.long_description if long_description is None else \
+                sqla.cast(sqla.literal(long_description), sqla.TEXT))
+
+        if len(values) > 0:
+            await execute(conn, table.update().\
+                          where(table.c.code == code).values(values))
+
+    @transactional
+    async def update_stock(self, conn, code, count, price):
+        self._invalidate(conn, [code])
+        rows = await fetch(conn, be.stock_query(code).\
+                           with_entities(models.StockItem.id))
+        table = models.StockItem.__table__
+        now = datetime.datetime.utcnow()
+        if len(rows) > 0:
+            q = table.update().where(table.c.id == rows[0][0]).\
+              values(count=table.c.count + count, price=price,
+                     modification=now)
+            await execute(conn, q)
+            changed = await fetch(conn, be._rebalance_sql,
+                                  {'ids': [rows[0][0]], 'now': now})
+            # the price may have changed
+            await execute(conn, be._basket_totals_sql['stock'],
+                          {'ids': [rows[0][0]]})
+            await update_totals(conn, changed[0][1])
+            return
+
+        rows = await fetch(conn, be.item_query(code).\
+                           with_entities(models.Item.id))
+        if len(rows) == 0:
+            raise KeyError('Unknown item code')
+
+        q = table.insert().values(item_id=rows[0][0], count=count,
+                                  reserved=0, price=price, visible=True,
+                                  modification=now)
+        await execute(conn, q)
+
+    async def typeahead(self, prefix, limit=10):
+        """See be.Catalog.typeahead, without the in-memory index"""
+        rows = await self._fetch(
+            sqla.select([models.Item.code, models.Item.description]).\
+            where(be.prefix_filter(prefix)).\
+            order_by(models.Item.description_lower, models.Item.code).\
+            limit(limit))
+        return [{'code': x[0], 'description': x[1]} for x in rows]
+
+    async def list_items(self, sort_key='description',
+                         ascending=True, page=1, page_size=10, cursor=None):
+        return await self._item_page(be.items_query(), sort_key, ascending,
+                                     page, page_size, cursor)
+
+    async def _item_page(self, q, sort_key, ascending, page, page_size,
+                         cursor):
+        keys = be.sort_keys(sort_key, ascending)
+        q = be.page_query(q, keys, page, page_size, cursor)
+        rows = await self._fetch(q)
+        return be.page_result(rows, keys, page_size, cursor,
+                              lambda x: be.item_to_json(*x))
+
+    async def search_items(self, prefix, price_range, sort_key='description',
+                           ascending=True, page=1, page_size=10,
+                           cursor=None):
+        return await self._item_page(be.search_query(prefix, price_range),
+                                     sort_key, ascending, page, page_size,
+                                     cursor)
+
+    async def list_items_by_category(self, category, sort_key='description',
+                                     ascending=True, price_range=None,
+                                     prefix=None, page=1, page_size=10,
+                                     cursor=None):
+        return await self._item_page(
+            be.category_query(category, price_range, prefix), sort_key,
+            ascending, page, page_size, cursor)
+
+    async def search_text(self, text, price_range=None, page=1,
+                          page_size=10, cursor=None):
+        q, keys = be.text_search_query(text, price_range, page, page_size,
+                                       cursor)
+        rows = await self._fetch(q)
+        return be.page_result(rows, keys, page_size, cursor,
+                              lambda x: be.item_to_json(*x))
+
+    async def list_items_by_prices(self, prices, sort_key='price',
+                                   prefix=None, ascending=True, page=1,
+                                   page_size=10, cursor=None):
+        q, keys = be.price_groups_query(prices, prefix, ascending, page,
+                                        page_size, cursor)
+        rows = await self._fetch(q)
+        return be.page_result(rows, keys, page_size, cursor,
+                              be.price_group_to_json)
+
+    async def facets_by_prices(self, prices, prefix=None):
+        rows = await self._fetch(be.facets_query(prices, prefix))
+        return be.facets_result(prices, rows)
+
+class Basket(object):
+    def __init__(self, catalog, basket_id):
+        self.catalog = catalog
+        self.id = basket_id
+
+    @staticmethod
+    async def get(catalog, basket_id):
+        rows = await catalog._fetch(be.basket_query(basket_id))
+        if len(rows) == 0:
+            return None
+
+        return Basket(catalog, rows[0][0])
+
+    @staticmethod
+    async def create(catalog, basket_id):
+        basket = Basket(catalog, None)
+        await basket._create(basket_id)
+        return basket
+
+    @transactional
+    async def _create(self, conn, session_id):
+        table = models.Basket.__table__
+        now = datetime.datetime.utcnow()
+        q = table.insert().values(session=session_id, creation=now,
+                                  modification=now, lines=0, units=0,
+                                  value=0, reserved_value=0).\
+          returning(table.c.id)
+        rows = await fetch(conn, q)
+        self.id = rows[0][0]
+
+    @transactional
+    async def add_item(self, conn, code, count):
+        rows = await fetch(conn, be._add_item_sql['serializable'],
+                           {'code': code, 'count': count,
+                            'basket_id': self.id,
+                            'now': datetime.datetime.utcnow()})
+        if len(rows) == 0:
+            rows = await fetch(conn, be.item_query(code).\
+                               with_entities(models.Item.id))
+            if len(rows) == 0:
+                raise ValueError('Unknown code')
+            raise ValueError('Not in stock')
+        await update_totals(conn, [self.id])
+
+    @transactional
+    async def add_items(self, conn, lines):
+        """See be.Basket.add_items"""
+        return await self._apply_items(conn, lines, relative=True)
+
+    @transactional
+    async def set_items(self, conn, lines):
+        """See be.Basket.set_items"""
+        return await self._apply_items(conn, lines, relative=False)
+
+    async def _apply_items(self, conn, lines, relative):
+        counts = be.line_counts(lines, relative)
+        if len(counts) == 0:
+            return []
+
+        rows = await fetch(conn, be.basket_lines_query(self.id, counts))
+        results = await self._apply_lines(conn, counts,
+                                          dict((x[0], x[1:]) for x in rows),
+                                          relative)
+        return [dict(results[code]) for code, count in lines]
+
+    async def _apply_lines(self, conn, counts, found, relative):
+        results, upserts, removed, deltas = be.plan_basket_lines(
+            counts, found, relative)
+
+        now = datetime.datetime.utcnow()
+        await execute(conn, be.touch_basket(self.id, now))
+        if len(upserts) > 0:
+            rows = await fetch(conn, be.upsert_basket_items(self.id, upserts,
+                                                            now))
+            await execute(conn, be.upsert_reservations(upserts, dict(rows),
+                                                       now))
+
+        if len(removed) > 0:
+            await execute(conn, be.delete_basket_items(removed))
+
+        if len(deltas) > 0:
+            await execute(conn, be.update_reserved(deltas))
+
+        await update_totals(conn, [self.id])
+        return results
+
+    @transactional
+    async def update_item_count(self, conn, code, count):
+        rows = await fetch(conn, be.basket_lines_query(self.id, [code]))
+        if len(rows) == 0:
+            raise ValueError('Unknown item code')
+
+        found = rows[0][1:]
+        if found[0] is None:
+            raise ValueError('Item {:s} not in stock'.format(code))
+        if found[3] is None:
+            raise ValueError('Item {:s} not in basket'.format(code))
+
+        await self._apply_lines(conn, {code: count}, {code: found},
+                                relative=False)
+
+    async def remove_item(self, code):
+        return await self.update_item_count(code, 0)
+
+    @transactional
+    async def delete(self, conn):
+        await execute(conn, be.release_baskets([self.id]))
+        await execute(conn, be.delete_baskets([self.id]))
+
+    @transactional
+    async def checkout(self, conn):
+        """See be.Basket.checkout"""
+        res = be.checkout_result(await fetch(
+            conn, be._checkout_sql,
+            {'basket_id': self.id, 'now': datetime.datetime.utcnow()}))
+        await update_totals(conn, [self.id])
+        self.catalog._invalidate(conn, [x['code'] for x in
+                                        res['lines']])
+        return res
+
+    async def get_total(self, prices=None):
+        """See be.Basket.get_total"""
+        rows = await self.catalog._fetch(be.basket_total_query(self.id))
+        if len(rows) == 0:
+            return None
+        if prices is None:
+            return be.basket_total_to_json(rows[0])
+
+        groups = await self.catalog._fetch(
+            be.basket_totals_query(self.id, prices))
+        return be.basket_totals_result(prices, rows[0], groups)
+
+    async def list_items(self, sort_key='description', ascending=True):
+        rows = await self.catalog._fetch(
+            be.basket_items_query(self.id, sort_key, ascending))
+        return [be.basket_item_to_json(x) for x in rows]
+
+    async def list_items_by_prices(self, prices, sort_key='price',
+                                   prefix=None, ascending=True):
+        rows = await self.catalog._fetch(
+            be.basket_price_groups_query(self.id, prices, ascending))
+        return [be.basket_price_group_to_json(x) for x in rows]
+
+    async def dump(self, fp):
+        items = await self.list_items()
+        for x in items:
+            fp.write(repr(x) + "\n")
@@ -19,35 +19,86 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import base64
+import collections
+import contextlib
+import csv
+import datetime
+import decimal
+import functools
+import json
+import random
+import re
+import threading
+import time
+
 import sqlalchemy as sqla
 
+from sqlalchemy import event
+from sqlalchemy.ext import baked
 from sqlalchemy.sql import func
+from sqlalchemy.dialects import postgresql
 
+from sqlalchemy.orm import Query, scoped_session, sessionmaker
 from sqlalchemy.orm.session import Session
 from sqlalchemy.engine.url import URL
 
-from . import models
+from . import cache, jsonstream, models
+from .statements import PreparedStatements
+from .typeahead import TypeaheadIndex
+
+__all__ = ['db_connect', 'pool_status', 'Catalog', 'Basket', 'RetryPolicy',
+           'ItemRow', 'PriceGroupRow']
+
+RESERVATION_STRATEGIES = ('serializable', 'locking')
 
-__all__ = ['db_connect', 'Catalog', 'Basket']
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle',
+                'pool_pre_ping')
 
 def db_connect(settings):
-    return sqla.create_engine(URL(**settings['DB_ENGINE']),
-                              isolation_level='SERIALIZABLE')
+    """Create an engine from settings['DB_ENGINE'] URL parts.
 
-def ordering(q, ascending, sort_key):
-    if ascending:
-        order = sqla.asc
-    else:
-        order = sqla.desc
+    Connection pool options, one of POOL_OPTIONS, are taken from the
+    optional settings['DB_POOL'] dict.
+    """
+    pool = settings.get('DB_POOL', {})
+    for key in pool:
+        if key not in POOL_OPTIONS:
+            raise ValueError("Unknown pool option {:s}".format(key))
 
+    return sqla.create_engine(URL(**settings['DB_ENGINE']),
+                              isolation_level='SERIALIZABLE', **pool)
+
+def pool_status(engine):
+    """Usage of the connection pool of engine"""
+    pool = engine.pool
+    res = {'status': pool.status()}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        fun = getattr(pool, name, None)
+        if fun is not None:
+            res[name] = fun()
+    return res
+
+def sort_keys(sort_key, ascending):
     if sort_key == 'description':
-        q = q.order_by(order(models.Item.description_lower))
+        cols = [models.Item.description_lower, models.Item.id]
     elif sort_key == 'price':
-        q = q.order_by(order(models.StockItem.price))
+        cols = [models.StockItem.price, models.StockItem.item_id]
     else:
         raise ValueError("Invalid key")
+    return [(col, ascending) for col in cols]
+
+def order_by_keys(q, keys):
+    for col, ascending in keys:
+        if ascending:
+            q = q.order_by(sqla.asc(col))
+        else:
+            q = q.order_by(sqla.desc(col))
     return q
 
+def ordering(q, ascending, sort_key):
+    return order_by_keys(q, sort_keys(sort_key, ascending))
+
 def pg_cases(prices):
     cases = []
     i = 0
@@ -78,15 +129,195 @@ def pg_ordering(q, ascending):
 
     q = q.order_by(sqla.asc('price_group')).\
       order_by(order(models.StockItem.price)).\
-      order_by(sqla.asc(models.Item.description_lower))
+      order_by(sqla.asc(models.Item.description_lower)).\
+      order_by(sqla.asc(models.Item.id))
     return q
 
-def pagination(q, page, page_size):
-    if page >= 1:
-        q = q.limit(page_size).offset((page - 1) * page_size)
+def pg_keys(pg_case, ascending):
+    return [(pg_case.element, True), (models.StockItem.price, ascending),
+            (models.Item.description_lower, True), (models.Item.id, True)]
+
+def encode_cursor(values):
+    data = json.dumps(values, default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf8')).decode('ascii')
+
+def decode_cursor(cursor, keys):
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        values = json.loads(data.decode('utf8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError("Invalid cursor")
+
+    res = []
+    for (col, ascending), value in zip(keys, values):
+        if value is not None:
+            value = cursor_value(col, value)
+        res.append(value)
+    return res
+
+def cursor_value(col, value):
+    # the value of col in a cursor as the Python type of col, so that a
+    # tampered cursor fails here and not in the database
+    try:
+        python_type = col.type.python_type
+    except NotImplementedError:
+        raise ValueError("Invalid cursor")
+
+    if python_type is decimal.Decimal:
+        # encode_cursor writes decimals as strings
+        if not isinstance(value, (str, int)) or isinstance(value, bool):
+            raise ValueError("Invalid cursor")
+        try:
+            value = decimal.Decimal(value)
+        except (TypeError, ValueError, decimal.InvalidOperation):
+            raise ValueError("Invalid cursor")
+        if not value.is_finite():
+            raise ValueError("Invalid cursor")
+    elif isinstance(value, bool) or not isinstance(value, python_type):
+        raise ValueError("Invalid cursor")
+    elif isinstance(value, str) and '\x00' in value:
+        raise ValueError("Invalid cursor")
+    return value
+
+def seek(q, keys, values):
+    """Filter q to the rows that follow values in the order of keys"""
+    if all(ascending == keys[0][1] for col, ascending in keys):
+        lhs = sqla.tuple_(*[col for col, ascending in keys])
+        rhs = sqla.tuple_(*values)
+        if keys[0][1]:
+            return q.filter(lhs > rhs)
+        return q.filter(lhs < rhs)
+
+    # mixed directions can not use a row value comparison
+    clauses = []
+    for i, (col, ascending) in enumerate(keys):
+        terms = [c == v for (c, a), v in zip(keys[:i], values[:i])]
+        if ascending:
+            terms.append(col > values[i])
+        else:
+            terms.append(col < values[i])
+        clauses.append(sqla.and_(*terms))
+    return q.filter(sqla.or_(*clauses))
+
+def page_params(keys, page, page_size, cursor):
+    """The paging of page_limit and the values of its parameters"""
+    if cursor is None:
+        if page < 1:
+            raise ValueError("Invalid page")
+        return 'offset', {'page_limit': page_size,
+                          'page_offset': (page - 1) * page_size}
+
+    if page_size < 1:
+        raise ValueError("Invalid page size")
+    params = {'page_limit': page_size + 1}
+    if cursor == '':
+        return 'first', params
+    for i, value in enumerate(decode_cursor(cursor, keys)):
+        params['cursor_{:d}'.format(i)] = value
+    return 'seek', params
+
+def page_limit(q, keys, paging):
+    """Limit q, ordered by keys, to a page given by bind parameters.
+
+    paging is 'offset' for pages selected with page and page_size, or
+    'first' or 'seek' for keyset pagination.  Then the key columns are
+    added to the selected columns and one row more than page_size is
+    fetched to tell if there is a next page.
+    """
+    limit = sqla.bindparam('page_limit', type_=sqla.Integer)
+    if paging == 'offset':
+        return q.limit(limit).\
+          offset(sqla.bindparam('page_offset', type_=sqla.Integer))
+
+    if paging == 'seek':
+        q = seek(q, keys, [sqla.bindparam('cursor_{:d}'.format(i),
+                                          type_=col.type)
+                           for i, (col, ascending) in enumerate(keys)])
+
+    # labeled, a SELECT lists a column only once
+    return q.add_columns(*[col.label(None) for col, ascending in keys]).\
+      limit(limit)
+
+def keyset_rows(rows, keys, page_size):
+    """Returns the rows of a keyset page, without the key columns, and
+    the cursor of the next page or None if this is the last one.
+    """
+    nkeys = len(keys)
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(list(rows[-1][-nkeys:]))
+    return [x[:-nkeys] for x in rows], next_cursor
+
+def json_object(fields, cols):
+    """Text of a JSON object with fields as the keys of cols"""
+    args = []
+    for name, col in zip(fields, cols):
+        # literal keys, the type of a parameter could not be inferred
+        args.append(sqla.literal_column("'{:s}'".format(name)))
+        args.append(col)
+    return sqla.cast(func.json_build_object(*args), sqla.TEXT)
+
+def json_page(q, keys, paging, fields):
+    """page_limit of q, but each row is the text of a JSON object with
+    fields as the keys of the columns of q.
+
+    The objects are built in an outer query, only for the rows of the
+    page.  The key columns follow them as in page_limit.
+    """
+    if paging == 'offset':
+        # only for ordering the outer query
+        q = q.add_columns(*[col.label(None) for col, ascending in keys])
+    sq = page_limit(order_by_keys(q, keys), keys, paging).\
+      with_labels().subquery()
+
+    cols = list(sq.c)
+    key_cols = cols[len(fields):]
+    entities = [json_object(fields, cols)]
+    if paging != 'offset':
+        entities.extend(key_cols)
+    return order_by_keys(Query(entities),
+                         [(col, ascending) for col, (c, ascending)
+                          in zip(key_cols, keys)])
+
+def page_query(q, keys, page, page_size, cursor, json_fields=None):
+    """Order q by keys and limit it to a page, see Catalog.list_items.
+    With json_fields the rows are those of json_page.
+    """
+    paging, params = page_params(keys, page, page_size, cursor)
+    if json_fields is not None:
+        q = json_page(q, keys, paging, json_fields)
     else:
-        raise ValueError("Invalid page")
-    return q
+        q = page_limit(order_by_keys(q, keys), keys, paging)
+    return q.params(**params)
+
+def page_result(rows, keys, page_size, cursor, to_dict, result='dict',
+                row_type=None):
+    """The items of a page as to_dict makes them, as row_type rows or
+    as JSON, see Catalog.list_items.
+    """
+    next_cursor = None
+    if cursor is not None:
+        rows, next_cursor = keyset_rows(rows, keys, page_size)
+
+    if result == 'json':
+        # rows of json_rows, the objects are already serialized
+        res = '[' + ','.join(x[0] for x in rows) + ']'
+        if cursor is not None:
+            res = '{{"items":{:s},"cursor":{:s}}}'.format(
+                res, json.dumps(next_cursor))
+        return res.encode('utf8')
+
+    if result == 'row':
+        items = [row_type._make(x) for x in rows]
+    else:
+        items = [to_dict(x) for x in rows]
+    if cursor is None:
+        return items
+    return {'items': items, 'cursor': next_cursor}
 
 def item_to_json(code, description, category, price, count, reserved=-1):
     x = {'code': code, 'description': description,
@@ -97,37 +328,908 @@ def item_to_json(code, description, category, price, count, reserved=-1):
         x['reserved'] = reserved
     return x
 
-def subtransaction(fun):
+def price_group_to_json(x):
+    res = item_to_json(*x[1:])
+    res['price_group'] = x[0]
+    return res
+
+# Compact rows of result='row', fields in the order of the columns
+ItemRow = collections.namedtuple(
+    'ItemRow', ['code', 'description', 'category', 'price', 'count',
+                'reserved'])
+PriceGroupRow = collections.namedtuple(
+    'PriceGroupRow', ['price_group'] + list(ItemRow._fields))
+
+RESULTS = ('dict', 'row', 'json')
+
+def check_result(result):
+    if result not in RESULTS:
+        raise ValueError("Invalid result")
+
+def basket_item_to_json(x):
+    return { 'code': x[0], 'description': x[1], 'price': x[2],
+             'count': x[3], 'reserved': x[4] }
+
+def basket_price_group_to_json(x):
+    return { 'price_group': x[0], 'code': x[1], 'description': x[2],
+             'price': x[3], 'count': x[4], 'reserved': x[5] }
+
+# Queries and statements shared by Catalog and Basket and the asyncio
+# counterparts in aio.  Queries are built without a session.  Values
+# that change from call to call are named bind parameters, so that a
+# query built once can be run again with other values.
+
+def param(name, value, col):
+    return sqla.bindparam(name, value, type_=col.type)
+
+def item_query(code):
+    return Query(models.Item).\
+      filter(models.Item.code == param('code', code, models.Item.code))
+
+def stock_query(code):
+    return Query([models.Item, models.StockItem]).\
+      with_entities(models.StockItem).\
+      filter(models.Item.code == param('code', code, models.Item.code)).\
+      filter(models.Item.id == models.StockItem.item_id)
+
+def items_query():
+    """Catalog items with their primary category and stock"""
+    return Query([models.Item, models.Category, models.ItemCategory,
+                  models.StockItem]).\
+      with_entities(models.Item.code, models.Item.description,
+                    models.Category.name, models.StockItem.price,
+                    models.StockItem.count, models.StockItem.reserved).\
+      join(models.StockItem).\
+      join(models.ItemCategory,
+           models.Item.id == models.ItemCategory.item_id).\
+      join(models.Category,
+           models.Category.id == models.ItemCategory.category_id).\
+      filter(models.ItemCategory.primary == True)
+
+def escape_like(text):
+    return re.sub(r'([\\%_])', r'\\\1', text)
+
+def prefix_pattern(prefix):
+    return escape_like(prefix.lower()) + '%'
+
+def prefix_filter(prefix):
+    """Descriptions that start with prefix, served by the text_pattern_ops
+    index of description_lower.
+    """
+    col = models.Item.description_lower
+    return col.like(param('pattern', prefix_pattern(prefix), col))
+
+def price_filter(price_range):
+    col = models.StockItem.price
+    return col.between(param('price_low', price_range[0], col),
+                       param('price_high', price_range[1], col))
+
+def tsquery_terms(text):
+    """to_tsquery input that matches the words of text as prefixes"""
+    return ' & '.join(word + ':*' for word in re.findall(r'\w+', text.lower()))
+
+def document_value(description, long_description):
+    """Item.document of the given descriptions"""
+    return models.item_document(
+        sqla.cast(sqla.literal(description), sqla.TEXT),
+        sqla.cast(sqla.literal(long_description), sqla.TEXT))
+
+def search_query(prefix, price_range):
+    return items_query().\
+      filter(price_filter(price_range), prefix_filter(prefix))
+
+def category_query(category, price_range, prefix):
+    """Items of a category, primary or not, with their stock"""
+    q = Query([models.Item, models.Category, models.ItemCategory,
+               models.StockItem]).\
+      with_entities(models.Item.code, models.Item.description,
+                    models.Category.name, models.StockItem.price,
+                    models.StockItem.count, models.StockItem.reserved).\
+      join(models.StockItem).\
+      join(models.ItemCategory,
+           models.Item.id == models.ItemCategory.item_id).\
+      join(models.Category,
+           models.Category.id == models.ItemCategory.category_id).\
+      filter(models.Category.name == param('category', category,
+                                           models.Category.name))
+    if price_range is not None:
+        q = q.filter(price_filter(price_range))
+    if prefix is not None:
+        q = q.filter(prefix_filter(prefix))
+    return q
+
+def text_search_query(text, price_range, page, page_size, cursor,
+                      as_json=False):
+    """Page of catalog items matching the words of text, most relevant
+    first.  Returns the query and its keys for page_result.  With
+    as_json=True the rows are those of json_page.
+    """
+    terms = tsquery_terms(text)
+    tsquery = func.to_tsquery(
+        sqla.literal_column("'{:s}'".format(models.TEXT_SEARCH_CONFIG)),
+        terms)
+    document = models.Item.document
+    # numeric survives the round trip through a cursor exactly
+    rank = sqla.cast(func.ts_rank(document, tsquery), sqla.Numeric)
+
+    q = items_query()
+    if terms == '':
+        q = q.filter(sqla.false())
+    else:
+        q = q.filter(document.op('@@')(tsquery))
+    if price_range is not None:
+        q = q.filter(price_filter(price_range))
+
+    keys = [(rank, False), (models.Item.description_lower, True),
+            (models.Item.id, True)]
+    fields = ItemRow._fields if as_json else None
+    return page_query(q, keys, page, page_size, cursor, fields), keys
+
+def price_groups_query(prices, prefix, ascending, page, page_size, cursor,
+                       as_json=False):
+    """Page of catalog items grouped by prices, returns the query and
+    its keys for page_result.  With as_json=True the rows are those of
+    json_page.
+    """
+    pgs = pg_cases(prices)
+    pg_case = sqla.case(pgs, else_ = -1).label('price_group')
+
+    q = Query([models.Item, models.Category, models.ItemCategory,
+               models.StockItem]).\
+                           with_entities(pg_case, models.Item.code,
+                                         models.Item.description,
+                                         models.Category.name,
+                                         models.StockItem.price,
+                                         models.StockItem.count,
+                                         models.StockItem.reserved)
+    if prefix is not None:
+        q = q.filter(prefix_filter(prefix))
+
+    q = q.join(models.StockItem.item).\
+      filter(models.ItemCategory.item_id == models.Item.id,
+             models.ItemCategory.category_id == models.Category.id,
+             models.ItemCategory.primary == True,
+             pg_case >= 0)
+
+    keys = pg_keys(pg_case, ascending)
+    fields = PriceGroupRow._fields if as_json else None
+    return page_query(q, keys, page, page_size, cursor, fields), keys
+
+def facets_query(prices, prefix):
+    """Item counts by price group and by primary category in one pass.
+
+    Rows are (price_group, category, count), the column that was not
+    grouped is NULL.
+    """
+    pg_case = sqla.case(pg_cases(prices), else_ = -1)
+
+    q = Query([pg_case.label('price_group'), models.Category.name,
+               func.count()]).\
+      select_from(models.Item).\
+      join(models.StockItem).\
+      join(models.ItemCategory,
+           models.Item.id == models.ItemCategory.item_id).\
+      join(models.Category,
+           models.Category.id == models.ItemCategory.category_id).\
+      filter(models.ItemCategory.primary == True, pg_case >= 0)
+    if prefix is not None:
+        q = q.filter(prefix_filter(prefix))
+
+    return q.group_by(func.grouping_sets(sqla.tuple_(pg_case),
+                                         sqla.tuple_(models.Category.name)))
+
+def facets_result(prices, rows):
+    res = {'price_groups': [0] * len(prices), 'categories': {}, 'total': 0}
+    for price_group, category, count in rows:
+        if category is None:
+            res['price_groups'][price_group] = count
+            res['total'] += count
+        else:
+            res['categories'][category] = count
+    return res
+
+def basket_query(session_id):
+    return Query(models.Basket.id).\
+      filter(models.Basket.session == param('session_id', session_id,
+                                            models.Basket.session))
+
+def basket_item_query(basket_id, stock_id):
+    return Query(models.BasketItem).\
+      filter(models.BasketItem.basket_id == \
+             param('basket_id', basket_id, models.BasketItem.basket_id),
+             models.BasketItem.stock_item_id == \
+             param('stock_id', stock_id, models.BasketItem.stock_item_id))
+
+def basket_items_query(basket_id, sort_key, ascending):
+    q = Query([models.Item, models.StockItem, models.Basket,
+               models.BasketItem, models.Reservation]).\
+        with_entities(models.Item.code, models.Item.description,
+                      models.StockItem.price, models.BasketItem.count,
+                      models.Reservation.count).\
+        filter(models.Basket.id == basket_id,
+               models.Basket.id == models.BasketItem.basket_id,
+               models.StockItem.id == models.BasketItem.stock_item_id,
+               models.Item.id == models.StockItem.item_id,
+               models.BasketItem.id == models.Reservation.basket_item_id)
+    return ordering(q, ascending, sort_key)
+
+def basket_price_groups_query(basket_id, prices, ascending):
+    cases = pg_cases(prices)
+    pg_case = sqla.case(cases, else_ = -1).label('price_group')
+
+    q = Query([models.Item, models.StockItem, models.Basket,
+               models.BasketItem, models.Reservation]).\
+        with_entities(pg_case, models.Item.code,
+                      models.Item.description, models.StockItem.price,
+                      models.StockItem.count, models.BasketItem.count,
+                      models.Reservation.count).\
+        join(models.Basket.basket_items).\
+        join(models.Item.stock_item).\
+        filter(models.Basket.id == basket_id,
+               models.StockItem.id == models.BasketItem.stock_item_id,
+               models.BasketItem.id == models.Reservation.basket_item_id,
+               pg_case >= 0)
+    return pg_ordering(q, ascending)
+
+def basket_total_query(basket_id):
+    return Query([models.Basket.lines, models.Basket.units,
+                  models.Basket.value, models.Basket.reserved_value]).\
+      filter(models.Basket.id == param('basket_id', basket_id,
+                                       models.Basket.id))
+
+def basket_totals_query(basket_id, prices):
+    """Totals of the items of a basket by price group"""
+    pg_case = sqla.case(pg_cases(prices), else_ = -1)
+    reserved = func.coalesce(models.Reservation.count, 0)
+
+    q = Query([pg_case.label('price_group'), func.count(),
+               func.sum(models.BasketItem.count),
+               func.sum(models.BasketItem.count * models.StockItem.price),
+               func.sum(reserved * models.StockItem.price)]).\
+      select_from(models.BasketItem).\
+      join(models.StockItem,
+           models.StockItem.id == models.BasketItem.stock_item_id).\
+      outerjoin(models.Reservation,
+                models.BasketItem.id == models.Reservation.basket_item_id).\
+      filter(models.BasketItem.basket_id == basket_id, pg_case >= 0)
+    return q.group_by(pg_case)
+
+def basket_total_to_json(x):
+    return { 'lines': x[0], 'units': x[1], 'value': x[2],
+             'reserved_value': x[3] }
+
+def basket_totals_result(prices, row, rows):
+    res = basket_total_to_json(row)
+    zero = decimal.Decimal('0.00')
+    res['price_groups'] = [basket_total_to_json((0, 0, zero, zero))
+                           for x in prices]
+    for x in rows:
+        res['price_groups'][x[0]] = basket_total_to_json(x[1:])
+    return res
+
+def basket_lines_query(basket_id, codes):
+    """Stock, basket item and reservation of each code"""
+    return Query([models.Item.code, models.StockItem.id,
+                  models.StockItem.count, models.StockItem.reserved,
+                  models.BasketItem.id, models.BasketItem.count,
+                  models.Reservation.count]).\
+      outerjoin(models.StockItem,
+                models.Item.id == models.StockItem.item_id).\
+      outerjoin(models.BasketItem,
+                sqla.and_(models.BasketItem.basket_id == basket_id,
+                          models.BasketItem.stock_item_id == \
+                          models.StockItem.id)).\
+      outerjoin(models.Reservation,
+                models.BasketItem.id == models.Reservation.basket_item_id).\
+      filter(models.Item.code.in_(list(codes)))
+
+def line_counts(lines, relative):
+    counts = collections.OrderedDict()
+    for code, count in lines:
+        if relative:
+            counts[code] = counts.get(code, 0) + count
+        else:
+            counts[code] = count
+    return counts
+
+def plan_basket_lines(counts, found, relative):
+    """Work out the changes of Basket.add_items and set_items.
+
+    counts maps codes to counts and found codes to the rows of
+    basket_lines_query.  Returns the result of each code, the
+    (stock_item_id, count, reserved) basket items to upsert, the ids of
+    basket items to delete and the changes of reserved counts.
+    """
+    results = {}
+    upserts = []
+    removed = []
+    deltas = {}
+    for code, count in counts.items():
+        res = {'code': code, 'status': 'ok', 'count': 0, 'reserved': 0}
+        results[code] = res
+        if code not in found:
+            res['status'] = 'unknown code'
+            continue
+
+        stock_id, scount, sreserved, bi_id, bi_count, rcount = found[code]
+        if stock_id is None:
+            res['status'] = 'not in stock'
+            continue
+
+        if rcount is None:
+            rcount = 0
+        if relative and bi_count is not None:
+            count += bi_count
+
+        if count <= 0:
+            if bi_id is not None:
+                removed.append(bi_id)
+                deltas[stock_id] = -rcount
+            continue
+
+        reserve = min(count, scount - sreserved + rcount)
+        upserts.append((stock_id, count, reserve))
+        deltas[stock_id] = reserve - rcount
+        res['count'] = count
+        res['reserved'] = reserve
+
+    deltas = dict((k, v) for k, v in deltas.items() if v != 0)
+    return results, upserts, removed, deltas
+
+def upsert_basket_items(basket_id, upserts, now):
+    """Returns stock_item_id, id of the basket items"""
+    table = models.BasketItem.__table__
+    q = postgresql.insert(table).\
+      values([{'basket_id': basket_id, 'stock_item_id': stock_id,
+               'count': count, 'creation': now, 'modification': now}
+              for stock_id, count, reserve in upserts])
+    q = q.on_conflict_do_update(
+        index_elements=[table.c.basket_id, table.c.stock_item_id],
+        set_={'count': q.excluded.count,
+              'modification': q.excluded.modification})
+    return q.returning(table.c.stock_item_id, table.c.id)
+
+def upsert_reservations(upserts, basket_items, now):
+    table = models.Reservation.__table__
+    q = postgresql.insert(table).\
+      values([{'stock_item_id': stock_id,
+               'basket_item_id': basket_items[stock_id],
+               'count': reserve, 'creation': now, 'modification': now}
+              for stock_id, count, reserve in upserts])
+    return q.on_conflict_do_update(
+        index_elements=[table.c.stock_item_id,
+                        table.c.basket_item_id],
+        set_={'count': q.excluded.count,
+              'modification': q.excluded.modification})
+
+def delete_basket_items(basket_item_ids):
+    # Reservations are deleted by the cascade
+    table = models.BasketItem.__table__
+    return table.delete().where(table.c.id.in_(basket_item_ids))
+
+def update_reserved(deltas):
+    table = models.StockItem.__table__
+    return table.update().\
+      where(table.c.id.in_(list(deltas))).\
+      values(reserved=table.c.reserved + \
+             sqla.case(deltas, value=table.c.id))
+
+def release_baskets(basket_ids):
+    # Reservations of deleted baskets go away with the on delete
+    # cascade, the counts need to be subtracted before that
+    sq = Query([models.Reservation.stock_item_id,
+                func.sum(models.Reservation.count).label('reserved')]).\
+      join(models.Reservation.basket_item).\
+      filter(models.BasketItem.basket_id.in_(basket_ids)).\
+      group_by(models.Reservation.stock_item_id).\
+      subquery()
+
+    table = models.StockItem.__table__
+    return table.update().\
+      where(table.c.id == sq.c.stock_item_id).\
+      values(reserved=table.c.reserved - sq.c.reserved)
+
+def delete_baskets(basket_ids):
+    table = models.Basket.__table__
+    return table.delete().where(table.c.id.in_(basket_ids))
+
+def touch_basket(basket_id, now):
+    table = models.Basket.__table__
+    return table.update().where(table.c.id == basket_id).\
+      values(modification=now)
+
+def import_progress_query(source):
+    return Query(models.ImportProgress).\
+      filter(models.ImportProgress.source == source)
+
+def stale_baskets_query(cutoff, batch_size):
+    """Ids of at most batch_size baskets not modified since cutoff,
+    locked.  Baskets locked by others are skipped.
+    """
+    return Query(models.Basket.id).\
+      filter(models.Basket.modification < cutoff).\
+      order_by(models.Basket.modification).\
+      limit(batch_size).\
+      with_for_update(skip_locked=True)
+
+def lock_stock_query(codes=None, stock_ids=None, basket_id=None):
+    """Ids of the stock items of codes, of stock_ids or in the basket of
+    basket_id, locked for update.  Rows are locked in the order of their
+    ids, so that transactions that lock several of them do not deadlock.
+    """
+    q = Query(models.StockItem.id)
+    if codes is not None:
+        q = q.join(models.Item, models.Item.id == models.StockItem.item_id).\
+          filter(models.Item.code.in_(list(codes)))
+    if stock_ids is not None:
+        q = q.filter(models.StockItem.id.in_(list(stock_ids)))
+    if basket_id is not None:
+        table = models.BasketItem.__table__
+        q = q.filter(models.StockItem.id.in_(
+            sqla.select([table.c.stock_item_id]).\
+            where(table.c.basket_id == basket_id)))
+    return q.order_by(models.StockItem.id).\
+      with_for_update(of=models.StockItem)
+
+def basket_contents_query(basket_ids):
+    """Number of basket items, reservations and reserved units"""
+    return Query([func.count(sqla.distinct(models.BasketItem.id)),
+                  func.count(models.Reservation.id),
+                  func.coalesce(func.sum(models.Reservation.count), 0)]).\
+      select_from(models.BasketItem).\
+      outerjoin(models.Reservation,
+                models.BasketItem.id == models.Reservation.basket_item_id).\
+      filter(models.BasketItem.basket_id.in_(basket_ids))
+
+# Hot queries of Catalog and Basket are baked: built and compiled once
+# for each key and then run with new values of their parameters
+bakery = baked.bakery()
+
+def checkout_result(rows):
+    """Order of the rows of the checkout statement"""
+    if len(rows) == 0:
+        raise ValueError('Nothing reserved')
+    # the guard left some stock items as they were
+    if rows[0][4] != len(rows):
+        raise ValueError('Not in stock')
+
+    lines = [{'code': x[1], 'count': x[2], 'price': x[3]} for x in rows]
+    return {'order': rows[0][0], 'lines': lines,
+            'total': sum(x['count'] * x['price'] for x in lines)}
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def copy_result(res):
+    if isinstance(res, dict):
+        return dict((k, copy_result(v)) for k, v in res.items())
+    if isinstance(res, list):
+        return [copy_result(x) for x in res]
+    return res
+
+# SQLSTATEs of serialization failures and deadlocks
+RETRYABLE_ERRORS = ('40001', '40P01')
+
+def is_retryable(exc):
+    return isinstance(exc, sqla.exc.DBAPIError) and \
+      getattr(exc.orig, 'pgcode', None) in RETRYABLE_ERRORS
+
+class RetryPolicy(object):
+    """How top level transactions are retried after serialization failures.
+
+    A transaction is run at most attempts times.  Before a retry the
+    caller sleeps a random time between zero and delay * 2 ** (retry - 1)
+    seconds, but at most max_delay seconds.  on_retry, if given, is called
+    with the name of the unit of work, the attempt that failed and the
+    exception.
+    """
+    def __init__(self, attempts=5, delay=0.01, max_delay=1.0, on_retry=None,
+                 sleep=time.sleep):
+        if attempts < 1:
+            raise ValueError("Invalid number of attempts")
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.on_retry = on_retry
+        self.sleep = sleep
+
+    def backoff(self, retry):
+        return random.uniform(0, min(self.max_delay,
+                                     self.delay * 2 ** (retry - 1)))
+
+def subtransaction(fun=None, changes='catalog'):
+    # changes is what fun changes for the result cache, 'catalog',
+    # 'reserved' or None when fun records its changes itself
+    if fun is None:
+        return lambda fun: subtransaction(fun, changes)
+
+    def changed(self):
+        if changes == 'catalog':
+            self._changed()
+        elif changes == 'reserved':
+            self._changed(reserved_only=True)
+
+    @functools.wraps(fun)
     def new_fun(self, *args, **kw):
+        catalog = getattr(self, 'catalog', self)
+        info = self.session.info
+        if catalog.retry is not None and info.get('depth', 0) == 0:
+            return catalog.transaction(new_fun, self, *args, **kw)
+
+        info['depth'] = info.get('depth', 0) + 1
         self.session.begin(subtransactions=True)
 
         try:
             res = fun(self, *args, **kw)
+            # a flush that fails here leaves the subtransaction open
+            self.session.commit()
         except Exception as exc:
             self.session.rollback()
+            changed(self)
             raise exc
+        finally:
+            info['depth'] -= 1
 
-        self.session.commit()
+        changed(self)
 
         return res
 
     return new_fun
 
 class Catalog(object):
-    def __init__(self, engine):
+    def __init__(self, engine, cache_size=0, cache_ttl=60.0,
+                 result_cache_size=0, result_cache_ttl=60.0,
+                 reserved_staleness=0, retry=None, scoped=False,
+                 typeahead=False, prepared=False,
+                 reservation='serializable'):
+        """cache_size > 0 enables an LRU cache of get_item and get_stock
+        results for that many codes, each kept for at most cache_ttl
+        seconds.  Codes changed through this catalog are dropped from it
+        when the transaction ends, and until then the session that
+        changed them does not use the cache.
+
+        result_cache_size > 0 enables a cache of that many list_items and
+        list_items_by_prices results.  Entries are dropped when this
+        catalog or its baskets commit a change of anything, but changes
+        to reserved counts only after reserved_staleness seconds.  A
+        session with uncommitted changes does not fill the cache.
+        Changes made by other processes are seen after result_cache_ttl
+        seconds, with result_cache_ttl=None only when the cache is
+        dropped, which is safe when no other process changes the
+        catalog.
+
+        With a RetryPolicy as retry every top level call of a method that
+        changes data is a transaction of its own.  It is committed, or
+        retried if it fails because of a serialization failure.
+
+        With scoped=True each thread gets a session of its own from a
+        session factory.  Wrap each unit of work in request(), so that
+        the session is closed and its connection returned to the pool.
+
+        typeahead=True keeps the descriptions of all items in memory for
+        typeahead().  Changes made through this catalog are applied to
+        it when they are committed, changes made by others only by
+        refresh_typeahead().
+
+        The hot read queries of get_item, get_stock, list_items,
+        search_items, list_items_by_category and Basket.get are built and
+        compiled once and then run with new parameters.  prepared=True
+        runs them as server side prepared statements, which also saves
+        the parsing and planning in the database.
+
+        reservation is one of RESERVATION_STRATEGIES.  With
+        'serializable' reservations rely on the SERIALIZABLE isolation
+        of the engine, and concurrent reservations of the same stock
+        item fail with serialization failures.  'locking' runs the
+        sessions at READ COMMITTED instead, and changes of reservations
+        and stock first lock the basket and the stock item rows, so
+        that concurrent baskets wait for each other in turn.
+        """
+        if reservation not in RESERVATION_STRATEGIES:
+            raise ValueError("Invalid reservation strategy")
+        self.reservation = reservation
+
         self.engine = engine
-        self.session = Session(bind=self.engine)
+        bind = engine
+        if reservation == 'locking':
+            bind = engine.execution_options(isolation_level='READ COMMITTED')
+        if scoped:
+            factory = sessionmaker(bind=bind)
+            self._sessions = scoped_session(factory)
+            self._session = None
+        else:
+            factory = Session(bind=bind)
+            self._sessions = None
+            self._session = factory
+
+        self.retry = retry
+        self._retry_stats = {}
+        self._retry_lock = threading.Lock()
+
+        self.item_cache = None
+        self.item_version = 0
+        if cache_size > 0:
+            self.item_cache = cache.LRUCache(cache_size, cache_ttl)
+
+        self.catalog_version = 0
+        self.reserved_version = 0
+        self.reserved_staleness = reserved_staleness
+        self.result_cache = None
+        if result_cache_size > 0:
+            self.result_cache = cache.LRUCache(result_cache_size,
+                                               result_cache_ttl)
+
+        self.typeahead_index = None
+        self._typeahead_loaded = False
+        if typeahead:
+            self.typeahead_index = TypeaheadIndex()
+            event.listen(factory, 'after_commit', self._typeahead_commit)
+            event.listen(factory, 'after_transaction_end',
+                         self._typeahead_end)
+        event.listen(factory, 'after_transaction_end', self._transaction_end)
+
+        self.prepared = None
+        if prepared:
+            self.prepared = PreparedStatements()
+
+    @property
+    def session(self):
+        if self._sessions is not None:
+            return self._sessions()
+        return self._session
+
+    def close(self):
+        """Close the session of this thread and release its connection"""
+        if self._sessions is not None:
+            self._sessions.remove()
+        else:
+            self._session.close()
+
+    @contextlib.contextmanager
+    def request(self):
+        """Scope of one unit of work, e.g. a web request.
+
+        The session is committed at the end, or rolled back if an
+        exception is raised, and then closed.
+        """
+        try:
+            yield self
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            self.close()
+
+    def cache_stats(self):
+        if self.item_cache is None:
+            return None
+        return self.item_cache.stats()
+
+    def result_cache_stats(self):
+        if self.result_cache is None:
+            return None
+        return self.result_cache.stats()
+
+    def transaction(self, fun, *args, **kw):
+        """Run fun(*args, **kw) as a transaction of its own and commit it.
+
+        The transaction is rolled back and fun called again after
+        serialization failures and deadlocks as the retry policy allows.
+        Returns the result of fun.
+
+        Changes already pending in the session are committed with the
+        transaction.  The rollback of a failed attempt discards them, so
+        then the failure is raised without retrying.
+        """
+        policy = self.retry
+        if policy is None:
+            policy = RetryPolicy(attempts=1)
+
+        name = getattr(fun, '__qualname__', fun.__name__)
+        info = self.session.info
+        pending = self._pending()
+        attempt = 1
+        while True:
+            info['depth'] = info.get('depth', 0) + 1
+            try:
+                res = fun(*args, **kw)
+                self.session.commit()
+                return res
+            except Exception as exc:
+                self.session.rollback()
+                if not is_retryable(exc):
+                    raise exc
+
+                failed = attempt >= policy.attempts or pending
+                with self._retry_lock:
+                    stats = self._retry_stats.setdefault(
+                        name, {'retries': 0, 'failures': 0})
+                    if failed:
+                        stats['failures'] += 1
+                    else:
+                        stats['retries'] += 1
+                if failed:
+                    raise exc
+                if policy.on_retry is not None:
+                    policy.on_retry(name, attempt, exc)
+            finally:
+                info['depth'] -= 1
+
+            policy.sleep(policy.backoff(attempt))
+            attempt += 1
+
+    def _pending(self):
+        # uncommitted changes, the caches mark those made by the catalog
+        session = self.session
+        return len(session.new) > 0 or len(session.dirty) > 0 or \
+          len(session.deleted) > 0 or 'changed' in session.info or \
+          'invalidate' in session.info
+
+    def retry_stats(self):
+        """Retries and final failures of transactions by unit of work"""
+        with self._retry_lock:
+            return dict((k, dict(v)) for k, v in self._retry_stats.items())
+
+    def create_basket(self, session_id):
+        return Basket.create(self, session_id)
+
+    def get_basket(self, session_id):
+        return Basket.get(self, session_id)
+
+    def _changed(self, reserved_only=False):
+        # the versions are bumped when the transaction ends
+        self.session.info.setdefault('changed', set()).\
+          add('reserved' if reserved_only else 'catalog')
+
+    def _cached(self, key, fun, reserved=True):
+        # reserved=False when the result does not depend on reservations
+        if self.result_cache is None:
+            return fun()
+
+        # uncommitted changes of this session, the results it reads are
+        # not cached
+        changed = self.session.info.get('changed', ())
+        if 'catalog' in changed:
+            return fun()
+
+        def fresh(entry):
+            catalog_version, reserved_version, created, res = entry
+            return catalog_version == self.catalog_version and \
+              (not reserved or
+               (reserved_version == self.reserved_version and
+                'reserved' not in changed) or
+               time.monotonic() - created < self.reserved_staleness)
+
+        entry = self.result_cache.get(key, valid=fresh)
+        if entry is not None:
+            return copy_result(entry[3])
+
+        # versions before the query, a concurrent change makes it stale
+        catalog_version = self.catalog_version
+        reserved_version = self.reserved_version
+        res = fun()
+        if len(changed) == 0:
+            self.result_cache.put(key, (catalog_version, reserved_version,
+                                        time.monotonic(), res))
+        return copy_result(res)
+
+    def _baked(self, key, build):
+        """Baked query of key, build() returns the Query the first time
+        key is seen.
+        """
+        return bakery(lambda session: build().with_session(session),
+                      *key)(self.session)
+
+    def _rows(self, key, build, params):
+        """Rows of a hot query, run as a baked query or a prepared
+        statement.  params are the values of the named bind parameters
+        of the Query that build() returns.
+        """
+        if self.prepared is None:
+            return self._baked(key, build).params(**params).all()
+
+        session = self.session
+        if session.autoflush:
+            session.flush()
+        return self.prepared.fetch(session.connection(), key, build, params)
+
+    def typeahead(self, prefix, limit=10):
+        """At most limit items whose description starts with prefix, as
+        dicts of 'code' and 'description' in the order of descriptions.
+
+        Without the in-memory index the database is queried.
+        """
+        if self.typeahead_index is None:
+            q = self.session.query(models.Item.code,
+                                   models.Item.description).\
+              filter(prefix_filter(prefix)).\
+              order_by(models.Item.description_lower, models.Item.code).\
+              limit(limit)
+            return [{'code': x[0], 'description': x[1]} for x in q]
+
+        if not self._typeahead_loaded:
+            self.refresh_typeahead()
+        return self.typeahead_index.complete(prefix, limit)
+
+    def refresh_typeahead(self):
+        """Load the typeahead index from the committed items"""
+        q = sqla.select([models.Item.code, models.Item.description])
+        with self.engine.connect() as conn:
+            self.typeahead_index.load(conn.execute(q).fetchall())
+        self._typeahead_loaded = True
+
+    def _typeahead_change(self, code, description=None):
+        # applied when the session commits, description None removes
+        if self.typeahead_index is not None:
+            self.session.info.setdefault('typeahead', []).\
+              append((code, description))
+
+    def _typeahead_commit(self, session):
+        for code, description in session.info.pop('typeahead', []):
+            if description is None:
+                self.typeahead_index.remove(code)
+            else:
+                self.typeahead_index.add(code, description)
+
+    def _typeahead_end(self, session, transaction):
+        # rolled back or closed without a commit
+        if transaction.parent is None:
+            session.info.pop('typeahead', None)
+
+    def _invalidate(self, codes):
+        # dropped now and again when the transaction ends, other
+        # sessions may cache the committed rows until then
+        if self.item_cache is None:
+            return
+        codes = set(codes)
+        self.session.info.setdefault('invalidate', set()).update(codes)
+        self._drop(codes)
+
+    def _drop(self, codes):
+        self.item_version += 1
+        for code in codes:
+            self.item_cache.invalidate(('item', code))
+            self.item_cache.invalidate(('stock', code))
+
+    def _item_cached(self):
+        # a session with uncommitted changes of items neither reads nor
+        # fills the cache
+        return self.item_cache is not None and \
+          'invalidate' not in self.session.info
+
+    def _transaction_end(self, session, transaction):
+        # committed, rolled back or closed
+        if transaction.parent is not None:
+            return
+        changed = session.info.pop('changed', ())
+        if 'catalog' in changed:
+            self.catalog_version += 1
+        if 'reserved' in changed:
+            self.reserved_version += 1
+        codes = session.info.pop('invalidate', None)
+        if codes is not None:
+            self._drop(codes)
 
     @subtransaction
     def add_item(self, code, description, long_description=None):
         citem = models.Item(code=code,
                             description=description,
-                            long_description=long_description)
+                            description_lower=description.lower(),
+                            long_description=long_description,
+                            document=document_value(description,
+                                                    long_description))
         self.session.add(citem)
+        self._invalidate([code])
+        self._changed()
+        self._typeahead_change(code, description)
         return citem
 
     @subtransaction
     def add_items(self, items):
+        items = list(items)
+        self._invalidate([item['code'] for item in items])
         for item in items:
             # KeyErrors not caught if missing required field
 
@@ -139,7 +1241,9 @@ class Catalog(object):
             citem = models.Item(code=item['code'],
                                 description=item['description'],
                                 description_lower=item['description'].lower(),
-                                long_description=long_desc)
+                                long_description=long_desc,
+                                document=document_value(item['description'],
+                                                        long_desc))
 
             primary=True
             for cat in item['categories']:
@@ -152,6 +1256,7 @@ class Catalog(object):
                 citem.categories.append(icater)
                 primary=False
             self.session.add(citem)
+            self._typeahead_change(item['code'], item['description'])
 
     def add_category(self, name):
         self.add_categories([name])
@@ -175,23 +1280,47 @@ class Catalog(object):
     # def remove_item_category
 
     def get_item(self, code, as_object=False):
-        q = self.session.query(models.Item).filter(models.Item.code == code)
-        item = q.first()
-        if item is None:
-            return None
+        cached = self._item_cached()
+        # a concurrent commit of changes makes the row stale
+        version = self.item_version
         if as_object is True:
+            item = self._baked(('item',), lambda: item_query(None)).\
+              params(code=code).first()
+            if item is not None and cached and version == self.item_version:
+                self.item_cache.put(('item', code),
+                                    (item.id, item.code, item.description,
+                                     item.long_description))
             return item
-        return (item.id, item.code, item.description, item.long_description)
 
+        if cached:
+            res = self.item_cache.get(('item', code))
+            if res is not None:
+                return res
+
+        rows = self._rows(('item_row',), lambda: item_query(None).\
+                          with_entities(models.Item.id, models.Item.code,
+                                        models.Item.description,
+                                        models.Item.long_description).\
+                          limit(1), {'code': code})
+        if len(rows) == 0:
+            return None
+
+        res = tuple(rows[0])
+        if cached and version == self.item_version:
+            self.item_cache.put(('item', code), res)
+        return res
+
+    @subtransaction
     def remove_item(self, code):
-        self.session.begin(subtransactions=True)
+        self._invalidate([code])
+        self._typeahead_change(code)
         q = self.session.query(models.Item).filter(models.Item.code == code).\
           delete()
-        self.session.commit()
 
     @subtransaction
     def update_item(self, code, description=None, long_description=None,
                     new_code=None):
+        self._invalidate([code, new_code])
         q = self.session.query(models.Item).filter(models.Item.code == code)
         item = q.first()
 
@@ -205,22 +1334,48 @@ class Catalog(object):
         if long_description is not None:
             item.long_description = long_description
 
+        if description is not None or long_description is not None:
+            item.document = document_value(item.description,
+                                           item.long_description)
+
+        if new_code is not None:
+            self._typeahead_change(code)
+        self._typeahead_change(item.code, item.description)
+
     def get_stock(self, code, as_object=False):
-        q = self.session.query(models.Item, models.StockItem).\
-          with_entities(models.StockItem).\
-          filter(models.Item.code == code).\
-          filter(models.Item.id == models.StockItem.item_id)
-        res = q.first()
-        if res is None:
+        cached = self._item_cached()
+        version = self.item_version
+        if as_object is True:
+            stock = self._baked(('stock',), lambda: stock_query(None)).\
+              params(code=code).first()
+            if stock is not None and cached and \
+              version == self.item_version:
+                self.item_cache.put(('stock', code),
+                                    (stock.id, stock.price, stock.count))
+            return stock
+
+        if cached:
+            res = self.item_cache.get(('stock', code))
+            if res is not None:
+                return res
+
+        rows = self._rows(('stock_row',), lambda: stock_query(None).\
+                          with_entities(models.StockItem.id,
+                                        models.StockItem.price,
+                                        models.StockItem.count).\
+                          limit(1), {'code': code})
+        if len(rows) == 0:
             return None
 
-        if as_object is True:
-            return res
-        return (res.id, res.price, res.count)
+        res = tuple(rows[0])
+        if cached and version == self.item_version:
+            self.item_cache.put(('stock', code), res)
+        return res
 
     @subtransaction
     def add_stock(self, items):
-
+        items = list(items)
+        self._invalidate([item['code'] for item in items])
         for item in items:
             q = self.session.query(models.Item).\
               filter(models.Item.code == item['code'])
@@ -230,8 +1385,21 @@ class Catalog(object):
                                     price=item['price'])
             self.session.add(stock)
 
+    def _lock_stock(self, codes=None, stock_ids=None, basket_id=None):
+        # the locking strategy: statements after this see the latest
+        # stock and reservations of the items, nobody else changes them
+        if self.reservation != 'locking':
+            return
+        q = lock_stock_query(codes, stock_ids, basket_id).\
+          with_entities(models.StockItem).\
+          with_session(self.session).\
+          populate_existing()
+        q.all()
+
     @subtransaction
     def update_stock(self, code, count, price):
+        self._invalidate([code])
+        self._lock_stock(codes=[code])
         q = self.session.query(models.Item, models.StockItem).\
               with_entities(models.StockItem).\
               join(models.StockItem.item).\
@@ -248,8 +1416,94 @@ class Catalog(object):
             else:
                 raise KeyError('Unknown item code')
         else:
+            repriced = [stock.id] if stock.price != price else []
             stock.count += count
             stock.price = price
+            self.session.flush()
+            self._rebalance([stock.id], repriced)
+
+    @subtransaction(changes='reserved')
+    def rebalance_reservations(self, codes):
+        """Reallocate the stock of the items of codes to the basket items
+        that want them, first come first served by the creation of the
+        basket items.
+
+        Stock updates do this for the items they change.  Returns the
+        number of reservations that changed.
+        """
+        q = self.session.query(models.StockItem.id).\
+          join(models.StockItem.item).\
+          filter(models.Item.code.in_(list(codes)))
+        return self._rebalance([x[0] for x in q])
+
+    def _rebalance(self, stock_ids, repriced=()):
+        # repriced, the stock items whose price changed
+        if len(stock_ids) == 0:
+            return 0
+
+        # pending changes must reach the database before the statement
+        self.session.flush()
+        self._lock_stock(stock_ids=stock_ids)
+        changed, baskets = self.session.execute(
+            _rebalance_sql, {'ids': list(stock_ids),
+                             'now': datetime.datetime.utcnow()}).first()
+        self._update_totals('stock', repriced)
+        self._update_totals('baskets', baskets)
+        # rows changed behind the back of the ORM
+        self.session.expire_all()
+        return changed
+
+    def _update_totals(self, key, ids):
+        # key 'baskets' for basket ids, 'stock' for stock item ids
+        if len(ids) == 0:
+            return
+        self.session.execute(_basket_totals_sql[key], {'ids': list(ids)})
+
+    @subtransaction
+    def update_stocks(self, rows, mode='delta', chunk_size=10000):
+        """Set based variant of update_stock for (code, count, price) rows.
+
+        With mode='delta' the counts are added to the stock as in
+        update_stock, with mode='absolute' they replace it.  Prices are
+        always replaced.  Items without stock get a stock item.  Rows of
+        the same code are combined, the last price wins.  Each chunk of
+        chunk_size codes is one statement, followed by the rebalancing
+        of the reservations of the updated stock items.  Returns the
+        numbers of 'updated' and 'inserted' stock items and the
+        'unknown' codes.
+        """
+        if mode not in _update_stocks_sql:
+            raise ValueError("Invalid mode")
+
+        stocks = collections.OrderedDict()
+        for code, count, price in rows:
+            if mode == 'delta' and code in stocks:
+                count += stocks[code][0]
+            stocks[code] = (count, price)
+        self._invalidate(stocks)
+
+        res = {'updated': 0, 'inserted': 0, 'unknown': []}
+        now = datetime.datetime.utcnow()
+        # pending changes must reach the database before the statements
+        self.session.flush()
+        if self.reservation == 'locking':
+            # all of the rows before the first chunk, the chunks are in
+            # the order of rows and not of the ids
+            self.session.execute(_lock_stocks_sql, {'codes': list(stocks)})
+        for chunk in chunked(list(stocks.items()), chunk_size):
+            updated, inserted, unknown, repriced = self.session.execute(
+                _update_stocks_sql[mode],
+                {'codes': [code for code, x in chunk],
+                 'counts': [x[0] for code, x in chunk],
+                 'prices': [x[1] for code, x in chunk],
+                 'now': now}).first()
+            res['updated'] += len(updated)
+            res['inserted'] += inserted
+            res['unknown'].extend(unknown)
+            self._rebalance(updated, repriced)
+        # rows changed behind the back of the ORM
+        self.session.expire_all()
+        return res
 
     @subtransaction
     def add_items_with_stock(self, items):
@@ -262,110 +1516,343 @@ class Catalog(object):
         self.add_items(items)
         self.add_stock(items)
 
-    def list_items(self, sort_key='description',
-                   ascending=True, page=1, page_size=10):
-        sq = self.session.query(models.Reservation.stock_item_id,
-                                func.sum(models.Reservation.count).\
-                                label('reserved')).\
-                                group_by(models.Reservation.stock_item_id).\
-                                subquery()
-        q = self.session.query(models.Item, models.Category,
-                               models.ItemCategory, models.StockItem,
-                               sq.c.reserved).\
-          with_entities(models.Item.code, models.Item.description,
-                        models.Category.name, models.StockItem.price,
-                        models.StockItem.count, sq.c.reserved).\
-          join(models.StockItem).\
-          join(models.ItemCategory,
-               models.Item.id == models.ItemCategory.item_id).\
-          join(models.Category,
-               models.Category.id == models.ItemCategory.category_id).\
-          filter(models.ItemCategory.primary == True).\
-          outerjoin(sq, models.StockItem.id == sq.c.stock_item_id)
-
-        q = ordering(q, ascending, sort_key)
-        q = pagination(q, page, page_size)
+    @subtransaction
+    def bulk_add_items_with_stock(self, items, chunk_size=1000):
+        """Set based variant of add_items_with_stock.
+
+        Missing categories are created.  Rows are written with multi-row
+        inserts of at most chunk_size rows.  Returns row counts and
+        timings per phase.
+        """
+        stats = {}
+        items = list(items)
+        self._invalidate([item['code'] for item in items])
+
+        start = time.perf_counter()
+        names = set()
+        for item in items:
+            names.update(item['categories'])
+        categories, rows = self._bulk_add_categories(names, chunk_size)
+        stats['categories'] = {'rows': rows,
+                               'seconds': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        codes = {}
+        table = models.Item.__table__
+        for chunk in chunked(items, chunk_size):
+            values = [{'code': item['code'],
+                       'description': item['description'],
+                       'description_lower': item['description'].lower(),
+                       'long_description': item.get('long description'),
+                       'document': document_value(
+                           item['description'],
+                           item.get('long description'))}
+                      for item in chunk]
+            q = table.insert().values(values).\
+              returning(table.c.id, table.c.code)
+            codes.update((code, id_) for id_, code in self.session.execute(q))
+            for item in chunk:
+                self._typeahead_change(item['code'], item['description'])
+        stats['items'] = {'rows': len(codes),
+                          'seconds': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        values = []
+        for item in items:
+            primary = True
+            for cat in item['categories']:
+                values.append({'item_id': codes[item['code']],
+                               'category_id': categories[cat],
+                               'primary': primary})
+                primary = False
+        table = models.ItemCategory.__table__
+        for chunk in chunked(values, chunk_size):
+            self.session.execute(table.insert().values(chunk))
+        stats['item_categories'] = {'rows': len(values),
+                                    'seconds': time.perf_counter() - start}
+
+        start = time.perf_counter()
+        now = datetime.datetime.utcnow()
+        values = [{'item_id': codes[item['code']], 'count': item['count'],
+                   'reserved': 0, 'price': item['price'], 'visible': True,
+                   'modification': now} for item in items]
+        table = models.StockItem.__table__
+        for chunk in chunked(values, chunk_size):
+            self.session.execute(table.insert().values(chunk))
+        stats['stock_items'] = {'rows': len(values),
+                                'seconds': time.perf_counter() - start}
+
+        return stats
+
+    def _bulk_add_categories(self, names, chunk_size=1000):
+        categories = {}
+        if len(names) == 0:
+            return categories, 0
+
+        table = models.Category.__table__
+        q = sqla.select([table.c.name, table.c.id]).\
+          where(table.c.name.in_(names))
+        categories.update(self.session.execute(q).fetchall())
+
+        missing = [{'name': name} for name in names
+                   if name not in categories]
+        for chunk in chunked(missing, chunk_size):
+            q = table.insert().values(chunk).\
+              returning(table.c.name, table.c.id)
+            categories.update(self.session.execute(q).fetchall())
+        return categories, len(missing)
+
+    def import_items(self, fp, source, chunk_size=1000, progress=None):
+        """Stream a catalog JSON array from fp into the database.
+
+        Each chunk of chunk_size items is committed together with the
+        position reached in source, so a failed import resumes after
+        the last committed chunk when called again with the same source.
+        progress is called with the number of items committed so far.
+        Returns that number.  Each chunk is a transaction of its own,
+        retried as the retry policy allows.
+        """
+        state = import_progress_query(source).with_session(self.session).\
+          first()
+        done = 0 if state is None else state.position
+
+        chunk = []
+        for i, item in enumerate(jsonstream.iter_array(fp)):
+            if i < done:
+                continue
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                done = self._import_chunk(source, chunk, progress)
+                chunk = []
+
+        if len(chunk) > 0:
+            done = self._import_chunk(source, chunk, progress)
+
+        return done
+
+    def _import_chunk(self, source, chunk, progress):
+        done = self.transaction(self._import_chunk_items, source, chunk)
+        if progress is not None:
+            progress(done)
+        return done
+
+    def _import_chunk_items(self, source, chunk):
+        # the position is read again by each attempt, a rollback
+        # discards the one of the failed attempt
+        state = import_progress_query(source).with_session(self.session).\
+          first()
+        if state is None:
+            state = models.ImportProgress(source=source, position=0)
+            self.session.add(state)
+
+        self.bulk_add_items_with_stock(chunk)
+        state.position += len(chunk)
+        state.modification = datetime.datetime.utcnow()
+        self.session.flush()
+        return state.position
 
-        res = [item_to_json(*x) for x in q]
-        return res
+    def list_items(self, sort_key='description',
+                   ascending=True, page=1, page_size=10, cursor=None,
+                   result='dict'):
+        """List catalog items a page at a time.
+
+        With the default cursor=None pages are selected with page and
+        page_size.  Passing a cursor, '' for the first page, switches to
+        keyset pagination and the result becomes a dict of 'items' and
+        the 'cursor' of the following page (None after the last page).
+
+        With result='row' the items are ItemRow named tuples instead of
+        dicts.  result='json' returns the whole result serialized as
+        UTF-8 JSON bytes, built by the database.
+        """
+        check_result(result)
+        key = ('list_items', sort_key, ascending, page, page_size, cursor,
+               result)
+        return self._cached(key, lambda: self._list_items(
+            sort_key, ascending, page, page_size, cursor, result))
+
+    def _list_items(self, sort_key, ascending, page, page_size, cursor,
+                    result):
+        return self._item_page(('list_items',), items_query, {}, sort_key,
+                               ascending, page, page_size, cursor, result)
+
+    def _item_page(self, key, build, params, sort_key, ascending, page,
+                   page_size, cursor, result):
+        # build() and params as in _rows, the paging is added here
+        keys = sort_keys(sort_key, ascending)
+        paging, values = page_params(keys, page, page_size, cursor)
+        values.update(params)
+
+        as_json = result == 'json'
+        def build_page():
+            if as_json:
+                return json_page(build(), keys, paging, ItemRow._fields)
+            return page_limit(order_by_keys(build(), keys), keys, paging)
+
+        rows = self._rows(key + (sort_key, ascending, paging, as_json),
+                          build_page, values)
+        return page_result(rows, keys, page_size, cursor,
+                           lambda x: item_to_json(*x), result, ItemRow)
 
     def search_items(self, prefix, price_range, sort_key='description',
-                     ascending=True, page=1, page_size=10):
-        sq = self.session.query(models.Reservation.stock_item_id,
-                                func.sum(models.Reservation.count).\
-                                label('reserved')).\
-                                group_by(models.Reservation.stock_item_id).\
-                                subquery()
-
-        q = self.session.query(models.Item, models.Category,
-                               models.ItemCategory, models.StockItem,
-                               sq.c.reserved).\
-          with_entities(models.Item.code, models.Item.description,
-                        models.Category.name, models.StockItem.price,
-                        models.StockItem.count,
-                        sq.c.reserved).\
-          join(models.StockItem).\
-          join(models.ItemCategory,
-               models.Item.id == models.ItemCategory.item_id).\
-          join(models.Category,
-               models.Category.id == models.ItemCategory.category_id).\
-          filter(models.StockItem.price.between(*price_range),
-                 models.Item.description_lower.like('{:s}%'.format(prefix.lower())),
-                 models.ItemCategory.primary == True).\
-          outerjoin(sq, models.StockItem.id == sq.c.stock_item_id)
-
-        q = ordering(q, ascending, sort_key)
-        q = pagination(q, page, page_size)
-
-        res = [item_to_json(*x) for x in q]
-        return res
+                     ascending=True, page=1, page_size=10, cursor=None,
+                     result='dict'):
+        check_result(result)
+        params = {'pattern': prefix_pattern(prefix),
+                  'price_low': price_range[0], 'price_high': price_range[1]}
+        return self._item_page(('search_items',),
+                               lambda: search_query(prefix, price_range),
+                               params, sort_key, ascending, page, page_size,
+                               cursor, result)
+
+    def list_items_by_category(self, category, sort_key='description',
+                               ascending=True, price_range=None, prefix=None,
+                               page=1, page_size=10, cursor=None,
+                               result='dict'):
+        """List the items of a category, primary or not.
+
+        The options are as in search_items, price_range and prefix
+        filter only when given.  The 'category' of the items is the
+        listed category.
+        """
+        check_result(result)
+        key = ('list_items_by_category', category, sort_key, ascending,
+               price_range and tuple(price_range), prefix, page, page_size,
+               cursor, result)
+        params = {'category': category}
+        if price_range is not None:
+            params['price_low'], params['price_high'] = price_range
+        if prefix is not None:
+            params['pattern'] = prefix_pattern(prefix)
+        return self._cached(key, lambda: self._item_page(
+            ('list_items_by_category', price_range is None, prefix is None),
+            lambda: category_query(category, price_range, prefix), params,
+            sort_key, ascending, page, page_size, cursor, result))
+
+    def search_text(self, text, price_range=None, page=1, page_size=10,
+                    cursor=None, result='dict'):
+        """Full text search of the descriptions of items.
+
+        Items that contain all words of text, or words starting with
+        them, are listed by relevance.  Pages are selected and results
+        formatted as in list_items.
+        """
+        check_result(result)
+        q, keys = text_search_query(text, price_range, page, page_size,
+                                    cursor, as_json=result == 'json')
+        rows = q.with_session(self.session).all()
+        return page_result(rows, keys, page_size, cursor,
+                           lambda x: item_to_json(*x), result, ItemRow)
 
     def list_items_by_prices(self, prices, sort_key='price', prefix=None,
-                             ascending=True, page=1, page_size=10):
-        pgs = pg_cases(prices)
-        pg_case = sqla.case(pgs, else_ = -1).label('price_group')
-
-        sq = self.session.query(models.Reservation.stock_item_id,
-                                func.sum(models.Reservation.count).\
-                                label('reserved')).\
-                                group_by(models.Reservation.stock_item_id).\
-                                subquery()
-
-        q = self.session.query(models.Item, models.Category,
-                               models.ItemCategory, models.StockItem,
-                               sq.c.reserved).\
-                               with_entities(pg_case, models.Item.code,
-                                             models.Item.description,
-                                             models.Category.name,
-                                             models.StockItem.price,
-                                             models.StockItem.count,
-                                             sq.c.reserved)
-        if prefix is not None:
-            q = q.filter(models.Item.description_lower.like('{:s}%'.format(prefix.lower())))
+                             ascending=True, page=1, page_size=10,
+                             cursor=None, result='dict'):
+        """List catalog items grouped by the price definitions of prices.
+
+        With result='row' the items are PriceGroupRow named tuples,
+        otherwise as in list_items.
+        """
+        check_result(result)
+        key = ('list_items_by_prices', tuple(tuple(x) for x in prices),
+               sort_key, prefix, ascending, page, page_size, cursor, result)
+        return self._cached(key, lambda: self._list_items_by_prices(
+            prices, sort_key, prefix, ascending, page, page_size, cursor,
+            result))
+
+    def _list_items_by_prices(self, prices, sort_key, prefix, ascending,
+                              page, page_size, cursor, result):
+        q, keys = price_groups_query(prices, prefix, ascending, page,
+                                     page_size, cursor,
+                                     as_json=result == 'json')
+        rows = q.with_session(self.session).all()
+        return page_result(rows, keys, page_size, cursor, price_group_to_json,
+                           result, PriceGroupRow)
+
+    def export(self, fp, format='jsonl', batch_size=1000):
+        """Write all catalog items with stock to the text file fp.
+
+        format 'jsonl' writes each item as a JSON object on a line of
+        its own, with the fields of list_items.  'csv' writes a header
+        row and a row per item.  Items are in the order of their codes.
+        Rows are read from a server side cursor batch_size at a time, so
+        memory use does not grow with the catalog.  Returns the number
+        of items written.
+        """
+        q = items_query()
+        if format == 'jsonl':
+            cols = [x['expr'] for x in q.column_descriptions]
+            q = q.with_entities(json_object(ItemRow._fields, cols))
+            write = lambda row: fp.write(row[0] + '\n')
+        elif format == 'csv':
+            writer = csv.writer(fp)
+            writer.writerow(ItemRow._fields)
+            write = writer.writerow
+        else:
+            raise ValueError("Invalid format")
+
+        q = q.order_by(models.Item.code).with_session(self.session).\
+          yield_per(batch_size)
+        count = 0
+        for row in q:
+            write(row)
+            count += 1
+        return count
+
+    def facets_by_prices(self, prices, prefix=None):
+        """Counts of the items of list_items_by_prices.
+
+        Returns a dict of 'price_groups', a list of the counts of each
+        price definition, 'categories', a dict of counts by primary
+        category, and the 'total' count.  Cached like the listing.
+        """
+        key = ('facets_by_prices', tuple(tuple(x) for x in prices), prefix)
+        return self._cached(key, lambda: facets_result(
+            prices, facets_query(prices, prefix).with_session(self.session)),
+                            reserved=False)
+
+    def expire_baskets(self, idle, batch_size=100):
+        """Delete the baskets that have not been modified for idle
+        seconds, with their items and reservations.
+
+        Baskets are deleted batch_size at a time, each batch in a
+        transaction of its own that is committed.  Baskets that other
+        transactions have locked are left for the next run.  Returns the
+        numbers of deleted 'baskets', 'basket_items' and 'reservations'
+        and the 'units' of stock released.
+        """
+        cutoff = datetime.datetime.utcnow() - \
+          datetime.timedelta(seconds=idle)
+        res = {'baskets': 0, 'basket_items': 0, 'reservations': 0,
+               'units': 0}
+        while True:
+            batch = self.transaction(self._expire_batch, cutoff, batch_size)
+            for key, value in batch.items():
+                res[key] += value
+            if batch['baskets'] < batch_size:
+                return res
+
+    def _expire_batch(self, cutoff, batch_size):
+        q = stale_baskets_query(cutoff, batch_size).with_session(self.session)
+        ids = [x[0] for x in q]
+        res = {'baskets': len(ids), 'basket_items': 0, 'reservations': 0,
+               'units': 0}
+        if len(ids) == 0:
+            return res
 
-        q = q.join(models.StockItem.item).\
-          outerjoin(sq, models.StockItem.id == sq.c.stock_item_id).\
-          filter(models.ItemCategory.item_id == models.Item.id,
-                 models.ItemCategory.category_id == models.Category.id,
-                 models.ItemCategory.primary == True,
-                 pg_case >= 0)
-
-        q = pg_ordering(q, ascending)
-        q = pagination(q, page, page_size)
-        def to_dict(x):
-            tmp = item_to_json(*x[1:])
-            tmp.update({'price_group': x[0]})
-            return tmp
-        res = [to_dict(x) for x in q]
+        q = basket_contents_query(ids).with_session(self.session)
+        res['basket_items'], res['reservations'], res['units'] = q.one()
+        self.session.execute(release_baskets(ids))
+        self.session.execute(delete_baskets(ids))
+        self.session.expire_all()
+        self._changed(reserved_only=True)
         return res
 
     def _get_reservations(self, stock_id):
-        q = self.session.query(func.sum(models.Reservation.count)).\
-          filter(models.StockItem.id == stock_id).\
-          filter(models.StockItem.id == models.Reservation.stock_item_id)
+        q = self.session.query(models.StockItem.reserved).\
+          filter(models.StockItem.id == stock_id)
 
         res = q.first()
-        if res is None or res[0] is None:
+        if res is None:
             return 0
 
         return res[0]
@@ -379,157 +1866,512 @@ class Catalog(object):
         res = q.first()
         return res
 
-    @subtransaction
+    @subtransaction(changes='reserved')
     def _update_reservation(self, stock, basket_item):
-        reservations = self._get_reservations(basket_item.stock_item_id)
+        reservations = stock.reserved
         # can reserve (scount - reservations)
         reservation = self._get_reservation(basket_item.id)
 
         if reservation is not None:
             rcount = min(basket_item.count,
                          stock.count - reservations + reservation.count)
+            delta = rcount - reservation.count
             reservation.count = rcount
         else:
             rcount = min(basket_item.count, stock.count - reservations)
+            delta = rcount
             reservation = models.Reservation(stock_item=stock,
                                              basket_item=basket_item,
                                              count=rcount)
             self.session.add(reservation)
 
+        stock.reserved = models.StockItem.reserved + delta
+
+    @subtransaction(changes='reserved')
+    def _release_reservation(self, stock, basket_item):
+        reservation = self._get_reservation(basket_item.id)
+        if reservation is not None:
+            stock.reserved = models.StockItem.reserved - reservation.count
+            self.session.delete(reservation)
+
+    @subtransaction(changes='reserved')
+    def _release_baskets(self, basket_ids):
+        self.session.execute(release_baskets(basket_ids))
+        self.session.expire_all()
+
+    @subtransaction(changes=None)
+    def check_reservations(self, repair=False):
+        """Compare the reserved counts of stock items to their reservations.
+
+        Returns a list of the mismatches as dicts of 'code', 'reserved'
+        and 'actual'.  With repair=True the reserved counts are also
+        corrected.
+        """
+        sq = self.session.query(models.Reservation.stock_item_id,
+                                func.sum(models.Reservation.count).\
+                                label('reserved')).\
+          group_by(models.Reservation.stock_item_id).\
+          subquery()
+        actual = func.coalesce(sq.c.reserved, 0)
+
+        q = self.session.query(models.Item.code, models.StockItem.id,
+                               models.StockItem.reserved, actual).\
+          join(models.StockItem).\
+          outerjoin(sq, models.StockItem.id == sq.c.stock_item_id).\
+          filter(models.StockItem.reserved != actual).\
+          order_by(models.Item.code)
+        res = q.all()
+
+        if repair and len(res) > 0:
+            total = sqla.select([func.coalesce(func.sum(models.Reservation.count),
+                                               0)]).\
+              where(models.Reservation.stock_item_id == models.StockItem.id).\
+              as_scalar()
+            self.session.query(models.StockItem).\
+              filter(models.StockItem.id.in_([x[1] for x in res])).\
+              update({models.StockItem.reserved: total},
+                     synchronize_session=False)
+            self.session.expire_all()
+            self._changed(reserved_only=True)
+
+        return [{'code': x[0], 'reserved': x[2], 'actual': x[3]}
+                for x in res]
+
+# Adds count units of an item to a basket and reserves what is available
+# in a single statement.  The CTEs all see the same snapshot, so old is
+# the reservation as it was before the upserts.  For the locking
+# strategy the basket row is locked by a statement before this one, so
+# the snapshot has the latest reservation of the basket, and s locks the
+# stock item, at READ COMMITTED it then has the latest count and reserved
+# count, and the final update applies to them.
+_add_item_sql = """
+WITH s AS (
+    SELECT stock_items.id, stock_items.count, stock_items.reserved
+    FROM items JOIN stock_items ON items.id = stock_items.item_id
+    WHERE items.code = :code{lock:s}
+), old AS (
+    SELECT reservations.count
+    FROM basket_items
+    JOIN s ON basket_items.stock_item_id = s.id
+    JOIN reservations ON basket_items.id = reservations.basket_item_id
+    WHERE basket_items.basket_id = :basket_id
+), bi AS (
+    INSERT INTO basket_items (basket_id, stock_item_id, count,
+                              creation, modification)
+    SELECT :basket_id, s.id, :count, :now, :now FROM s
+    ON CONFLICT (basket_id, stock_item_id) DO UPDATE
+    SET count = basket_items.count + EXCLUDED.count,
+        modification = EXCLUDED.modification
+    RETURNING basket_items.id, basket_items.stock_item_id,
+              basket_items.count
+), want AS (
+    SELECT bi.id AS basket_item_id, bi.stock_item_id,
+           LEAST(bi.count, s.count - s.reserved +
+                 COALESCE((SELECT count FROM old), 0)) AS count,
+           COALESCE((SELECT count FROM old), 0) AS old_count
+    FROM bi JOIN s ON s.id = bi.stock_item_id
+), r AS (
+    INSERT INTO reservations (stock_item_id, basket_item_id, count,
+                              creation, modification)
+    SELECT want.stock_item_id, want.basket_item_id, want.count, :now, :now
+    FROM want
+    ON CONFLICT (stock_item_id, basket_item_id) DO UPDATE
+    SET count = EXCLUDED.count, modification = EXCLUDED.modification
+), touched AS (
+    UPDATE basket SET modification = :now WHERE id = :basket_id
+)
+UPDATE stock_items
+SET reserved = stock_items.reserved + want.count - want.old_count
+FROM want
+WHERE stock_items.id = want.stock_item_id
+RETURNING want.basket_item_id, want.count
+"""
+_add_item_sql = {
+    'serializable': sqla.text(_add_item_sql.format(lock='')),
+    'locking': sqla.text(_add_item_sql.format(
+        lock='\n    FOR UPDATE OF stock_items'))}
+
+# Sets the stock of many codes at once, the rows come as arrays of
+# codes, counts and prices.  Returns the ids of the updated stock items,
+# the number of inserted ones, the codes that are not in the catalog and
+# the ids of the updated stock items whose price changed.
+_update_stocks_sql = """
+WITH v AS (
+    SELECT v.code, v.count, v.price, items.id AS item_id
+    FROM unnest(CAST(:codes AS TEXT[]), CAST(:counts AS INTEGER[]),
+                CAST(:prices AS NUMERIC[])) AS v(code, count, price)
+    LEFT JOIN items ON items.code = v.code
+), updated AS (
+    UPDATE stock_items
+    SET count = {count:s}, price = v.price, modification = :now
+    FROM v, stock_items AS old
+    WHERE stock_items.item_id = v.item_id AND old.id = stock_items.id
+    RETURNING stock_items.id, old.price <> v.price AS repriced
+), inserted AS (
+    INSERT INTO stock_items (item_id, count, reserved, price, visible,
+                             modification)
+    SELECT v.item_id, v.count, 0, v.price, TRUE, :now
+    FROM v
+    WHERE v.item_id IS NOT NULL AND
+          NOT EXISTS (SELECT 1 FROM stock_items
+                      WHERE stock_items.item_id = v.item_id)
+    RETURNING stock_items.item_id
+)
+SELECT ARRAY(SELECT updated.id FROM updated),
+       (SELECT count(*) FROM inserted),
+       ARRAY(SELECT v.code FROM v WHERE v.item_id IS NULL),
+       ARRAY(SELECT updated.id FROM updated WHERE updated.repriced)
+"""
+_update_stocks_sql = {
+    'absolute': sqla.text(_update_stocks_sql.format(count='v.count')),
+    'delta': sqla.text(_update_stocks_sql.format(
+        count='stock_items.count + v.count'))}
+
+# Locks the stock items of the array of :codes in the order of their ids,
+# as lock_stock_query does for short lists
+_lock_stocks_sql = sqla.text("""
+SELECT stock_items.id
+FROM stock_items JOIN items ON items.id = stock_items.item_id
+WHERE items.code = ANY(CAST(:codes AS TEXT[]))
+ORDER BY stock_items.id
+FOR UPDATE OF stock_items
+""")
+
+# Reallocates the stock of the stock items of :ids to their basket
+# items, first come first served.  The window sums the counts of the
+# basket items created before each one, only the reservations that
+# change are written.  Returns the number of changed reservations.
+_rebalance_sql = sqla.text("""
+WITH s AS (
+    SELECT stock_items.id, stock_items.count
+    FROM stock_items
+    WHERE stock_items.id = ANY(CAST(:ids AS INTEGER[]))
+), alloc AS (
+    SELECT basket_items.id AS basket_item_id, basket_items.stock_item_id,
+           LEAST(basket_items.count,
+                 GREATEST(0, s.count + basket_items.count -
+                          SUM(basket_items.count) OVER w)) AS count
+    FROM s JOIN basket_items ON basket_items.stock_item_id = s.id
+    WINDOW w AS (PARTITION BY basket_items.stock_item_id
+                 ORDER BY basket_items.creation, basket_items.id
+                 ROWS UNBOUNDED PRECEDING)
+), changed AS (
+    INSERT INTO reservations (stock_item_id, basket_item_id, count,
+                              creation, modification)
+    SELECT alloc.stock_item_id, alloc.basket_item_id, alloc.count, :now, :now
+    FROM alloc
+    LEFT JOIN reservations
+    ON reservations.stock_item_id = alloc.stock_item_id AND
+       reservations.basket_item_id = alloc.basket_item_id
+    WHERE reservations.count IS DISTINCT FROM alloc.count
+    ON CONFLICT (stock_item_id, basket_item_id) DO UPDATE
+    SET count = EXCLUDED.count, modification = EXCLUDED.modification
+    RETURNING reservations.basket_item_id
+), totals AS (
+    SELECT s.id, COALESCE(SUM(alloc.count), 0) AS reserved
+    FROM s LEFT JOIN alloc ON alloc.stock_item_id = s.id
+    GROUP BY s.id
+), updated AS (
+    UPDATE stock_items
+    SET reserved = totals.reserved
+    FROM totals
+    WHERE stock_items.id = totals.id AND
+          stock_items.reserved <> totals.reserved
+)
+SELECT (SELECT count(*) FROM changed),
+       ARRAY(SELECT DISTINCT basket_items.basket_id
+             FROM changed
+             JOIN basket_items ON basket_items.id = changed.basket_item_id)
+""")
+
+# Recomputes the totals of baskets, of :ids or of the baskets with any of
+# the stock items of :ids.  Only the baskets whose totals change are
+# written.
+_basket_totals_sql = """
+WITH t AS (
+    SELECT basket.id, count(basket_items.id) AS lines,
+           COALESCE(SUM(basket_items.count), 0) AS units,
+           COALESCE(SUM(basket_items.count * stock_items.price),
+                    0) AS value,
+           COALESCE(SUM(reservations.count * stock_items.price),
+                    0) AS reserved_value
+    FROM basket
+    LEFT JOIN basket_items ON basket_items.basket_id = basket.id
+    LEFT JOIN stock_items ON stock_items.id = basket_items.stock_item_id
+    LEFT JOIN reservations
+    ON reservations.basket_item_id = basket_items.id
+    WHERE {where:s}
+    GROUP BY basket.id
+)
+UPDATE basket
+SET lines = t.lines, units = t.units, value = t.value,
+    reserved_value = t.reserved_value
+FROM t
+WHERE basket.id = t.id AND
+      (basket.lines, basket.units, basket.value, basket.reserved_value)
+      IS DISTINCT FROM (t.lines, t.units, t.value, t.reserved_value)
+"""
+_basket_totals_sql = {
+    'baskets': sqla.text(_basket_totals_sql.format(
+        where='basket.id = ANY(CAST(:ids AS INTEGER[]))')),
+    'stock': sqla.text(_basket_totals_sql.format(
+        where="""basket.id IN (
+        SELECT basket_items.basket_id FROM basket_items
+        WHERE basket_items.stock_item_id = ANY(CAST(:ids AS INTEGER[])))"""))}
+
+# Turns the reservations of a basket into an order and empties the
+# basket.  The reserved units leave the stock, the guard makes sure that
+# the stock still covers all reservations.  Returns a row for each
+# order line, and the number of stock items updated in each.
+_checkout_sql = sqla.text("""
+WITH lines AS (
+    SELECT basket_items.stock_item_id, items.code, reservations.count,
+           stock_items.price
+    FROM basket_items
+    JOIN reservations ON basket_items.id = reservations.basket_item_id
+    JOIN stock_items ON stock_items.id = basket_items.stock_item_id
+    JOIN items ON items.id = stock_items.item_id
+    WHERE basket_items.basket_id = :basket_id AND reservations.count > 0
+), o AS (
+    INSERT INTO orders (session, creation)
+    SELECT basket.session, :now
+    FROM basket
+    WHERE basket.id = :basket_id AND EXISTS (SELECT 1 FROM lines)
+    RETURNING orders.id
+), ol AS (
+    INSERT INTO order_lines (order_id, stock_item_id, count, price)
+    SELECT o.id, lines.stock_item_id, lines.count, lines.price
+    FROM o, lines
+), sold AS (
+    UPDATE stock_items
+    SET count = stock_items.count - lines.count,
+        reserved = stock_items.reserved - lines.count,
+        modification = :now
+    FROM lines
+    WHERE stock_items.id = lines.stock_item_id AND
+          stock_items.count >= stock_items.reserved
+    RETURNING stock_items.id
+), emptied AS (
+    DELETE FROM basket_items WHERE basket_items.basket_id = :basket_id
+)
+SELECT o.id, lines.code, lines.count, lines.price,
+       (SELECT count(*) FROM sold)
+FROM o, lines
+ORDER BY lines.code
+""")
+
 class Basket(object):
     def __init__(self, catalog, basket_id):
         self.catalog = catalog
-        self.session = catalog.session
         self.id = basket_id
 
+    @property
+    def session(self):
+        return self.catalog.session
+
+    def _changed(self, reserved_only=True):
+        self.catalog._changed(reserved_only=True)
+
     @staticmethod
     def get(catalog, basket_id):
-        q = catalog.session.query(models.Basket).\
-            filter(models.Basket.session == basket_id)
-        res = q.first()
-        if res is None:
+        rows = catalog._rows(('basket',),
+                             lambda: basket_query(None).limit(1),
+                             {'session_id': basket_id})
+        if len(rows) == 0:
             return None
 
-        return Basket(catalog, res.id)
+        return Basket(catalog, rows[0][0])
 
     @staticmethod
     def create(catalog, basket_id):
-        session = catalog.session
+        basket = Basket(catalog, None)
+        basket._create(basket_id)
+        return basket
 
-        session.begin(subtransactions=True)
-        basket = models.Basket(session=basket_id)
-        session.add(basket)
-        session.flush()
-        session.refresh(basket)
-
-        session.commit()
-        return Basket(catalog, basket.id)
+    @subtransaction
+    def _create(self, session_id):
+        basket = models.Basket(session=session_id)
+        self.session.add(basket)
+        self.session.flush()
+        self.session.refresh(basket)
+        self.id = basket.id
 
     @subtransaction
     def add_item(self, code, count):
-        item = self.catalog.get_item(code, as_object=True)
-        if item is None:
-            raise ValueError('Unknown code')
-
-        stock = self.catalog.get_stock(item.code, as_object=True)
-        if stock is None:
+        # pending changes must reach the database before the statement
+        self.session.flush()
+        now = datetime.datetime.utcnow()
+        if self.catalog.reservation == 'locking':
+            # the basket before the stock, as in the other changes
+            self.session.execute(touch_basket(self.id, now))
+        res = self.session.execute(_add_item_sql[self.catalog.reservation],
+                                   {'code': code, 'count': count,
+                                    'basket_id': self.id, 'now': now})
+        row = res.first()
+        self.catalog._update_totals('baskets', [self.id])
+        # rows changed behind the back of the ORM
+        self.session.expire_all()
+
+        if row is None:
+            if self.catalog.get_item(code) is None:
+                raise ValueError('Unknown code')
             raise ValueError('Not in stock')
 
-        # Need to check if already in basket
-        basket_item = self.get_item(stock.id)
-        if basket_item is None:
-            basket_item = models.BasketItem(basket_id=self.id,
-                                            stock_item=stock,
-                                            count=count)
-            self.session.add(basket_item)
-            self.session.flush()
-            self.session.refresh(basket_item)
-        else:
-            basket_item.count += count
+    @subtransaction
+    def add_items(self, lines):
+        """Add a list of (code, count) pairs to the basket.
 
-        self.catalog._update_reservation(stock, basket_item)
+        Items and stock are looked up and the basket items, reservations
+        and reserved counts are written with one statement each.  Returns
+        a dict for each line with the 'code', a 'status' of 'ok',
+        'unknown code' or 'not in stock', and the 'count' and 'reserved'
+        count of the item in the basket after the change.
+        """
+        return self._apply_items(lines, relative=True)
 
     @subtransaction
-    def update_item_count(self, code, count):
-        item = self.catalog.get_item(code, as_object=True)
-        if item is None:
-            raise ValueError('Unknown item code')
+    def set_items(self, lines):
+        """Like add_items, but sets the counts.  Zero removes the item."""
+        return self._apply_items(lines, relative=False)
+
+    def _apply_items(self, lines, relative):
+        counts = line_counts(lines, relative)
+        if len(counts) == 0:
+            return []
+
+        self.session.flush()
+        now = datetime.datetime.utcnow()
+        self.session.execute(touch_basket(self.id, now))
+        self.catalog._lock_stock(codes=counts)
+        q = basket_lines_query(self.id, counts).with_session(self.session)
+        found = dict((x[0], x[1:]) for x in q)
+        results, upserts, removed, deltas = plan_basket_lines(
+            counts, found, relative)
+
+        if len(upserts) > 0:
+            q = upsert_basket_items(self.id, upserts, now)
+            basket_items = dict(self.session.execute(q).fetchall())
+            self.session.execute(upsert_reservations(upserts, basket_items,
+                                                     now))
+
+        if len(removed) > 0:
+            self.session.execute(delete_basket_items(removed))
+
+        if len(deltas) > 0:
+            self.session.execute(update_reserved(deltas))
+
+        self.catalog._update_totals('baskets', [self.id])
+        self.session.expire_all()
+        return [dict(results[code]) for code, count in lines]
 
-        stock = self.catalog.get_stock(item.code, as_object=True)
+    @subtransaction
+    def update_item_count(self, code, count):
+        # plain tuples, these may come from the cache
+        stock = self.catalog.get_stock(code)
         if stock is None:
-            raise ValueError('Item {:s} not in stock'.format(item.code))
+            if self.catalog.get_item(code) is None:
+                raise ValueError('Unknown item code')
+            raise ValueError('Item {:s} not in stock'.format(code))
 
-        basket_item = self.get_item(stock.id)
+        basket_item = self.get_item(stock[0])
         if basket_item is None:
-            raise ValueError('Item {:s} not in basket'.format(item.code))
+            raise ValueError('Item {:s} not in basket'.format(code))
+
+        self.session.execute(touch_basket(self.id,
+                                          datetime.datetime.utcnow()))
+        self.catalog._lock_stock(codes=[code])
+        stock = basket_item.stock_item
 
         if count == 0:
+            self.catalog._release_reservation(stock, basket_item)
             self.session.delete(basket_item)
-            # Reservations are automatically deleted (on delete cascade)
-            return
+        else:
+            basket_item.count = count
+            self.catalog._update_reservation(stock, basket_item)
 
-        basket_item.count = count
-        self.catalog._update_reservation(stock, basket_item)
+        self.session.flush()
+        self.catalog._update_totals('baskets', [self.id])
 
     def remove_item(self, code):
         return self.update_item_count(code, 0)
 
     def get_item(self, stock_id):
-        q = self.session.query(models.StockItem, models.Basket,
-                                  models.BasketItem).\
-          with_entities(models.BasketItem).\
-                  filter(models.StockItem.id == stock_id).\
-                  filter(models.Basket.id == self.id).\
-                  filter(models.Basket.id == models.BasketItem.basket_id).\
-                  filter(models.StockItem.id == models.BasketItem.stock_item_id)
-        res = q.first()
+        q = self.catalog._baked(('basket_item',),
+                                lambda: basket_item_query(None, None))
+        return q.params(basket_id=self.id, stock_id=stock_id).first()
+
+    @subtransaction
+    def delete(self):
+        if self.catalog.reservation == 'locking':
+            # the basket before the stock, as in the other changes
+            self.session.execute(touch_basket(
+                self.id, datetime.datetime.utcnow()))
+            self.catalog._lock_stock(basket_id=self.id)
+        self.catalog._release_baskets([self.id])
+        self.session.query(models.Basket).\
+          filter(models.Basket.id == self.id).\
+          delete(synchronize_session=False)
+        # Basket items and reservations are deleted by the cascades
+
+    @subtransaction
+    def checkout(self):
+        """Order the reserved units of the items of the basket.
+
+        The order and its lines are written, the units are taken from
+        the stock and the basket is emptied, all with one statement.
+        Units in the basket that were not reserved are not ordered.
+        Returns a dict of the 'order' id, its 'lines' as dicts of
+        'code', 'count' and unit 'price', and the 'total' price.
+        Raises ValueError when nothing is reserved, or when the stock of
+        an item no longer covers its reservations.
+        """
+        self.session.flush()
+        now = datetime.datetime.utcnow()
+        if self.catalog.reservation == 'locking':
+            self.session.execute(touch_basket(self.id, now))
+            self.catalog._lock_stock(basket_id=self.id)
+        rows = self.session.execute(_checkout_sql, {'basket_id': self.id,
+                                                    'now': now}).fetchall()
+        res = checkout_result(rows)
+        self.catalog._update_totals('baskets', [self.id])
+
+        # rows changed behind the back of the ORM
+        self.session.expire_all()
+        self.catalog._invalidate([x['code'] for x in res['lines']])
+        self.catalog._changed()
         return res
 
-    # def get_total -- return value of the basket
+    def get_total(self, prices=None):
+        """Totals of the basket: the number of 'lines', the 'units' of
+        all lines, and the 'value' and 'reserved_value' of the units at
+        the current prices.
+
+        The totals are kept on the basket row, so this is one lookup by
+        the primary key.  With a list of price definitions as prices,
+        as in list_items_by_prices, 'price_groups' has the totals of
+        each price group too, those are summed from the basket items.
+        """
+        rows = self.catalog._rows(('basket_total',),
+                                  lambda: basket_total_query(None),
+                                  {'basket_id': self.id})
+        if len(rows) == 0:
+            return None
+        if prices is None:
+            return basket_total_to_json(rows[0])
+
+        q = basket_totals_query(self.id, prices).with_session(self.session)
+        return basket_totals_result(prices, rows[0], q.all())
 
     def list_items(self, sort_key='description', ascending=True):
-        q = self.session.query(
-            models.Item, models.StockItem, models.Basket,
-            models.BasketItem, models.Reservation).\
-            with_entities(models.Item.code, models.Item.description,
-                          models.StockItem.price, models.BasketItem.count,
-                          models.Reservation.count).\
-            filter(models.Basket.id == self.id,
-                   models.Basket.id == models.BasketItem.basket_id,
-                   models.StockItem.id == models.BasketItem.stock_item_id,
-                   models.Item.id == models.StockItem.item_id,
-                   models.BasketItem.id == models.Reservation.basket_item_id)
-        q = ordering(q, ascending, sort_key)
-        def to_dict(x):
-            return { 'code': x[0], 'description': x[1], 'price': x[2],
-                     'count': x[3], 'reserved': x[4] }
-        res = [to_dict(x) for x in q]
-        return res
+        q = basket_items_query(self.id, sort_key, ascending).\
+          with_session(self.session)
+        return [basket_item_to_json(x) for x in q]
 
     def list_items_by_prices(self, prices, sort_key='price', prefix=None,
                              ascending=True):
-        cases = pg_cases(prices)
-        pg_case = sqla.case(cases, else_ = -1).label('price_group')
-
-        q = self.session.query(
-            models.Item, models.StockItem, models.Basket,
-            models.BasketItem, models.Reservation).\
-            with_entities(pg_case, models.Item.code,
-                          models.Item.description, models.StockItem.price,
-                          models.StockItem.count, models.BasketItem.count,
-                          models.Reservation.count).\
-            join(models.Basket.basket_items).\
-            join(models.Item.stock_item).\
-            filter(models.Basket.id == self.id,
-                   models.StockItem.id == models.BasketItem.stock_item_id,
-                   models.BasketItem.id == models.Reservation.basket_item_id,
-                   pg_case >= 0)
-        q = pg_ordering(q, ascending)
-        def to_dict(x):
-            return { 'price_group': x[0], 'code': x[1], 'description': x[2],
-                     'price': x[3], 'count': x[4], 'reserved': x[5] }
-        res = [to_dict(x) for x in q]
-        return res
+        q = basket_price_groups_query(self.id, prices, ascending).\
+          with_session(self.session)
+        return [basket_price_group_to_json(x) for x in q]
 
     def dump(self, fp):
         items = self.list_items()
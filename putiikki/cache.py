@@ -0,0 +1,92 @@
+# coding: utf8
+#
+
+"""In-process caches for catalog data"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import threading
+import time
+
+__all__ = ['LRUCache']
+
+class LRUCache(object):
+    """Thread safe mapping limited to size entries of at most ttl seconds.
+
+    The least recently used entry is dropped when the cache is full.
+    ttl=None keeps entries until they are invalidated or dropped.
+    """
+    def __init__(self, size, ttl=None, clock=time.monotonic):
+        if size < 1:
+            raise ValueError("Invalid cache size")
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None, valid=None):
+        """Value of key, or default.  An entry for which valid(value) is
+        false is left in the cache but counted as a miss."""
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= self.clock():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            if valid is not None and not valid(value):
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock() + self.ttl
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': self.size, 'entries': len(self._data),
+                'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,111 @@
+# coding: utf8
+#
+
+"""Incremental parsing of large JSON documents"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import re
+
+__all__ = ['iter_array']
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_number_tail = re.compile(r'[0-9.eE+-]*')
+
+# an error this far before the end of the data read so far is not
+# fixed by reading more, as the end of a cut literal or number would be
+_LOOKAHEAD = 16
+
+def iter_array(fp, buffer_size=65536, max_element_size=16 * 1024 * 1024):
+    """Yield the elements of a top level JSON array one at a time.
+
+    Only the element being decoded is kept in memory, fp is read in
+    blocks of buffer_size characters.  A malformed element, or one
+    longer than max_element_size characters, raises ValueError with its
+    offset in fp as soon as that is known.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    # offset of buf in fp
+    offset = 0
+    eof = False
+    expect = 'start'
+
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        if pos == len(buf) or expect == 'more':
+            data = '' if eof else fp.read(buffer_size)
+            if not data:
+                if expect == 'more':
+                    eof = True
+                    expect = 'value'
+                    continue
+                raise ValueError('Unexpected end of JSON array')
+            offset += pos
+            buf = buf[pos:] + data
+            pos = 0
+            if expect == 'more':
+                expect = 'value'
+            continue
+
+        c = buf[pos]
+        if expect == 'start':
+            if c != '[':
+                raise ValueError('Expected a JSON array')
+            pos += 1
+            expect = 'first'
+            continue
+        elif expect in ('first', 'next'):
+            if c == ']':
+                return
+            if expect == 'next':
+                if c != ',':
+                    raise ValueError('Expected , or ] at {:d}'.format(
+                        offset + pos))
+                pos += 1
+                expect = 'value'
+                continue
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError as exc:
+            if eof:
+                raise
+            error = getattr(exc, 'pos', len(buf))
+            if not exc.args[0].startswith('Unterminated string') and \
+              error + _LOOKAHEAD < len(buf):
+                raise ValueError('Malformed JSON element at {:d}: {:s}'.\
+                                 format(offset + pos, exc.args[0]))
+            if len(buf) - pos > max_element_size:
+                raise ValueError('JSON element at {:d} is longer than {:d} '
+                                 'characters'.format(offset + pos,
+                                                     max_element_size))
+            # element continues in the next block
+            expect = 'more'
+            continue
+
+        if isinstance(obj, (int, float)) and not eof and \
+          _number_tail.match(buf, end).end() == len(buf):
+            # the number may continue in the next block
+            expect = 'more'
+            continue
+
+        yield obj
+        pos = end
+        expect = 'next'
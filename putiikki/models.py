@@ -20,8 +20,9 @@
 #
 import sqlalchemy as sqla
 from sqlalchemy import Column, Boolean, DateTime, Integer, Numeric, String, \
-    CheckConstraint, ForeignKey, UniqueConstraint, TEXT, Table
+    CheckConstraint, ForeignKey, Index, UniqueConstraint, TEXT, Table
 
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
 
@@ -29,6 +30,17 @@ import datetime
 
 Base = declarative_base()
 
+# text search configuration of the full text index of items, simple
+# does not stem, the descriptions are in many languages
+TEXT_SEARCH_CONFIG = 'simple'
+
+def item_document(description, long_description):
+    """tsvector of the descriptions of an item, stored in Item.document"""
+    return sqla.func.to_tsvector(
+        sqla.literal_column("'{:s}'".format(TEXT_SEARCH_CONFIG)),
+        description + sqla.literal_column("' '") + \
+        sqla.func.coalesce(long_description, sqla.literal_column("''")))
+
 class Item(Base):
     __tablename__ = 'items'
 
@@ -40,6 +52,8 @@ class Item(Base):
     description = Column(TEXT, nullable=False, index=True)
     description_lower = Column(TEXT, nullable=False, index=True)
     long_description = Column(TEXT, nullable=True)
+    # item_document() of the descriptions, kept up to date with them
+    document = Column(TSVECTOR, nullable=True)
     categories = relationship('ItemCategory')
 
     stock_item = relationship('StockItem', uselist=False,
@@ -47,7 +61,18 @@ class Item(Base):
 
     __table_args__ = (CheckConstraint('char_length(code) >= 4'),
                       CheckConstraint('char_length(description) >= 4'),
-                      CheckConstraint('char_length(description_lower) >= 4'),)
+                      CheckConstraint('char_length(description_lower) >= 4'),
+                      # keyset pagination seeks on (sort key, id)
+                      Index('ix_items_description_lower_id',
+                            'description_lower', 'id'),
+                      # LIKE 'prefix%' can not use the index above
+                      # unless the collation is C
+                      Index('ix_items_description_lower_pattern',
+                            'description_lower',
+                            postgresql_ops={'description_lower':
+                                            'text_pattern_ops'}),
+                      Index('ix_items_document', 'document',
+                            postgresql_using='gin'),)
 
 class Category(Base):
     __tablename__ = 'categories'
@@ -72,7 +97,10 @@ class ItemCategory(Base):
     item = relationship("Item")
     category = relationship("Category")
 
-    __table_args__ = (UniqueConstraint('item_id', 'category_id'),)
+    __table_args__ = (UniqueConstraint('item_id', 'category_id'),
+                      # listings of a category
+                      Index('ix_item_categories_category_id_item_id',
+                            'category_id', 'item_id'),)
 
 class StockItem(Base):
     __tablename__ = 'stock_items'
@@ -82,6 +110,8 @@ class StockItem(Base):
                                 onupdate="CASCADE", ondelete="RESTRICT"),
                      nullable=False, unique=True)
     count = Column(Integer, nullable=False)
+    # sum of the reservations, maintained along with them
+    reserved = Column(Integer, default=0, nullable=False)
     price = Column(Numeric(12,2), nullable=False, index=True)
     visible = Column(Boolean, default=True, nullable=False)
 
@@ -93,7 +123,9 @@ class StockItem(Base):
     reservation = relationship("Reservation", back_populates="stock_item")
 
     __table_args__ = (CheckConstraint('count >= 0'),
-                      CheckConstraint('price >= 0.0'), )
+                      CheckConstraint('reserved >= 0'),
+                      CheckConstraint('price >= 0.0'),
+                      Index('ix_stock_items_price_item_id', 'price', 'item_id'),)
 
 class Basket(Base):
     __tablename__ = 'basket'
@@ -106,8 +138,18 @@ class Basket(Base):
     modification = Column(DateTime, default=datetime.datetime.utcnow,
                           nullable=False)
 
+    # totals of the basket items, updated along with them and with the
+    # prices and reservations of their stock items
+    lines = Column(Integer, default=0, nullable=False)
+    units = Column(Integer, default=0, nullable=False)
+    value = Column(Numeric(14,2), default=0, nullable=False)
+    reserved_value = Column(Numeric(14,2), default=0, nullable=False)
+
     basket_items = relationship("BasketItem", back_populates="basket")
 
+    # expiry finds the baskets idle the longest
+    __table_args__ = (Index('ix_basket_modification', 'modification'),)
+
 class BasketItem(Base):
     __tablename__ = 'basket_items'
     id = Column(Integer, primary_key=True)
@@ -132,7 +174,11 @@ class BasketItem(Base):
     stock_item = relationship("StockItem", back_populates="basket_item")
 
     __table_args__ = (CheckConstraint('count >= 0'),
-                      UniqueConstraint('basket_id', 'stock_item_id'))
+                      UniqueConstraint('basket_id', 'stock_item_id'),
+                      # rebalancing goes through the basket items of a
+                      # stock item first come first served
+                      Index('ix_basket_items_stock_item_id_creation_id',
+                            'stock_item_id', 'creation', 'id'))
 
 class Reservation(Base):
     __tablename__ = 'reservations'
@@ -156,7 +202,59 @@ class Reservation(Base):
     stock_item = relationship("StockItem", back_populates="reservation")
 
     __table_args__ = (CheckConstraint('count >= 0'),
-                      UniqueConstraint('stock_item_id', 'basket_item_id'))
+                      UniqueConstraint('stock_item_id', 'basket_item_id'),
+                      # the cascade from deleted basket items
+                      Index('ix_reservations_basket_item_id',
+                            'basket_item_id'))
+
+class Order(Base):
+    __tablename__ = 'orders'
+    id = Column(Integer, primary_key=True)
+    # session of the basket that was checked out
+    session = Column(TEXT, nullable=False)
+
+    creation = Column(DateTime, default=datetime.datetime.utcnow,
+                      nullable=False)
+
+    order_lines = relationship("OrderLine", back_populates="order")
+
+class OrderLine(Base):
+    __tablename__ = 'order_lines'
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer,
+                      ForeignKey("orders.id",
+                                 onupdate="CASCADE", ondelete="CASCADE"),
+                      nullable=False)
+    stock_item_id = Column(Integer,
+                           ForeignKey("stock_items.id",
+                                      onupdate="CASCADE", ondelete="RESTRICT"),
+                           nullable=False)
+    count = Column(Integer, nullable=False)
+    # unit price at the time of the checkout
+    price = Column(Numeric(12,2), nullable=False)
+
+    order = relationship("Order", back_populates="order_lines")
+    stock_item = relationship("StockItem")
+
+    __table_args__ = (CheckConstraint('count > 0'),
+                      CheckConstraint('price >= 0.0'),
+                      UniqueConstraint('order_id', 'stock_item_id'),
+                      # deletes of stock items check the order lines
+                      Index('ix_order_lines_stock_item_id',
+                            'stock_item_id'))
+
+class ImportProgress(Base):
+    __tablename__ = 'import_progress'
+    id = Column(Integer, primary_key=True)
+    # name of the imported feed, e.g. file name
+    source = Column(TEXT, nullable=False, unique=True)
+    # number of items committed so far
+    position = Column(Integer, default=0, nullable=False)
+
+    modification = Column(DateTime, default=datetime.datetime.utcnow,
+                          nullable=False)
+
+    __table_args__ = (CheckConstraint('position >= 0'),)
 
 def create_tables(engine):
     Base.metadata.create_all(engine)
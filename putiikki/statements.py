@@ -0,0 +1,127 @@
+# coding: utf8
+#
+
+"""Statements compiled for PostgreSQL with $n parameters
+
+These are what asyncpg takes, and what PREPARE takes for server side
+prepared statements.
+"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import collections
+import hashlib
+import re
+import threading
+
+import sqlalchemy as sqla
+
+from sqlalchemy.dialects.postgresql.base import PGCompiler, PGDialect
+from sqlalchemy.orm import Query
+
+__all__ = ['compile_statement', 'statement_args', 'PreparedStatements']
+
+class _Compiler(PGCompiler):
+    def visit_bindparam(self, bindparam, **kw):
+        text = super(_Compiler, self).visit_bindparam(bindparam, **kw)
+        # prepared statements get the types of parameters from their
+        # context, and PostgreSQL infers text where there is none,
+        # e.g. the results of CASE
+        if isinstance(bindparam.type, sqla.Integer) and \
+          not kw.get('literal_binds') and not bindparam.expanding:
+            text = '{:s}::{:s}'.format(
+                text, self.dialect.type_compiler.process(bindparam.type))
+        return text
+
+    def _apply_numbered_params(self):
+        # $1, $2, ... instead of :1, :2, ...  A parameter keeps its
+        # number where it is repeated, so that e.g. the same expression
+        # in SELECT and GROUP BY stays the same.  This overrides a
+        # private method of the SQLAlchemy 1.2 compiler and relies on
+        # its [_POSITION] placeholders, setup.py pins the version.
+        numbers = collections.OrderedDict()
+        for name in self.positiontup:
+            numbers.setdefault(name, len(numbers) + 1)
+        names = iter(self.positiontup)
+        self.string = re.sub(r':\[_POSITION\]',
+                             lambda m: '${:d}'.format(numbers[next(names)]),
+                             self.string)
+        self.positiontup = list(numbers)
+
+class _Dialect(PGDialect):
+    statement_compiler = _Compiler
+
+_dialect = _Dialect(paramstyle='numeric')
+
+def compile_statement(stmt):
+    """Compiled form of a statement or Query, its string has $n
+    parameters.
+    """
+    if isinstance(stmt, Query):
+        # rows are read by position, labels keep same named columns apart
+        stmt = stmt.with_labels().statement
+    return stmt.compile(dialect=_dialect)
+
+def statement_args(compiled, params=None):
+    """Positional arguments of a compiled statement, params override
+    the values of its named bind parameters.
+    """
+    values = compiled.construct_params(params)
+    return [values[name] for name in compiled.positiontup]
+
+class PreparedStatements(object):
+    """Server side prepared statements of queries, by key.
+
+    A query is built and compiled the first time its key is seen, and
+    prepared on a connection the first time it is run there.  The
+    prepared statements last as long as the connections.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statements = {}
+
+    def __len__(self):
+        return len(self._statements)
+
+    def _statement(self, key, build):
+        with self._lock:
+            entry = self._statements.get(key)
+        if entry is not None:
+            return entry
+
+        compiled = compile_statement(build())
+        # named by the SQL, other instances may share the connection
+        digest = hashlib.sha1(compiled.string.encode('utf8')).hexdigest()
+        entry = ('putiikki_{:s}'.format(digest[:20]), compiled)
+        with self._lock:
+            return self._statements.setdefault(key, entry)
+
+    def fetch(self, conn, key, build, params):
+        """Rows of the query build() returns, with params as the values
+        of its bind parameters.  conn is a SQLAlchemy Connection.
+        """
+        name, compiled = self._statement(key, build)
+        prepared = conn.info.setdefault('prepared_statements', set())
+        if name not in prepared:
+            conn.execute('PREPARE {:s} AS {:s}'.format(name, compiled.string))
+            prepared.add(name)
+
+        args = statement_args(compiled, params)
+        if len(args) == 0:
+            return conn.execute('EXECUTE {:s}'.format(name)).fetchall()
+        sql = 'EXECUTE {:s} ({:s})'.format(name, ', '.join(['%s'] * len(args)))
+        return conn.execute(sql, tuple(args)).fetchall()
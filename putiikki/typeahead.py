@@ -0,0 +1,85 @@
+# coding: utf8
+#
+
+"""In-process prefix index of item descriptions for autocompletion"""
+
+# Copyright (c) 2016 Jani J. Hakala <jjhakala@gmail.com> Jyväskylä, Finland
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, version 3 of the
+#  License.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bisect
+import threading
+
+__all__ = ['TypeaheadIndex']
+
+class TypeaheadIndex(object):
+    """Thread safe prefix index of item descriptions.
+
+    Entries are kept in a list sorted by lower case description and
+    code, the first match of a prefix is found with bisect.
+    """
+    def __init__(self, items=()):
+        self._lock = threading.Lock()
+        self._codes = {}
+        self._entries = []
+        self.load(items)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, items):
+        """Replace the entries with the (code, description) pairs of items"""
+        codes = {}
+        for code, description in items:
+            codes[code] = (description.lower(), code, description)
+        entries = sorted(codes.values())
+
+        with self._lock:
+            self._codes = codes
+            self._entries = entries
+
+    def add(self, code, description):
+        """Add an item or replace the description of code"""
+        entry = (description.lower(), code, description)
+        with self._lock:
+            self._remove(code)
+            bisect.insort(self._entries, entry)
+            self._codes[code] = entry
+
+    def remove(self, code):
+        with self._lock:
+            self._remove(code)
+
+    def _remove(self, code):
+        entry = self._codes.pop(code, None)
+        if entry is not None:
+            del self._entries[bisect.bisect_left(self._entries, entry)]
+
+    def complete(self, prefix, limit=10):
+        """At most limit items whose description starts with prefix, in
+        the order of the descriptions.  Returns dicts of 'code' and
+        'description'.
+        """
+        prefix = prefix.lower()
+        with self._lock:
+            i = bisect.bisect_left(self._entries, (prefix,))
+            entries = self._entries[i:i + limit]
+
+        res = []
+        for key, code, description in entries:
+            if not key.startswith(prefix):
+                break
+            res.append({'code': code, 'description': description})
+        return res
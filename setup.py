@@ -10,6 +10,8 @@ setup(
     license = "AGPL",
     keywords = "web shop catalog basket",
     packages = ['putiikki'],
+    # putiikki.statements builds on internals of the 1.2 compiler
+    install_requires = ['SQLAlchemy>=1.2,<1.3'],
     classifiers = [ "Development Status :: 1 - Planning",
                     "Intended Audience :: Developers",
                     "License :: OSI Approved :: GNU Affero General Public License v3"]
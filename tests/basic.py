@@ -7,11 +7,26 @@ sys.path.append(os.path.abspath("../"))
 
 MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-from putiikki import be, models
+from putiikki import be, cache, jsonstream, models, typeahead
 
+try:
+    from putiikki import aio
+except (ImportError, SyntaxError):
+    # asyncpg missing or Python older than 3.5
+    aio = None
+
+import asyncio
+import collections
+import csv
+import datetime
+import decimal
+import io
 import json
+import threading
 import uuid
 
+import sqlalchemy as sqla
+
 def fill_clear_db(fun):
     def new_fun(self, *args, **kw):
         self.fill_db()
@@ -37,6 +52,7 @@ class Simple(unittest.TestCase):
         self.catalog = be.Catalog(self.eng)
 
     def clear_db(self):
+        rows = self.catalog.session.query(models.Order).delete()
         rows = self.catalog.session.query(models.StockItem).delete()
         rows = self.catalog.session.query(models.Item).delete()
         rows = self.catalog.session.query(models.Category).delete()
@@ -49,6 +65,874 @@ class Simple(unittest.TestCase):
             items = json.load(fp, encoding="ISO-8859-1")
             self.catalog.add_items_with_stock(items)
 
+    def load_items(self):
+        with open(os.path.join(MODULE_DIR, 'shop_catalog1.json'), 'r',
+                  encoding="ISO-8859-1") as fp:
+            return json.load(fp, encoding="ISO-8859-1")
+
+    def test_bulk_add_items_with_stock(self):
+        items = self.load_items()
+        stats = self.catalog.bulk_add_items_with_stock(items, chunk_size=3)
+        self.catalog.session.commit()
+
+        self.assertEqual(stats['items']['rows'], len(items))
+        self.assertEqual(stats['item_categories']['rows'], len(items))
+        self.assertEqual(stats['stock_items']['rows'], len(items))
+        self.assertEqual(stats['categories']['rows'], 3)
+
+        res = self.catalog.list_items('description', page=1, page_size=50)
+        self.assertEqual(len(res), len(items))
+        stock = self.catalog.get_stock('SIEMENP_CAPBACC_LEMONDROP20')
+        self.assertEqual(stock[2], 20)
+
+        self.clear_db()
+
+    def test_import_items(self):
+        items = self.load_items()
+        broken = [dict(x) for x in items]
+        del broken[4]['code']
+
+        positions = []
+        fp = io.StringIO(json.dumps(broken))
+        with self.assertRaises(KeyError):
+            self.catalog.import_items(fp, 'shop_catalog1.json', chunk_size=3,
+                                      progress=positions.append)
+        self.assertEqual(positions, [3])
+
+        fp = io.StringIO(json.dumps(items))
+        count = self.catalog.import_items(fp, 'shop_catalog1.json',
+                                          chunk_size=3,
+                                          progress=positions.append)
+        self.assertEqual(count, len(items))
+        self.assertEqual(positions, [3, 6, 9, 10])
+
+        res = self.catalog.list_items('description', page=1, page_size=50)
+        self.assertEqual(len(res), len(items))
+        self.clear_db()
+        self.catalog.session.commit()
+
+        # a chunk is retried with its position
+        catalog = be.Catalog(self.eng, retry=be.RetryPolicy(
+            attempts=2, sleep=lambda x: None))
+        failed = []
+
+        def fail_once(session, context):
+            if len(failed) == 0:
+                failed.append(True)
+                session.connection().execute(
+                    "DO $$ BEGIN RAISE EXCEPTION 'conflict' "
+                    "USING ERRCODE = 'serialization_failure'; END $$")
+
+        sqla.event.listen(catalog.session, 'after_flush', fail_once)
+        positions = []
+        fp = io.StringIO(json.dumps(items))
+        count = catalog.import_items(fp, 'shop_catalog2.json', chunk_size=3,
+                                     progress=positions.append)
+        self.assertEqual(count, len(items))
+        self.assertEqual(positions, [3, 6, 9, 10])
+        self.assertEqual(sum(x['retries'] for x in
+                             catalog.retry_stats().values()), 1)
+        fp = io.StringIO(json.dumps(items))
+        self.assertEqual(catalog.import_items(fp, 'shop_catalog2.json'),
+                         len(items))
+        catalog.session.close()
+
+        self.clear_db()
+
+    def collect_pages(self, fun, *args, **kw):
+        items = []
+        cursor = ''
+        while cursor is not None:
+            res = fun(*args, cursor=cursor, **kw)
+            self.assertLessEqual(len(res['items']), kw['page_size'])
+            items.extend(res['items'])
+            cursor = res['cursor']
+        return items
+
+    @fill_clear_db
+    def test_keyset_pagination(self):
+        catalog = self.catalog
+        for sort_key in ('description', 'price'):
+            for ascending in (True, False):
+                expected = catalog.list_items(sort_key, ascending,
+                                              page=1, page_size=50)
+                items = self.collect_pages(catalog.list_items, sort_key,
+                                           ascending, page_size=3)
+                self.assertEqual(items, expected)
+
+                expected = catalog.search_items('', (2.0, 5.0), sort_key,
+                                                ascending, page=1,
+                                                page_size=50)
+                items = self.collect_pages(catalog.search_items, '',
+                                           (2.0, 5.0), sort_key, ascending,
+                                           page_size=2)
+                self.assertEqual(items, expected)
+
+        prices = [('<', 2.0), ('range', 2.0, 4.99), ('>=', 5.0)]
+        for ascending in (True, False):
+            expected = catalog.list_items_by_prices(prices,
+                                                    ascending=ascending,
+                                                    page=1, page_size=50)
+            items = self.collect_pages(catalog.list_items_by_prices, prices,
+                                       ascending=ascending, page_size=4)
+            self.assertEqual(items, expected)
+
+        with self.assertRaises(ValueError):
+            catalog.list_items(cursor='garbage', page_size=3)
+        # values of the wrong type for their columns
+        for values in (['lemon', 'x'], [1, 2], ['lemon\x00', 2],
+                       ['lemon', 2.5], ['lemon', True]):
+            with self.assertRaises(ValueError):
+                catalog.list_items(cursor=be.encode_cursor(values),
+                                   page_size=3)
+        for values in ([[], 2], ['NaN', 2], [1.5, 2]):
+            with self.assertRaises(ValueError):
+                catalog.list_items('price', cursor=be.encode_cursor(values),
+                                   page_size=3)
+        self.assertEqual(len(catalog.list_items(
+            'price', cursor=be.encode_cursor(['1.50', 2]),
+            page_size=3)['items']), 3)
+
+    @fill_clear_db
+    def test_result_formats(self):
+        catalog = be.Catalog(self.eng, prepared=True)
+        prices = [('<', 2.0), ('range', 2.0, 4.99), ('>=', 5.0)]
+        calls = [lambda **kw: catalog.list_items('price', **kw),
+                 lambda **kw: catalog.search_items('lemon', (0.0, 5.0), **kw),
+                 lambda **kw: catalog.list_items_by_category(
+                     'Siemenpussit :: Chilit :: Capsicum chinense', **kw),
+                 lambda **kw: catalog.search_text('siemenpussi', **kw),
+                 lambda **kw: catalog.list_items_by_prices(prices, **kw)]
+        for fun in calls:
+            for cursor in (None, ''):
+                expected = fun(page_size=4, cursor=cursor)
+                rows = fun(page_size=4, cursor=cursor, result='row')
+                data = fun(page_size=4, cursor=cursor, result='json')
+                res = json.loads(data.decode('utf8'),
+                                 parse_float=decimal.Decimal)
+                if cursor is None:
+                    self.assertEqual([x._asdict() for x in rows], expected)
+                    self.assertEqual(res, expected)
+                else:
+                    self.assertEqual([x._asdict() for x in rows['items']],
+                                     expected['items'])
+                    self.assertEqual(rows['cursor'], expected['cursor'])
+                    self.assertEqual(res, expected)
+
+        res = catalog.list_items(result='row', page_size=1)
+        self.assertIsInstance(res[0], be.ItemRow)
+        self.assertEqual(catalog.list_items(page=5, result='json'), b'[]')
+        with self.assertRaises(ValueError):
+            catalog.list_items(result='xml')
+        catalog.session.rollback()
+        catalog.session.close()
+
+    @fill_clear_db
+    def test_export(self):
+        catalog = self.catalog
+        items = sorted(catalog.list_items(page_size=50),
+                       key=lambda x: x['code'])
+
+        fp = io.StringIO()
+        self.assertEqual(catalog.export(fp, batch_size=3), len(items))
+        lines = fp.getvalue().splitlines()
+        self.assertEqual([json.loads(x, parse_float=decimal.Decimal)
+                          for x in lines], items)
+
+        fp = io.StringIO()
+        self.assertEqual(catalog.export(fp, 'csv', batch_size=3), len(items))
+        fp.seek(0)
+        rows = list(csv.DictReader(fp))
+        self.assertEqual([x['code'] for x in rows],
+                         [x['code'] for x in items])
+        self.assertEqual([decimal.Decimal(x['price']) for x in rows],
+                         [x['price'] for x in items])
+
+        with self.assertRaises(ValueError):
+            catalog.export(io.StringIO(), 'xml')
+        catalog.session.commit()
+
+    @fill_clear_db
+    def test_search(self):
+        catalog = self.catalog
+        res = catalog.search_text('siemenpussi 20', page_size=50)
+        self.assertEqual(sorted(x['code'] for x in res),
+                         ['SIEMENP_CAPANN_PADRON20',
+                          'SIEMENP_CAPBACC_AJICRISTAL20',
+                          'SIEMENP_CAPBACC_LEMONDROP20'])
+        res = catalog.search_text('lemon DR', price_range=(0.0, 2.0))
+        self.assertEqual([x['code'] for x in res],
+                         ['SIEMENP_CAPBACC_LEMONDROP5'])
+        self.assertEqual(catalog.search_text(' ,'), [])
+
+        catalog.update_item('SIEMENP_CAPCHIN_CAJAM5',
+                            long_description='Peruvian yellow habanero')
+        res = catalog.search_text('peru habanero')
+        self.assertEqual([x['code'] for x in res], ['SIEMENP_CAPCHIN_CAJAM5'])
+
+        # the shortest description is the most relevant
+        res = catalog.search_text('siemenpussi', page_size=50)
+        self.assertEqual(len(res), 10)
+        self.assertEqual(res[0]['code'], 'SIEMENP_CAPCHIN_7POT5')
+        self.assertEqual(self.collect_pages(catalog.search_text,
+                                            'siemenpussi', page_size=3),
+                         res)
+
+        # LIKE wildcards in prefixes are matched literally
+        self.assertEqual(len(catalog.search_items('aji', (0.0, 10.0))), 2)
+        self.assertEqual(catalog.search_items('%', (0.0, 10.0)), [])
+        self.assertEqual(catalog.list_items_by_prices([('<', 10.0)],
+                                                      prefix='_'), [])
+
+    @fill_clear_db
+    def test_facets(self):
+        catalog = be.Catalog(self.eng, result_cache_size=10)
+        prices = [('<', 2.0), ('range', 2.0, 4.99), ('>=', 5.0)]
+        for prefix in (None, 'aji', 'nothing'):
+            items = catalog.list_items_by_prices(prices, prefix=prefix,
+                                                 page_size=50)
+            res = catalog.facets_by_prices(prices, prefix)
+            self.assertEqual(res['total'], len(items))
+            self.assertEqual(res['price_groups'],
+                             [len([x for x in items if x['price_group'] == i])
+                              for i in range(len(prices))])
+            self.assertEqual(res['categories'], dict(
+                collections.Counter(x['category'] for x in items)))
+
+        # reservations do not change the counts
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket.add_item('SIEMENP_CAPBACC_LEMONDROP5', 1)
+        hits = catalog.result_cache_stats()['hits']
+        self.assertEqual(catalog.facets_by_prices(prices)['total'], 10)
+        self.assertEqual(catalog.result_cache_stats()['hits'], hits + 1)
+        catalog.session.rollback()
+        catalog.session.close()
+
+    @fill_clear_db
+    def test_list_items_by_category(self):
+        catalog = self.catalog
+        chinense = 'Siemenpussit :: Chilit :: Capsicum chinense'
+        res = catalog.list_items_by_category(chinense, 'price',
+                                             ascending=False)
+        self.assertEqual(len(res), 4)
+        self.assertEqual(set(x['category'] for x in res), set([chinense]))
+        self.assertEqual(self.collect_pages(catalog.list_items_by_category,
+                                            chinense, 'price',
+                                            ascending=False, page_size=3),
+                         res)
+        res = catalog.list_items_by_category(chinense, prefix='naga',
+                                             price_range=(1.0, 2.0))
+        self.assertEqual([x['code'] for x in res], ['SIEMENP_CAPCHIN_NAGA5'])
+        self.assertEqual(catalog.list_items_by_category('Nothing'), [])
+
+        # items are listed in their other categories too
+        catalog.add_category('Tarjoukset')
+        item = catalog.get_item('SIEMENP_CAPBACC_LEMONDROP5')
+        category = catalog.session.query(models.Category).\
+          filter(models.Category.name == 'Tarjoukset').one()
+        catalog.add_item_category(item[0], category.id)
+        res = catalog.list_items_by_category('Tarjoukset')
+        self.assertEqual([(x['code'], x['category']) for x in res],
+                         [('SIEMENP_CAPBACC_LEMONDROP5', 'Tarjoukset')])
+        catalog.session.commit()
+
+    def reserved(self, code):
+        stock = self.catalog.get_stock(code, as_object=True)
+        return stock.reserved
+
+    @fill_clear_db
+    def test_reserved_counts(self):
+        catalog = self.catalog
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket.add_item('SIEMENP_CAPBACC_LEMONDROP5', 5)
+        basket.add_item('SIEMENP_CAPBACC_LEMONDROP20', 8)
+        basket2 = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket2.add_item('SIEMENP_CAPBACC_LEMONDROP5', 16)
+        basket2.add_item('SIEMENP_CAPBACC_LEMONDROP20', 4)
+        catalog.session.commit()
+
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP5'), 20)
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP20'), 12)
+        self.assertEqual(catalog.check_reservations(), [])
+
+        basket2.update_item_count('SIEMENP_CAPBACC_LEMONDROP20', 1)
+        basket2.remove_item('SIEMENP_CAPBACC_LEMONDROP5')
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP5'), 5)
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP20'), 9)
+
+        basket.delete()
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP5'), 0)
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP20'), 1)
+        self.assertEqual(catalog.check_reservations(), [])
+        catalog.session.commit()
+
+        catalog.session.query(models.StockItem).\
+          update({models.StockItem.reserved: 3})
+        res = catalog.check_reservations(repair=True)
+        self.assertEqual(len(res), 10)
+        self.assertEqual(catalog.check_reservations(), [])
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP20'), 1)
+        catalog.session.commit()
+
+    @fill_clear_db
+    def test_basket_add_item(self):
+        catalog = self.catalog
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket.add_item('SIEMENP_CAPBACC_LEMONDROP5', 5)
+        basket2 = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket2.add_item('SIEMENP_CAPBACC_LEMONDROP5', 10)
+        basket2.add_item('SIEMENP_CAPBACC_LEMONDROP5', 10)
+
+        items = basket2.list_items()
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0]['count'], 20)
+        self.assertEqual(items[0]['reserved'], 15)
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP5'), 20)
+
+        basket.remove_item('SIEMENP_CAPBACC_LEMONDROP5')
+        basket2.add_item('SIEMENP_CAPBACC_LEMONDROP5', 1)
+        items = basket2.list_items()
+        self.assertEqual(items[0]['count'], 21)
+        self.assertEqual(items[0]['reserved'], 20)
+        self.assertEqual(catalog.check_reservations(), [])
+
+        catalog.add_items([{'code': 'SIEMENP_NOSTOCK',
+                            'description': 'Not in stock',
+                            'categories': []}])
+        catalog.session.commit()
+
+        with self.assertRaisesRegex(ValueError, 'Unknown code'):
+            basket.add_item('SIEMENP_NOSUCHITEM', 1)
+        catalog.session.rollback()
+
+        with self.assertRaisesRegex(ValueError, 'Not in stock'):
+            basket.add_item('SIEMENP_NOSTOCK', 1)
+        catalog.session.rollback()
+
+    @fill_clear_db
+    def test_basket_add_items(self):
+        catalog = self.catalog
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket.add_item('SIEMENP_CAPBACC_LEMONDROP5', 5)
+        basket2 = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket2.add_item('SIEMENP_CAPANN_PADRON20', 2)
+
+        res = basket2.add_items([('SIEMENP_CAPBACC_LEMONDROP5', 10),
+                                 ('SIEMENP_NOSUCHITEM', 1),
+                                 ('SIEMENP_CAPBACC_LEMONDROP5', 10),
+                                 ('SIEMENP_CAPANN_PADRON20', 1)])
+        self.assertEqual([x['status'] for x in res],
+                         ['ok', 'unknown code', 'ok', 'ok'])
+        self.assertEqual(res[0], {'code': 'SIEMENP_CAPBACC_LEMONDROP5',
+                                  'status': 'ok', 'count': 20,
+                                  'reserved': 15})
+        self.assertEqual(res[3]['count'], 3)
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP5'), 20)
+
+        res = basket2.set_items([('SIEMENP_CAPBACC_LEMONDROP5', 4),
+                                 ('SIEMENP_CAPANN_PADRON20', 0),
+                                 ('SIEMENP_CAPCHIN_NAGA5', 2)])
+        self.assertEqual([x['reserved'] for x in res], [4, 0, 2])
+        items = basket2.list_items()
+        self.assertEqual([(x['code'], x['count'], x['reserved'])
+                          for x in items],
+                         [('SIEMENP_CAPBACC_LEMONDROP5', 4, 4),
+                          ('SIEMENP_CAPCHIN_NAGA5', 2, 2)])
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP5'), 9)
+        self.assertEqual(self.reserved('SIEMENP_CAPANN_PADRON20'), 0)
+        self.assertEqual(catalog.check_reservations(), [])
+        catalog.session.commit()
+
+    @fill_clear_db
+    def test_expire_baskets(self):
+        catalog = self.catalog
+        old = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        baskets = []
+        for i in range(5):
+            basket = be.Basket.create(catalog, str(uuid.uuid4()))
+            basket.add_items([('SIEMENP_CAPBACC_LEMONDROP5', 2),
+                              ('SIEMENP_CAPANN_PADRON20', 1)])
+            baskets.append(basket)
+        catalog.session.query(models.Basket).\
+          update({models.Basket.modification: old})
+        catalog.session.commit()
+
+        # changes keep a basket alive
+        baskets[0].add_item('SIEMENP_CAPCHIN_NAGA5', 1)
+        baskets[1].update_item_count('SIEMENP_CAPANN_PADRON20', 2)
+        catalog.session.commit()
+
+        res = catalog.expire_baskets(3600, batch_size=2)
+        self.assertEqual(res, {'baskets': 3, 'basket_items': 6,
+                               'reservations': 6, 'units': 9})
+        self.assertEqual(catalog.session.query(models.Basket).count(), 2)
+        self.assertEqual(self.reserved('SIEMENP_CAPBACC_LEMONDROP5'), 4)
+        self.assertEqual(catalog.check_reservations(), [])
+        self.assertEqual(catalog.expire_baskets(3600)['baskets'], 0)
+        catalog.session.commit()
+
+    def test_iter_array(self):
+        items = [{'code': 'A', 'price': -1.5e-3, 'count': 12345,
+                  'visible': True, 'text': 'x' * 40, 'none': None},
+                 [False, 'a \\"b\\" \\u00e4', 0.25], 'c', 7]
+        text = json.dumps(items * 20)
+        for size in (1, 3, 7, 64):
+            self.assertEqual(list(jsonstream.iter_array(
+                io.StringIO(text), buffer_size=size)), items * 20)
+
+        class CountingReader(io.StringIO):
+            reads = 0
+
+            def read(self, size=-1):
+                self.reads += 1
+                return super().read(size)
+
+        # malformed and too long elements are reported at once
+        fp = CountingReader('[{"a": 1}, {"a": x, "b": 2}, ' +
+                            ', '.join(['{"a": 1}'] * 10000) + ']')
+        with self.assertRaisesRegex(ValueError, 'at 11'):
+            list(jsonstream.iter_array(fp, buffer_size=64))
+        self.assertLess(fp.reads, 5)
+
+        fp = CountingReader('[1, "' + 'x' * 100000 + '"]')
+        with self.assertRaisesRegex(ValueError, 'longer than 1000'):
+            list(jsonstream.iter_array(fp, buffer_size=64,
+                                       max_element_size=1000))
+        self.assertLess(fp.reads, 30)
+
+    def test_lru_cache(self):
+        now = [0.0]
+        lru = cache.LRUCache(2, ttl=10.0, clock=lambda: now[0])
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.put('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+        self.assertIsNone(lru.get('c', valid=lambda x: x != 3))
+        now[0] = 10.0
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.stats(), {'size': 2, 'entries': 1,
+                                       'hits': 2, 'misses': 3})
+
+    def test_typeahead_index(self):
+        index = typeahead.TypeaheadIndex([('B1', 'Bhut Jolokia'),
+                                          ('A1', 'Aji cristal'),
+                                          ('A2', 'aji Lemon')])
+        self.assertEqual([x['code'] for x in index.complete('AJI')],
+                         ['A1', 'A2'])
+        index.add('A1', 'Ajo blanco')
+        index.add('A3', 'Aji amarillo')
+        index.remove('A2')
+        index.remove('X1')
+        self.assertEqual(index.complete('aj', limit=2),
+                         [{'code': 'A3', 'description': 'Aji amarillo'},
+                          {'code': 'A1', 'description': 'Ajo blanco'}])
+        self.assertEqual(index.complete('c'), [])
+        self.assertEqual(len(index), 3)
+
+    @fill_clear_db
+    def test_typeahead(self):
+        catalog = be.Catalog(self.eng, typeahead=True)
+        self.assertEqual(catalog.typeahead('lemon d'),
+                         self.catalog.typeahead('lemon d'))
+        self.assertEqual(len(catalog.typeahead('')), 10)
+        self.catalog.session.commit()
+
+        # changes are seen when they are committed
+        catalog.add_item('SIEMENP_CAPBACC_LEMONYELLOW', 'Lemon yellow')
+        self.assertEqual(len(catalog.typeahead('lemon')), 2)
+        catalog.session.rollback()
+        self.assertEqual(len(catalog.typeahead('lemon')), 2)
+
+        catalog.add_item('SIEMENP_CAPBACC_LEMONYELLOW', 'Lemon yellow')
+        catalog.update_item('SIEMENP_CAPBACC_LEMONDROP5',
+                            new_code='SIEMENP_CAPBACC_LEMONDROP6',
+                            description='Lemon Drop 6 seeds')
+        catalog.session.commit()
+        self.assertEqual([x['code'] for x in catalog.typeahead('lemon')],
+                         ['SIEMENP_CAPBACC_LEMONDROP6',
+                          'SIEMENP_CAPBACC_LEMONDROP20',
+                          'SIEMENP_CAPBACC_LEMONYELLOW'])
+        self.assertEqual(catalog.typeahead('lemon'),
+                         self.catalog.typeahead('lemon'))
+
+        catalog.remove_item('SIEMENP_CAPBACC_LEMONYELLOW')
+        catalog.session.commit()
+        self.assertEqual(len(catalog.typeahead('lemon')), 2)
+        catalog.session.close()
+        self.catalog.session.commit()
+
+    @fill_clear_db
+    def test_item_cache(self):
+        catalog = be.Catalog(self.eng, cache_size=100)
+        code = 'SIEMENP_CAPBACC_LEMONDROP20'
+        item = catalog.get_item(code)
+        self.assertEqual(catalog.get_item(code), item)
+        stock = catalog.get_stock(code)
+        self.assertEqual(catalog.get_stock(code), stock)
+        self.assertEqual(catalog.cache_stats()['hits'], 2)
+        self.assertEqual(catalog.cache_stats()['misses'], 2)
+
+        catalog.update_stock(code, count=5, price=6.00)
+        self.assertEqual(catalog.get_stock(code)[2], stock[2] + 5)
+
+        catalog.update_item(code, new_code='SIEMENP_CAPBACC_LEMONDROP25')
+        self.assertIsNone(catalog.get_item(code))
+
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket.add_item('SIEMENP_CAPBACC_LEMONDROP25', 2)
+        basket.update_item_count('SIEMENP_CAPBACC_LEMONDROP25', 3)
+        self.assertEqual(basket.list_items()[0]['reserved'], 3)
+        catalog.session.rollback()
+        catalog.session.close()
+
+    @fill_clear_db
+    def test_item_cache_transactions(self):
+        catalog = be.Catalog(self.eng, cache_size=100, scoped=True)
+        code = 'SIEMENP_CAPBACC_LEMONDROP20'
+        stock = catalog.get_stock(code)
+        read = []
+
+        def other():
+            read.append(catalog.get_stock(code))
+            catalog.close()
+
+        def read_other():
+            t = threading.Thread(target=other)
+            t.start()
+            t.join()
+            return read.pop()
+
+        catalog.update_stock(code, count=100, price=2.00)
+        changed = (stock[0], decimal.Decimal('2.00'), stock[2] + 100)
+        self.assertEqual(catalog.get_stock(code), changed)
+        # other sessions read and cache the committed row meanwhile
+        self.assertEqual(read_other(), stock)
+        catalog.session.rollback()
+        self.assertEqual(catalog.get_stock(code), stock)
+
+        catalog.update_stock(code, count=100, price=2.00)
+        self.assertEqual(read_other(), stock)
+        catalog.session.commit()
+        self.assertEqual(read_other(), changed)
+        self.assertEqual(catalog.get_stock(code), changed)
+        catalog.close()
+
+    @fill_clear_db
+    def test_prepared_statements(self):
+        catalog = be.Catalog(self.eng, prepared=True)
+        code = 'SIEMENP_CAPBACC_LEMONDROP20'
+        chinense = 'Siemenpussit :: Chilit :: Capsicum chinense'
+        calls = [lambda c: c.get_item(code),
+                 lambda c: c.get_stock(code),
+                 lambda c: c.get_item('NOTHING'),
+                 lambda c: c.list_items('price', False, page=2, page_size=3),
+                 lambda c: self.collect_pages(c.list_items, page_size=3),
+                 lambda c: c.search_items('aji', (0.0, 10.0)),
+                 lambda c: c.search_items('lemon', (0.0, 2.0)),
+                 lambda c: c.list_items_by_category(chinense, prefix='naga')]
+        for i in range(2):
+            for fun in calls:
+                self.assertEqual(fun(catalog), fun(self.catalog))
+        self.assertEqual(len(catalog.prepared), 7)
+        names = catalog.session.execute(
+            'SELECT name FROM pg_prepared_statements').fetchall()
+        self.assertEqual(len(names), 7)
+
+        basket = be.Basket.create(catalog, 'prepared')
+        self.assertEqual(be.Basket.get(catalog, 'prepared').id, basket.id)
+        self.assertIsNone(be.Basket.get(catalog, 'nothing'))
+        basket.add_item(code, 2)
+        basket.update_item_count(code, 3)
+        self.assertEqual(basket.list_items()[0]['count'], 3)
+        catalog.session.rollback()
+        catalog.session.close()
+
+    @fill_clear_db
+    def test_result_cache(self):
+        prices = [('<', 2.0), ('range', 2.0, 4.99), ('>=', 5.0)]
+        for staleness in (0, 3600):
+            catalog = be.Catalog(self.eng, result_cache_size=10,
+                                 reserved_staleness=staleness)
+            first = catalog.list_items(page=1, page_size=50)
+            self.assertEqual(catalog.list_items(page=1, page_size=50), first)
+            catalog.list_items_by_prices(prices, page=1, page_size=50)
+            catalog.list_items_by_prices(prices, page=1, page_size=50)
+            self.assertEqual(catalog.result_cache_stats()['hits'], 2)
+
+            basket = be.Basket.create(catalog, str(uuid.uuid4()))
+            basket.add_item('SIEMENP_CAPBACC_LEMONDROP5', 5)
+            res = catalog.list_items(page=1, page_size=50)
+            reserved = [x['reserved'] for x in res]
+            if staleness == 0:
+                self.assertEqual(sum(reserved), 5)
+            else:
+                self.assertEqual(sum(reserved), 0)
+            # a stale entry is a miss
+            self.assertEqual(catalog.result_cache_stats()['hits'],
+                             2 if staleness == 0 else 3)
+
+            catalog.update_item('SIEMENP_CAPBACC_LEMONDROP5',
+                                description='Lemon Drop, 5 seeds')
+            res = catalog.list_items(page=1, page_size=50)
+            self.assertEqual(sum(x['reserved'] for x in res), 5)
+            self.assertIn('Lemon Drop, 5 seeds',
+                          [x['description'] for x in res])
+            catalog.session.rollback()
+            catalog.session.close()
+
+    @fill_clear_db
+    def test_result_cache_transactions(self):
+        catalog = be.Catalog(self.eng, result_cache_size=10, scoped=True)
+        code = 'SIEMENP_CAPBACC_LEMONDROP5'
+        read = []
+
+        def descriptions():
+            return [x['description'] for x in
+                    catalog.list_items(page=1, page_size=50)]
+
+        def other():
+            read.append(descriptions())
+            catalog.close()
+
+        def read_other():
+            t = threading.Thread(target=other)
+            t.start()
+            t.join()
+            return read.pop()
+
+        first = descriptions()
+        catalog.update_item(code, description='Lemon Drop, 5 seeds')
+        self.assertIn('Lemon Drop, 5 seeds', descriptions())
+        catalog.session.rollback()
+        self.assertEqual(descriptions(), first)
+
+        # other sessions read the committed items meanwhile
+        catalog.update_item(code, description='Lemon Drop, 5 seeds')
+        self.assertEqual(read_other(), first)
+        catalog.session.commit()
+        self.assertIn('Lemon Drop, 5 seeds', read_other())
+        self.assertIn('Lemon Drop, 5 seeds', descriptions())
+
+        # basket changes only touch the reservations
+        versions = (catalog.catalog_version, catalog.reserved_version)
+        basket = catalog.create_basket(str(uuid.uuid4()))
+        basket.add_item(code, 2)
+        basket.update_item_count(code, 1)
+        basket.remove_item(code)
+        basket.add_item(code, 1)
+        basket.delete()
+        catalog.session.commit()
+        self.assertEqual(catalog.catalog_version, versions[0])
+        self.assertEqual(catalog.reserved_version, versions[1] + 1)
+
+        versions = (catalog.catalog_version, catalog.reserved_version)
+        self.assertEqual(catalog.check_reservations(repair=True), [])
+        catalog.session.commit()
+        self.assertEqual((catalog.catalog_version, catalog.reserved_version),
+                         versions)
+        catalog.close()
+
+    @fill_clear_db
+    def test_retry_serialization_failure(self):
+        code = 'SIEMENP_CAPBACC_LEMONDROP20'
+        retries = []
+        policy = be.RetryPolicy(attempts=3, sleep=lambda x: None,
+                                on_retry=lambda *args: retries.append(args))
+        catalog = be.Catalog(self.eng, retry=policy)
+        other = be.Catalog(self.eng)
+
+        def work(conflict):
+            stock = catalog.get_stock(code, as_object=True)
+            if conflict:
+                other.update_stock(code, count=1, price=5.00)
+                other.session.commit()
+            stock.count += 10
+            catalog.session.flush()
+            return stock.count
+
+        def conflict_once():
+            return work(len(retries) == 0)
+
+        def conflict_always():
+            return work(True)
+
+        self.assertEqual(catalog.transaction(conflict_once), 31)
+        self.assertEqual(len(retries), 1)
+        self.assertEqual(catalog.retry_stats(),
+                         {conflict_once.__qualname__: {'retries': 1,
+                                                       'failures': 0}})
+
+        with self.assertRaises(sqla.exc.OperationalError):
+            catalog.transaction(conflict_always)
+        stats = catalog.retry_stats()[conflict_always.__qualname__]
+        self.assertEqual(stats, {'retries': 2, 'failures': 1})
+
+        # a retry would lose the changes made before the transaction
+        item = catalog.get_item(code, as_object=True)
+        description = item.description
+        item.description = 'Pending'
+        with self.assertRaises(sqla.exc.OperationalError):
+            catalog.transaction(conflict_always)
+        stats = catalog.retry_stats()[conflict_always.__qualname__]
+        self.assertEqual(stats, {'retries': 2, 'failures': 2})
+        self.assertEqual(catalog.get_item(code)[2], description)
+
+        # top level calls of decorated methods commit by themselves
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket.add_item(code, 2)
+        stock = other.get_stock(code, as_object=True)
+        self.assertEqual(stock.reserved, 2)
+
+        # a flush failing at the end of a nested unit of work
+        with self.assertRaises(sqla.exc.IntegrityError):
+            catalog.transaction(catalog.add_items, [
+                {'code': code, 'description': 'Copy', 'categories': []}])
+        self.assertEqual(catalog.get_stock(code, as_object=True).reserved, 2)
+        other.session.close()
+        catalog.session.close()
+
+    @fill_clear_db
+    def test_scoped_sessions(self):
+        settings = { "DB_ENGINE" : { "drivername": "postgresql",
+                                     "database": "putiikki" },
+                     "DB_POOL": { "pool_size": 3, "max_overflow": 2,
+                                  "pool_pre_ping": True } }
+        eng = be.db_connect(settings)
+        self.assertEqual(be.pool_status(eng)['size'], 3)
+
+        # the baskets share a stock item, conflicts are retried
+        catalog = be.Catalog(eng, scoped=True,
+                             retry=be.RetryPolicy(attempts=50))
+        sessions = set()
+        errors = []
+        def work():
+            try:
+                for i in range(5):
+                    with catalog.request():
+                        sessions.add(id(catalog.session))
+                        basket = catalog.create_basket(str(uuid.uuid4()))
+                        basket.add_item('SIEMENP_CAPBACC_AJICRISTAL5', 1)
+                        # reads outside of decorated methods retried too
+                        catalog.transaction(catalog.list_items, page=1,
+                                            page_size=5)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertGreater(len(sessions), 1)
+        self.assertEqual(be.pool_status(eng)['checkedout'], 0)
+        stock = self.catalog.get_stock('SIEMENP_CAPBACC_AJICRISTAL5',
+                                       as_object=True)
+        self.assertEqual(stock.reserved, 20)
+        eng.dispose()
+
+        with self.assertRaises(ValueError):
+            be.db_connect({"DB_ENGINE": settings["DB_ENGINE"],
+                           "DB_POOL": {"pool_sise": 3}})
+
+    @unittest.skipIf(aio is None, 'asyncpg is not available')
+    @fill_clear_db
+    def test_aio(self):
+        settings = { "DB_ENGINE" : { "drivername": "postgresql",
+                                     "database": "putiikki" },
+                     "DB_POOL": { "pool_size": 4 } }
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        run = loop.run_until_complete
+        pool = run(aio.connect(settings))
+        catalog = aio.Catalog(pool, retry=be.RetryPolicy(attempts=50))
+        code = 'SIEMENP_CAPBACC_LEMONDROP5'
+        try:
+            prices = [('<', 2.0), ('range', 2.0, 4.99), ('>=', 5.0)]
+            res = run(asyncio.gather(
+                catalog.list_items(page=2, page_size=5),
+                catalog.list_items('price', cursor='', page_size=5),
+                catalog.search_items('Aji', (0.0, 2.0), 'price'),
+                catalog.search_text('siemenpussi', cursor='', page_size=5),
+                catalog.list_items_by_prices(prices, page_size=50),
+                catalog.facets_by_prices(prices, prefix='aji')))
+            self.assertEqual(res, [
+                self.catalog.list_items(page=2, page_size=5),
+                self.catalog.list_items('price', cursor='', page_size=5),
+                self.catalog.search_items('Aji', (0.0, 2.0), 'price'),
+                self.catalog.search_text('siemenpussi', cursor='',
+                                         page_size=5),
+                self.catalog.list_items_by_prices(prices, page_size=50),
+                self.catalog.facets_by_prices(prices, prefix='aji')])
+            self.assertEqual(run(catalog.get_stock(code)),
+                             self.catalog.get_stock(code))
+            self.assertEqual(run(catalog.typeahead('lemon', 3)),
+                             self.catalog.typeahead('lemon', 3))
+            self.catalog.session.commit()
+            run(catalog.update_item(code, long_description='Yellow habanero'))
+            self.assertEqual([x['code'] for x in
+                              self.catalog.search_text('lemon habanero')],
+                             [code])
+            self.catalog.session.commit()
+
+            # concurrent reservations of the same stock item
+            baskets = run(asyncio.gather(
+                *[catalog.create_basket(str(uuid.uuid4()))
+                  for i in range(4)]))
+            run(asyncio.gather(*[basket.add_item(code, 2)
+                                 for basket in baskets]))
+            self.assertEqual(self.reserved(code), 8)
+            self.catalog.session.commit()
+
+            basket = baskets[0]
+            res = run(basket.add_items([(code, 1), ('SIEMENP_NOSUCHITEM', 1)]))
+            self.assertEqual([x['status'] for x in res], ['ok', 'unknown code'])
+            run(basket.update_item_count(code, 4))
+            with self.assertRaises(ValueError):
+                run(basket.add_item('SIEMENP_NOSUCHITEM', 1))
+            sync_basket = be.Basket(self.catalog, basket.id)
+            self.assertEqual(run(basket.list_items()),
+                             sync_basket.list_items())
+            self.catalog.session.commit()
+
+            run(basket.delete())
+            self.assertEqual(self.reserved(code), 6)
+            self.assertEqual(self.catalog.check_reservations(), [])
+            self.catalog.session.commit()
+
+            sync_basket = be.Basket(self.catalog, baskets[1].id)
+            self.assertEqual(run(baskets[1].get_total([('<', 100.0)])),
+                             sync_basket.get_total([('<', 100.0)]))
+            self.catalog.session.commit()
+
+            res = run(baskets[1].checkout())
+            self.assertEqual([x['count'] for x in res['lines']], [2])
+            self.assertEqual(self.reserved(code), 4)
+            self.catalog.session.commit()
+
+            # lookups during a change cache the committed row until the
+            # transaction ends
+            cached = aio.Catalog(pool, cache_size=10)
+            old = run(cached.get_item(code))
+            table = models.Item.__table__
+
+            async def change(conn):
+                await aio.execute(conn, table.update().\
+                                  where(table.c.code == code).\
+                                  values(description='Changed'))
+                cached._invalidate(conn, [code])
+                self.assertEqual(await cached.get_item(code), old)
+
+            run(cached.transaction(change))
+            self.assertEqual(run(cached.get_item(code))[2], 'Changed')
+        finally:
+            run(pool.close())
+            loop.close()
+            asyncio.set_event_loop(None)
+
     @fill_clear_db
     def test_create_catalog(self):
         pass
@@ -69,6 +953,297 @@ class Simple(unittest.TestCase):
         except KeyError as ex:
             self.catalog.session.rollback()
 
+    @fill_clear_db
+    def test_update_stocks(self):
+        catalog = be.Catalog(self.eng, cache_size=10)
+        lemon = 'SIEMENP_CAPBACC_LEMONDROP20'
+        naga = 'SIEMENP_CAPCHIN_NAGA5'
+        count = catalog.get_stock(lemon)[2]
+        catalog.add_item('SIEMENP_NOSTOCK', 'Item without stock')
+
+        res = catalog.update_stocks([(lemon, 5, 6.00),
+                                     ('SIEMENP_NOSUCHITEM', 1, 1.00),
+                                     (lemon, 2, decimal.Decimal('6.50')),
+                                     ('SIEMENP_NOSTOCK', 3, 2.00)],
+                                    chunk_size=2)
+        self.assertEqual(res, {'updated': 1, 'inserted': 1,
+                               'unknown': ['SIEMENP_NOSUCHITEM']})
+        stock = catalog.get_stock(lemon)
+        self.assertEqual(stock[1:], (decimal.Decimal('6.50'), count + 7))
+        self.assertEqual(catalog.get_stock('SIEMENP_NOSTOCK')[2], 3)
+
+        res = catalog.update_stocks([(lemon, 1, 6.00), (naga, 0, 2.00)],
+                                    mode='absolute')
+        self.assertEqual(res, {'updated': 2, 'inserted': 0, 'unknown': []})
+        self.assertEqual(catalog.get_stock(lemon)[2], 1)
+        self.assertEqual(catalog.get_stock(naga)[2], 0)
+
+        with self.assertRaises(ValueError):
+            catalog.update_stocks([], mode='relative')
+        catalog.session.rollback()
+        catalog.session.close()
+
+    def reservations(self, baskets, code):
+        return [dict((x['code'], x['reserved'])
+                     for x in basket.list_items())[code]
+                for basket in baskets]
+
+    @fill_clear_db
+    def test_rebalance_reservations(self):
+        catalog = self.catalog
+        code = 'SIEMENP_CAPBACC_LEMONDROP5'
+        catalog.update_stocks([(code, 10, 2.00)], mode='absolute')
+        baskets = []
+        for i in range(3):
+            basket = be.Basket.create(catalog, str(uuid.uuid4()))
+            basket.add_item(code, 4)
+            baskets.append(basket)
+        self.assertEqual(self.reservations(baskets, code), [4, 4, 2])
+
+        # first come first served
+        catalog.update_stock(code, count=-4, price=2.00)
+        self.assertEqual(self.reservations(baskets, code), [4, 2, 0])
+        self.assertEqual(self.reserved(code), 6)
+        catalog.update_stocks([(code, 20, 2.00)], mode='absolute')
+        self.assertEqual(self.reservations(baskets, code), [4, 4, 4])
+        self.assertEqual(self.reserved(code), 12)
+        self.assertEqual(catalog.check_reservations(), [])
+
+        # only changes are written
+        self.assertEqual(catalog.rebalance_reservations([code]), 0)
+        baskets[0].update_item_count(code, 1)
+        catalog.session.query(models.StockItem).\
+          update({models.StockItem.count: 5})
+        self.assertEqual(catalog.rebalance_reservations([code, 'NOTHING']),
+                         1)
+        self.assertEqual(self.reservations(baskets, code), [1, 4, 0])
+        self.assertEqual(catalog.check_reservations(), [])
+        catalog.session.commit()
+
+    @fill_clear_db
+    def test_locking_reservations(self):
+        with self.assertRaises(ValueError):
+            be.Catalog(self.eng, reservation='optimistic')
+
+        code = 'SIEMENP_CAPBACC_AJICRISTAL5'
+        self.catalog.update_stocks([(code, 30, 2.00)], mode='absolute')
+        self.catalog.session.commit()
+
+        # a single attempt, nothing may fail with serialization failures
+        catalog = be.Catalog(self.eng, scoped=True, reservation='locking',
+                             retry=be.RetryPolicy(attempts=1))
+        with catalog.request():
+            level = catalog.session.execute('SHOW transaction_isolation')
+            self.assertEqual(level.scalar(), 'read committed')
+
+        errors = []
+        def work():
+            try:
+                for i in range(5):
+                    with catalog.request():
+                        basket = catalog.create_basket(str(uuid.uuid4()))
+                        basket.add_item(code, 1)
+                        basket.add_items([(code, 2)])
+                        basket.update_item_count(code, 1)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(catalog.retry_stats(), {})
+        self.assertEqual(self.reserved(code), 30)
+        self.assertEqual(self.catalog.check_reservations(), [])
+
+        # concurrent changes of one basket, in the same lock order
+        lemon = 'SIEMENP_CAPBACC_LEMONDROP5'
+        self.catalog.update_stocks([(lemon, 100, 2.00)], mode='absolute')
+        self.catalog.session.commit()
+        with catalog.request():
+            catalog.create_basket('shared').add_item(lemon, 1)
+
+        def shared(i):
+            try:
+                for j in range(5):
+                    with catalog.request():
+                        basket = catalog.get_basket('shared')
+                        if i % 2 == 0:
+                            basket.add_item(lemon, 1)
+                        else:
+                            basket.add_items([(lemon, 1)])
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=shared, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.reserved(lemon), 41)
+        self.assertEqual(self.catalog.check_reservations(), [])
+
+        # stock updates of the same items in different orders, and
+        # baskets deleted while others change them
+        with catalog.request():
+            for i in range(8):
+                catalog.create_basket('shared {:d}'.format(i)).\
+                  add_items([(code, 1), (lemon, 1)])
+
+        def stocks(i):
+            try:
+                for j in range(5):
+                    with catalog.request():
+                        rows = [(code, 1, 2.00), (lemon, 1, 2.00)]
+                        catalog.update_stocks(rows[::1 if i % 2 else -1],
+                                              chunk_size=1)
+                with catalog.request():
+                    basket = catalog.get_basket('shared {:d}'.format(i))
+                    basket.add_items([(lemon, 1), (code, 1)])
+                    basket.delete()
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=stocks, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.reserved(lemon), 41)
+        self.assertEqual(self.catalog.check_reservations(), [])
+        with catalog.request():
+            catalog.update_stocks([(code, -40, 2.00), (lemon, -40, 2.00)])
+
+        # stock changes lock too, and rebalance first come first served
+        with catalog.request():
+            catalog.update_stock(code, count=-20, price=2.00)
+        self.catalog.session.commit()
+        self.assertEqual(self.reserved(code), 10)
+        self.assertEqual(self.catalog.check_reservations(), [])
+
+        with catalog.request():
+            catalog.update_stock(code, count=31, price=2.00)
+            basket = catalog.create_basket(str(uuid.uuid4()))
+            basket.add_item(code, 2)
+            res = basket.checkout()
+        self.assertEqual(res['total'], decimal.Decimal('2.00'))
+        self.catalog.session.commit()
+        self.assertEqual(self.catalog.get_stock(code)[2], 40)
+        self.assertEqual(self.catalog.check_reservations(), [])
+        catalog.close()
+
+    @fill_clear_db
+    def test_checkout(self):
+        catalog = self.catalog
+        code1 = 'SIEMENP_CAPBACC_LEMONDROP5'
+        code2 = 'SIEMENP_CAPBACC_AJICRISTAL5'
+        catalog.update_stocks([(code1, 5, 2.00), (code2, 10, 3.50)],
+                              mode='absolute')
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        basket.add_items([(code1, 7), (code2, 2)])
+        other = be.Basket.create(catalog, str(uuid.uuid4()))
+        other.add_item(code2, 3)
+
+        # the reserved units are ordered, not the whole count
+        res = basket.checkout()
+        self.assertEqual(res['lines'],
+                         [{'code': code2, 'count': 2,
+                           'price': decimal.Decimal('3.50')},
+                          {'code': code1, 'count': 5,
+                           'price': decimal.Decimal('2.00')}])
+        self.assertEqual(res['total'], decimal.Decimal('17.00'))
+        order = catalog.session.query(models.Order).get(res['order'])
+        self.assertEqual(sorted(x.count for x in order.order_lines), [2, 5])
+
+        self.assertEqual(basket.list_items(), [])
+        self.assertEqual(catalog.get_stock(code1)[2], 0)
+        self.assertEqual(catalog.get_stock(code2)[2], 8)
+        self.assertEqual(self.reserved(code1), 0)
+        self.assertEqual(self.reserved(code2), 3)
+        self.assertEqual(catalog.check_reservations(), [])
+        catalog.session.commit()
+
+        with self.assertRaises(ValueError):
+            basket.checkout()
+        catalog.session.rollback()
+
+        # the guard, stock that no longer covers the reservations
+        catalog.session.query(models.StockItem).\
+          filter(models.StockItem.count == 8).\
+          update({models.StockItem.count: 2})
+        with self.assertRaises(ValueError):
+            other.checkout()
+        catalog.session.rollback()
+        self.assertEqual(self.reservations([other], code2), [3])
+        self.assertEqual(catalog.session.query(models.Order).count(), 1)
+        catalog.session.commit()
+
+    def total(self, basket):
+        items = basket.list_items()
+        return {'lines': len(items),
+                'units': sum(x['count'] for x in items),
+                'value': sum(x['count'] * x['price'] for x in items),
+                'reserved_value': sum(x['reserved'] * x['price']
+                                      for x in items)}
+
+    @fill_clear_db
+    def test_basket_total(self):
+        catalog = self.catalog
+        code1 = 'SIEMENP_CAPBACC_LEMONDROP5'
+        code2 = 'SIEMENP_CAPBACC_AJICRISTAL5'
+        catalog.update_stocks([(code1, 5, 2.00), (code2, 10, 3.50)],
+                              mode='absolute')
+        basket = be.Basket.create(catalog, str(uuid.uuid4()))
+        D = decimal.Decimal
+        self.assertEqual(basket.get_total(),
+                         {'lines': 0, 'units': 0, 'value': D('0.00'),
+                          'reserved_value': D('0.00')})
+
+        basket.add_items([(code1, 7), (code2, 2)])
+        res = basket.get_total()
+        self.assertEqual(res, {'lines': 2, 'units': 9, 'value': D('21.00'),
+                               'reserved_value': D('17.00')})
+        self.assertEqual(res, self.total(basket))
+
+        basket.update_item_count(code1, 3)
+        basket.add_item(code2, 1)
+        self.assertEqual(basket.get_total(), self.total(basket))
+        self.assertEqual(basket.get_total()['value'], D('16.50'))
+
+        # price and stock changes reach the totals
+        catalog.update_stock(code2, count=0, price=4.00)
+        self.assertEqual(basket.get_total()['value'], D('18.00'))
+        catalog.update_stocks([(code1, 1, 2.00)], mode='absolute')
+        self.assertEqual(basket.get_total()['reserved_value'], D('14.00'))
+        self.assertEqual(basket.get_total(), self.total(basket))
+
+        prices = [('<', 3.0), ('>=', 3.0), ('>', 100.0)]
+        res = basket.get_total(prices)
+        self.assertEqual(res['price_groups'],
+                         [{'lines': 1, 'units': 3, 'value': D('6.00'),
+                           'reserved_value': D('2.00')},
+                          {'lines': 1, 'units': 3, 'value': D('12.00'),
+                           'reserved_value': D('12.00')},
+                          {'lines': 0, 'units': 0, 'value': D('0.00'),
+                           'reserved_value': D('0.00')}])
+        self.assertEqual(res['value'], D('18.00'))
+
+        basket.remove_item(code1)
+        self.assertEqual(basket.get_total(), self.total(basket))
+        basket.checkout()
+        self.assertEqual(basket.get_total()['lines'], 0)
+        self.assertIsNone(be.Basket(catalog, -1).get_total())
+        catalog.session.commit()
+
     @fill_clear_db
     def test_long_success(self):
         catalog = self.catalog